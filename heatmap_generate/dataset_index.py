@@ -0,0 +1,73 @@
+import gzip
+import hashlib
+import json
+import os
+
+import torchvision.datasets as datasets
+
+# Listing the ImageNet tree takes minutes on a network filesystem. The file
+# index of an ImageFolder (class names and file names) is cached in a small
+# gzipped JSON file and reused as long as the mtimes of the root and of every
+# class directory are unchanged; adding or removing a file changes the mtime
+# of its class directory.
+
+INDEX_VERSION = 1
+
+
+def index_path(root, cache_dir):
+    key = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+    return os.path.join(os.path.expanduser(cache_dir), 'index_%s.json.gz' % key)
+
+
+def directory_mtimes(directory, classes):
+    mtimes = {'': os.stat(directory).st_mtime_ns}
+    for name in classes:
+        mtimes[name] = os.stat(os.path.join(directory, name)).st_mtime_ns
+    return mtimes
+
+
+class CachedImageFolder(datasets.ImageFolder):
+    """ImageFolder that reads its file index from `cache_dir` when it is up to date"""
+
+    def __init__(self, root, transform=None, cache_dir='~/.cache/obe'):
+        self.cache_dir = cache_dir
+        super(CachedImageFolder, self).__init__(root, transform)
+
+    def make_dataset(self, directory, class_to_idx, *args, **kwargs):
+        path = index_path(directory, self.cache_dir)
+        mtimes = directory_mtimes(directory, class_to_idx)
+        index = self._load_index(path)
+        if index is not None and index['mtimes'] == mtimes:
+            return [(os.path.join(directory, name, f), class_to_idx[name])
+                    for name in sorted(index['files']) for f in index['files'][name]]
+
+        samples = super(CachedImageFolder, self).make_dataset(directory, class_to_idx, *args, **kwargs)
+        files = dict((name, []) for name in class_to_idx)
+        idx_to_class = dict((idx, name) for name, idx in class_to_idx.items())
+        for sample_path, target in samples:
+            files[idx_to_class[target]].append(os.path.relpath(sample_path, os.path.join(directory, idx_to_class[target])))
+        self._save_index(path, {'version': INDEX_VERSION, 'root': os.path.abspath(directory),
+                                'mtimes': mtimes, 'files': files})
+        return samples
+
+    @staticmethod
+    def _load_index(path):
+        try:
+            with gzip.open(path, 'rt') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if index.get('version') != INDEX_VERSION:
+            return None
+        return index
+
+    @staticmethod
+    def _save_index(path, index):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write then rename, so concurrent runs never read a partial index
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with gzip.open(tmp_path, 'wt') as f:
+            json.dump(index, f)
+        os.rename(tmp_path, path)
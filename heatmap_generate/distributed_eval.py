@@ -0,0 +1,55 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data
+
+# Distributed validation: every rank evaluates a contiguous shard of the
+# validation set, the correct counts are summed exactly over the ranks and
+# only rank 0 writes results. Launch on one or several hosts with torchrun:
+#
+#   torchrun --nproc_per_node 4 erase_experiment_imagenet.py -a resnet50 -e --pretrained DIR
+#   torchrun --nnodes 2 --node_rank 0 --master_addr HOST --nproc_per_node 16 ...
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """Contiguous shard of a dataset without the padding of DistributedSampler,
+    so every image is counted exactly once and the shards concatenate in order"""
+
+    def __init__(self, data_source, rank, world_size):
+        size = len(data_source)
+        self.start = size * rank // world_size
+        self.end = size * (rank + 1) // world_size
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+
+def default_backend():
+    return 'nccl' if torch.cuda.is_available() else 'gloo'
+
+
+def is_main_process(args):
+    return not args.distributed or args.rank == 0
+
+
+def reduce_sum(values, args):
+    """Sum integer counts over all ranks"""
+    if not args.distributed:
+        return list(values)
+    counts = torch.tensor(values, dtype=torch.long)
+    if dist.get_backend() == 'nccl':
+        counts = counts.cuda(args.gpu)
+    dist.all_reduce(counts, op=dist.ReduceOp.SUM)
+    return counts.tolist()
+
+
+def gather_in_rank_order(array, args):
+    """Concatenate a per-rank numpy array over the ranks in rank order"""
+    if not args.distributed:
+        return array
+    parts = [None] * dist.get_world_size()
+    dist.all_gather_object(parts, array)
+    return np.concatenate(parts)
@@ -4,7 +4,10 @@ import random
 import shutil
 import time
 import warnings
+import sys
 import math 
+import json
+import re
 
 import torch
 import torch.nn as nn
@@ -21,15 +24,23 @@ import torchvision.models as models
 
 from torchvision.utils import save_image
 
-from preprocess import MyEraseTransform, MyEraseCircleTransform, MyRandomErasePixelTransform, MyEraseEvenTransform, MyEraseJPEGTransform
+from preprocess import MyEraseTransform, MyEraseCircleTransform, MyRandomErasePixelTransform, MyEraseEvenTransform, MyEraseJPEGTransform, MyUint8Normalize
+from results_store import ResultsStore, pack_bits, pack_floats
+from dataset_index import CachedImageFolder
+from synthetic_data import SyntheticImageNet, load_offline_model
+from weight_snapshot import fold_batchnorm, load_snapshot, save_snapshot
+from autotune import apply_profile, autotune, benchmark, report, trial_config
+from layer_profiler import LayerProfiler
+from telemetry import Telemetry
+from distributed_eval import ShardSampler, default_backend, gather_in_rank_order, is_main_process, reduce_sum
 
 model_names = sorted(name for name in models.__dict__
     if name.islower() and not name.startswith("__")
     and callable(models.__dict__[name]))
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
-parser.add_argument('data', metavar='DIR',
-                    help='path to dataset')
+parser.add_argument('data', metavar='DIR', nargs='?', default='',
+                    help='path to dataset (not needed with --synthetic)')
 parser.add_argument('-a', '--arch', metavar='ARCH', default='resnet18',
                     choices=model_names,
                     help='model architecture: ' +
@@ -69,8 +80,8 @@ parser.add_argument('--rank', default=-1, type=int,
                     help='node rank for distributed training')
 parser.add_argument('--dist-url', default='tcp://224.66.41.62:23456', type=str,
                     help='url used to set up distributed training')
-parser.add_argument('--dist-backend', default='nccl', type=str,
-                    help='distributed backend')
+parser.add_argument('--dist-backend', default=None, type=str,
+                    help='distributed backend (default: nccl with GPUs, gloo on CPU)')
 parser.add_argument('--seed', default=None, type=int,
                     help='seed for initializing training. ')
 parser.add_argument('--gpu', default=None, type=int,
@@ -91,9 +102,78 @@ parser.add_argument('--val-path', default=None, type=str,
                     help='')
 parser.add_argument('--heatmap', dest='heatmap', action='store_true',
                     help='use quantized model')    
+parser.add_argument('--results-db', default='../results.db', type=str, metavar='PATH',
+                    help='SQLite results store the heatmaps are written to (default: ../results.db)')
+parser.add_argument('--index-cache', default='~/.cache/obe', type=str, metavar='DIR',
+                    help='directory of the cached dataset file indexes (default: ~/.cache/obe)')
+parser.add_argument('--layer-profile', default='', type=str, metavar='DIR',
+                    help='time every layer, its masking hooks and the data wait during validation, '
+                         'and write a per-layer CSV and a Chrome trace per validation to DIR')
+parser.add_argument('--layer-profile-every', default=1, type=int, metavar='N',
+                    help='time only every N-th batch, cheap enough to keep on in sweeps (default: 1)')
+parser.add_argument('--telemetry', default='', type=str, metavar='PATH',
+                    help='append the hook metrics to this JSON lines file')
+parser.add_argument('--telemetry-interval', default=10.0, type=float, metavar='SEC',
+                    help='seconds between telemetry flushes (default: 10)')
+parser.add_argument('--verbosity', default=1, type=int,
+                    help='0: no telemetry, 1: --telemetry file, 2: also a line per flush (default: 1)')
+parser.add_argument('--uint8-transport', action='store_true',
+                    help='hand validation images from the loader workers as uint8 and normalize '
+                         'and erase them at the start of validate(), on the GPU when there is one')
+parser.add_argument('--erase-in-main', action='store_true',
+                    help='with --uint8-transport, also draw the random and block erase patterns in '
+                         'validate() instead of the loader workers')
+parser.add_argument('--share-heatmaps', action='store_true',
+                    help='generate full heatmaps only for representative layers of every stage '
+                         'and interpolate the others, checked with a few probe regions')
+parser.add_argument('--share-stride', default=2, type=int, metavar='K',
+                    help='first conv of every K-th bottleneck of a stage is representative (default: 2)')
+parser.add_argument('--probe-regions', default=4, type=int, metavar='P',
+                    help='regions measured to check an interpolated heatmap (default: 4)')
+parser.add_argument('--share-tolerance', default=0.5, type=float,
+                    help='mean acc@5 error of the probes above which a layer gets a full heatmap '
+                         '(default: 0.5)')
+parser.add_argument('--share-report', default='heatmap_sharing.json', type=str, metavar='PATH',
+                    help='per-layer report of --share-heatmaps (default: heatmap_sharing.json)')
+parser.add_argument('--synthetic', default=0, type=int, metavar='N',
+                    help='use N generated images instead of ImageNet and local or random weights, '
+                         'to profile and size the pipeline offline (default: 0, off)')
+parser.add_argument('--synthetic-classes', default=1000, type=int, metavar='C',
+                    help='classes of the --synthetic dataset (default: 1000)')
+parser.add_argument('--weights', default='', type=str, metavar='PATH',
+                    help='load the model weights from this state_dict instead of downloading them')
+parser.add_argument('--val-subset', default='', type=str, metavar='PATH',
+                    help='validate on the images listed in this coreset.py JSON file only')
+parser.add_argument('--snapshot', default='', type=str, metavar='PATH',
+                    help='memory-map the model weights from this snapshot, written by the first '
+                         'run that uses it')
+parser.add_argument('--fold-bn', action='store_true',
+                    help='fold the BatchNorms into the convs of a new --snapshot (evaluation only)')
+parser.add_argument('--autotune', action='store_true',
+                    help='benchmark batch size, intra-op/inter-op threads and workers on this '
+                         'host and save the best as its profile')
+parser.add_argument('--autotune-batches', default=10, type=int, metavar='N',
+                    help='timed batches per autotune trial (default: 10)')
+parser.add_argument('--profile-dir', default='~/.cache/obe', type=str, metavar='DIR',
+                    help='directory of the per-host autotune profiles (default: ~/.cache/obe)')
+parser.add_argument('--no-profile', dest='use_profile', action='store_false',
+                    help='ignore the autotune profile of this host')
+parser.add_argument('--no-bitsets', dest='bitsets', action='store_false',
+                    help='do not store per-image top-1/top-5 correctness with every result')
+parser.add_argument('--class-heatmaps', action='store_true',
+                    help='also store the top-1/top-5 accuracy of every class with every result, '
+                         'for the per-class heatmaps of --class-masks')
+parser.add_argument('--channel-groups', default=0, type=int, metavar='G',
+                    help='also generate G channel groups x 64 regions joint heatmaps (default: 0, off)')
+parser.add_argument('--joint-budget', default=64, type=int, metavar='K',
+                    help='number of (channel group, region) blocks measured per layer, '
+                         'the rest of the joint heatmap is estimated (default: 64)')
 best_acc1 = 0
 
 args = parser.parse_args()
+# Synthetic runs never mix with the real results
+if args.synthetic and args.results_db == parser.get_default('results_db'):
+    args.results_db = '../results_synthetic.db'
 
 # How many grid in a row
 GRID_width = 8
@@ -104,6 +184,23 @@ HEATMAP_COUNT = GRID_width * GRID_height
 
 idx_remove = 0
 conv_layer_count = -1
+# Channel group removed together with idx_remove, None removes all channels
+channel_group_remove = None
+
+# Results store, opened by open_results_store() in main_worker
+results_store = None
+
+# Normalization and erasing of --uint8-transport batches, set up in main_worker
+input_transform = None
+
+# Timing of --layer-profile, kept over validate() calls to number its outputs
+layer_profiler = None
+
+# Hook metrics, the hook itself never prints
+telemetry = Telemetry(args.telemetry, args.verbosity, args.telemetry_interval)
+hook_calls_metric = telemetry.counter('hook.calls')
+erase_pixel_metric = telemetry.counter('hook.erase_pixel')
+total_pixel_metric = telemetry.counter('hook.total_pixel')
 
 # We generate the layers' heatmaps by using OBE, which is to remove different 8x8 input areas 
 # and see if the accuracy drops. This is for identifying the important input areas for a layer.
@@ -116,15 +213,221 @@ def skip_computation_pre(self, input):
     # block height
     height_block = int(image_size / GRID_height)
 
-    print("conv_layer: " + str(conv_layer_count) + ", idx_remove: " + str(idx_remove))
+    channel_start, channel_end = 0, input[0].size(dim=1)
+    if channel_group_remove is not None:
+        channel_start, channel_end = channel_group_bounds(input[0].size(dim=1), args.channel_groups, channel_group_remove)
+    telemetry.inc(hook_calls_metric)
+    telemetry.inc(total_pixel_metric, input[0].size(dim=1) * image_size * image_size)
+
+    # Remove the channel group over the whole feature map
+    if idx_remove is None:
+        input[0].data[:, channel_start: channel_end] = 0
+        telemetry.inc(erase_pixel_metric, (channel_end - channel_start) * image_size * image_size)
+        return
+
     x_idx = int(idx_remove / 8)
     y_idx = int(idx_remove % 8)
     
-    input[0].data[:,:, width_block * x_idx: width_block * (x_idx + 1), height_block * y_idx: height_block * (y_idx + 1)] = 0
-    print("[%d: %d, %d: %d]" % (width_block * x_idx, width_block * (x_idx + 1), height_block * y_idx, height_block * (y_idx + 1)))
+    input[0].data[:, channel_start: channel_end, width_block * x_idx: width_block * (x_idx + 1), height_block * y_idx: height_block * (y_idx + 1)] = 0
+    telemetry.inc(erase_pixel_metric, (channel_end - channel_start) * width_block * height_block)
+
+
+def channel_group_bounds(channels, groups, group_idx):
+    # Groups are empty when a layer has fewer channels than groups (e.g. the RGB input)
+    return channels * group_idx // groups, channels * (group_idx + 1) // groups
+
+
+# Joint (channel group, region) heatmaps would need groups x 64 passes per layer.
+# Instead, the spatial and the channel group heatmaps are measured, each block's
+# accuracy drop is estimated from both, and only the joint_budget blocks with the
+# smallest estimated drop, i.e. the ones a mask would skip, are measured.
+def estimate_joint_heatmap(base_acc, spatial_acc, channel_acc):
+    spatial_drop = [max(base_acc - acc, 0.0) for acc in spatial_acc]
+    channel_drop = [max(base_acc - acc, 0.0) for acc in channel_acc]
+    spatial_total = sum(spatial_drop)
+    channel_total = sum(channel_drop)
+
+    joint = []
+    for g, c_drop in enumerate(channel_drop):
+        group_share = c_drop / channel_total if channel_total > 0 else 1.0 / len(channel_drop)
+        row = []
+        for s_drop in spatial_drop:
+            region_share = s_drop / spatial_total if spatial_total > 0 else 1.0 / len(spatial_drop)
+            row.append(base_acc - 0.5 * (s_drop * group_share + c_drop * region_share))
+        joint.append(row)
+    return joint
+
+
+def generate_joint_heatmap(conv_layer, val_loader, model, criterion, args, base_acc, spatial_acc):
+    global idx_remove, channel_group_remove
+
+    # Channel group heatmap: remove one group over the whole feature map
+    channel_acc = []
+    idx_remove = None
+    for g in range(args.channel_groups):
+        channel_group_remove = g
+        handler = conv_layer.register_forward_pre_hook(skip_computation_pre)
+        channel_acc.append(validate(val_loader, model, criterion, args))
+        handler.remove()
+
+    joint_acc = []
+    for k in range(2):
+        joint_acc.append(estimate_joint_heatmap(base_acc[k], [acc[k] for acc in spatial_acc],
+                                                [acc[k] for acc in channel_acc]))
+
+    # Measure the blocks the masks are most likely to skip
+    blocks = [(g, r) for g in range(args.channel_groups) for r in range(HEATMAP_COUNT)]
+    blocks.sort(key=lambda b: base_acc[1] - joint_acc[1][b[0]][b[1]])
+    measured = blocks[:args.joint_budget]
+    for g, r in measured:
+        channel_group_remove = g
+        idx_remove = r
+        handler = conv_layer.register_forward_pre_hook(skip_computation_pre)
+        acc = validate(val_loader, model, criterion, args)
+        handler.remove()
+        for k in range(2):
+            joint_acc[k][g][r] = acc[k]
+    channel_group_remove = None
+
+    print("conv_layer: %d, joint heatmap passes: %d (exhaustive: %d)"
+          % (conv_layer_count, args.channel_groups + len(measured), args.channel_groups * HEATMAP_COUNT))
+
+    measured = set(measured)
+    for g in range(args.channel_groups):
+        for r in range(HEATMAP_COUNT):
+            if (g, r) not in measured:
+                results_store.add(arch=args.arch, kind='heatmap_joint_estimate', layer=conv_layer_count,
+                                  region=r, channel_group=g, channel_groups=args.channel_groups,
+                                  acc1=joint_acc[0][g][r], acc5=joint_acc[1][g][r])
+    results_store.flush()
+
+
+# Stage-level heatmap sharing (--share-heatmaps). Layers of a ResNet stage
+# see the same objects at similar resolutions and their heatmaps look alike,
+# so full heatmaps are only generated for the stem conv and the first conv of
+# every --share-stride-th bottleneck (and of the last one) of each stage. The
+# heatmap of any other layer is interpolated between the representatives
+# around it in its stage and checked on --probe-regions regions; a layer whose
+# probes disagree by more than --share-tolerance gets a full heatmap too.
+# For ResNet50 with the defaults, 12 of the 53 convs are representative:
+# 12 x 64 + 41 x 4 = 932 passes instead of 3392 (3.6x) when every layer
+# passes its check.
+def conv_layer_stages(model):
+    """(stage, bottleneck, conv name) of every conv, stage and bottleneck are None for the stem"""
+    stages = []
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Conv2d):
+            continue
+        parts = name.split('.')
+        stage = [i for i, part in enumerate(parts) if re.match(r'layer\d+$', part)]
+        if stage:
+            i = stage[0]
+            stages.append((parts[i], int(parts[i + 1]), parts[-1] if parts[-2] != 'downsample' else 'downsample'))
+        else:
+            stages.append((None, None, parts[-1]))
+    if all(stage is None for stage, _, _ in stages):
+        raise ValueError("--share-heatmaps needs a ResNet, '{}' has no stages".format(args.arch))
+    return stages
+
+
+def representative_layers(stages, stride):
+    blocks = {}
+    for stage, block, _ in stages:
+        if stage is not None:
+            blocks.setdefault(stage, set()).add(block)
+    chosen = dict((stage, set(sorted(b)[::stride]) | {max(b)}) for stage, b in blocks.items())
+    return [idx for idx, (stage, block, conv) in enumerate(stages)
+            if stage is None or (conv == 'conv1' and block in chosen[stage])]
+
+
+def measure_heatmap(conv_layer, layer, regions, val_loader, model, criterion, args):
+    global idx_remove, conv_layer_count
+    conv_layer_count = layer
+    acc = {}
+    for region in regions:
+        idx_remove = region
+        handler = conv_layer.register_forward_pre_hook(skip_computation_pre)
+        acc[region] = validate(val_loader, model, criterion, args)
+        handler.remove()
+    return acc
+
+
+def generate_shared_heatmaps(conv_layer_list, val_loader, model, criterion, args):
+    stages = conv_layer_stages(model)
+    representatives = representative_layers(stages, args.share_stride)
+    heatmaps = {}
+    report = []
+    passes = 0
+    for layer in representatives:
+        heatmaps[layer] = measure_heatmap(conv_layer_list[layer], layer, range(HEATMAP_COUNT),
+                                          val_loader, model, criterion, args)
+        passes += HEATMAP_COUNT
+        report.append({'layer': layer, 'stage': stages[layer][0], 'role': 'representative',
+                       'passes': HEATMAP_COUNT})
+
+    for layer, (stage, _, _) in enumerate(stages):
+        if layer in heatmaps:
+            continue
+        # Interpolate between the representatives around the layer, in its stage
+        before = max(r for r in representatives if r < layer and stages[r][0] == stage)
+        after = [r for r in representatives if r > layer and stages[r][0] == stage]
+        t = float(layer - before) / (after[0] - before) if after else 0.0
+        upper = heatmaps[after[0]] if after else heatmaps[before]
+        shared = dict((region, tuple((1 - t) * heatmaps[before][region][k] + t * upper[region][k] for k in range(2)))
+                      for region in range(HEATMAP_COUNT))
+
+        # Probe the regions a mask skips first and the most important ones
+        ranked = sorted(range(HEATMAP_COUNT), key=lambda region: shared[region][1])
+        probes = sorted(set(ranked[len(ranked) - args.probe_regions // 2:] +
+                            ranked[:args.probe_regions - args.probe_regions // 2]))
+        measured = measure_heatmap(conv_layer_list[layer], layer, probes, val_loader, model, criterion, args)
+        error = sum(abs(measured[region][1] - shared[region][1]) for region in probes) / max(len(probes), 1)
+        entry = {'layer': layer, 'stage': stage, 'interpolated_from': [before] + after[:1],
+                 'probe_error': error, 'passes': len(probes)}
+        if error > args.share_tolerance:
+            rest = [region for region in range(HEATMAP_COUNT) if region not in measured]
+            measure_heatmap(conv_layer_list[layer], layer, rest, val_loader, model, criterion, args)
+            entry.update(role='regenerated', passes=HEATMAP_COUNT)
+        else:
+            for region in range(HEATMAP_COUNT):
+                results_store.add(arch=args.arch, kind='heatmap_shared', layer=layer, region=region,
+                                  pattern=args.pattern, acc1=shared[region][0], acc5=shared[region][1],
+                                  samples=len(val_loader.dataset))
+            entry['role'] = 'shared'
+        passes += entry['passes']
+        report.append(entry)
+    results_store.flush()
+
+    report.sort(key=lambda entry: entry['layer'])
+    failures = [entry for entry in report if entry['role'] == 'regenerated']
+    for entry in failures:
+        print("sharing failed: conv layer %d (%s), probe acc@5 error %.3f"
+              % (entry['layer'], entry['stage'], entry['probe_error']))
+    exhaustive = HEATMAP_COUNT * len(stages)
+    print("shared heatmaps: %d passes instead of %d (%.1fx), %d of %d interpolated layers regenerated"
+          % (passes, exhaustive, float(exhaustive) / passes, len(failures), len(stages) - len(representatives)))
+    with open(args.share_report, 'w') as f:
+        json.dump({'arch': args.arch, 'share_stride': args.share_stride, 'probe_regions': args.probe_regions,
+                   'share_tolerance': args.share_tolerance, 'passes': passes, 'exhaustive_passes': exhaustive,
+                   'layers': report}, f, indent=2)
 
 
 def main():
+    if not args.data and not args.synthetic:
+        parser.error('the dataset DIR is required without --synthetic')
+    if args.snapshot and args.quantize:
+        parser.error('--snapshot stores float models, not --use-quantize ones')
+    if args.fold_bn and not args.evaluate:
+        parser.error('--fold-bn folds the evaluation statistics, it needs -e')
+    if args.synthetic and args.quantize:
+        parser.error('--use-quantize needs the downloaded quantized weights, not --synthetic')
+    if args.share_heatmaps and args.channel_groups:
+        parser.error('--share-heatmaps generates spatial heatmaps only, drop --channel-groups')
+    if args.autotune:
+        autotune(args, sys.argv)
+        return
+    # Before any parallel work, so the inter-op threads of the profile apply
+    apply_profile(args, parser)
 
     # print("hidden_ratio_for_model: " + str(args.hidden_ratio_for_model))
         
@@ -147,6 +450,10 @@ def main():
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
+    # Launched by torchrun, which sets up the rendezvous in the environment
+    if "WORLD_SIZE" in os.environ and args.world_size == -1:
+        args.dist_url = "env://"
+
     if args.dist_url == "env://" and args.world_size == -1:
         args.world_size = int(os.environ["WORLD_SIZE"])
 
@@ -165,8 +472,20 @@ def main():
         main_worker(args.gpu, ngpus_per_node, args)
 
 
+# Only rank 0 writes, it creates or migrates the schema, the other ranks
+# wait for it and open the store read-only
+def open_results_store(args):
+    global results_store
+    if is_main_process(args):
+        results_store = ResultsStore(args.results_db)
+    if args.distributed:
+        dist.barrier()
+    if not is_main_process(args):
+        results_store = ResultsStore(args.results_db, read_only=True)
+
+
 def main_worker(gpu, ngpus_per_node, args):
-    global best_acc1
+    global best_acc1, input_transform
     args.gpu = gpu
 
     if args.gpu is not None:
@@ -179,13 +498,21 @@ def main_worker(gpu, ngpus_per_node, args):
             # For multiprocessing distributed training, rank needs to be the
             # global rank among all the processes
             args.rank = args.rank * ngpus_per_node + gpu
+        if args.dist_backend is None:
+            args.dist_backend = default_backend()
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
+    open_results_store(args)
     # create model
-    if args.pretrained:
+    if args.snapshot and os.path.isfile(args.snapshot):
+        print("=> mapping weight snapshot '{}'".format(args.snapshot))
+        model = load_snapshot(models, args.snapshot, args.arch)
+    elif args.synthetic or args.weights:
+        print("=> creating model '{}' offline".format(args.arch))
+        model = load_offline_model(models, args.arch, args.pretrained, args.weights)
+    elif args.pretrained:
         print("=> using pre-trained model '{}'".format(args.arch))
         if (args.quantize):
-            fake_model = models.__dict__[args.arch](pretrained=True)
             model = models.quantization.__dict__[args.arch](pretrained=True, quantize=True)
         else:
             model = models.__dict__[args.arch](pretrained=True)
@@ -193,8 +520,17 @@ def main_worker(gpu, ngpus_per_node, args):
         print("=> creating model '{}'".format(args.arch))
         model = models.__dict__[args.arch]()
 
+    if args.snapshot and not os.path.isfile(args.snapshot):
+        if args.fold_bn:
+            fold_batchnorm(model.eval())
+        if is_main_process(args):
+            save_snapshot(model, args.snapshot, args.arch, args.fold_bn)
+            print("=> weight snapshot written to '{}'".format(args.snapshot))
+
     if not torch.cuda.is_available():
         print('using CPU, this will be slow')
+        if args.distributed and not args.evaluate:
+            model = torch.nn.parallel.DistributedDataParallel(model)
     elif args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
@@ -227,12 +563,9 @@ def main_worker(gpu, ngpus_per_node, args):
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda(args.gpu)
     
-    # we have to fake optimizer, we don't need to train
-    if args.quantize:
-        optimizer = torch.optim.SGD(fake_model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
-    else:
+    # Evaluation and quantized models (which have no float parameters) need no optimizer
+    optimizer = None
+    if not args.evaluate and not args.quantize:
         optimizer = torch.optim.SGD(model.parameters(), args.lr,
                                 momentum=args.momentum,
                                 weight_decay=args.weight_decay)
@@ -253,7 +586,8 @@ def main_worker(gpu, ngpus_per_node, args):
                 # best_acc1 may be from a checkpoint from a different GPU
                 best_acc1 = best_acc1.to(args.gpu)
             model.load_state_dict(checkpoint['state_dict'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
+            if optimizer is not None:
+                optimizer.load_state_dict(checkpoint['optimizer'])
             print("=> loaded checkpoint '{}' (epoch {})"
                   .format(args.resume, checkpoint['epoch']))
         else:
@@ -265,35 +599,60 @@ def main_worker(gpu, ngpus_per_node, args):
         run_time = GRID_width * GRID_height
     else:
         run_time = 1
-    for i in range(run_time):
-        # Data loading code
-        traindir = os.path.join(args.data, 'train')
-        if args.val_path:
-            print("Validation dataset path specified: " + args.val_path)
-            valdir = args.val_path
+    # Data loading code
+    traindir = os.path.join(args.data, 'train')
+    if args.val_path:
+        print("Validation dataset path specified: " + args.val_path)
+        valdir = args.val_path
+    else:
+        valdir = os.path.join(args.data, 'val')
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                    std=[0.229, 0.224, 0.225])
+
+    # The training set is only listed when training actually runs
+    train_sampler = None
+    train_loader = None
+    if not args.evaluate:
+        train_transforms = transforms.Compose([
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            normalize,
+        ])
+        if args.synthetic:
+            train_dataset = SyntheticImageNet(args.synthetic, args.synthetic_classes, seed=1,
+                                              transform=train_transforms)
         else:
-            valdir = os.path.join(args.data, 'val')
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                        std=[0.229, 0.224, 0.225])
-
-        train_dataset = datasets.ImageFolder(
-            traindir,
-            transforms.Compose([
-                transforms.RandomResizedCrop(224),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ]))
+            train_dataset = CachedImageFolder(traindir, train_transforms, cache_dir=args.index_cache)
 
         if args.distributed:
             train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
-        else:
-            train_sampler = None
 
         train_loader = torch.utils.data.DataLoader(
             train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
             num_workers=args.workers, pin_memory=True, sampler=train_sampler)
 
+    # The validation file index is read once, every run only swaps the transforms
+    if args.synthetic:
+        val_dataset = SyntheticImageNet(args.synthetic, args.synthetic_classes)
+        valdir = val_dataset.key()
+    else:
+        val_dataset = CachedImageFolder(valdir, cache_dir=args.index_cache)
+        valdir = os.path.abspath(valdir)
+    # A --val-subset coreset keeps its labels under its own dataset name
+    val_subset = val_dataset
+    if args.val_subset:
+        with open(args.val_subset) as f:
+            indices = json.load(f)['indices']
+        val_subset = torch.utils.data.Subset(val_dataset, indices)
+        val_subset.targets = [val_dataset.targets[i] for i in indices]
+        valdir = '%s#%s' % (valdir, os.path.basename(args.val_subset))
+        print("=> validating on the {} images of '{}'".format(len(indices), args.val_subset))
+    # Autotune trials are thrown away, they write nothing to the results store
+    if args.bitsets and trial_config() is None:
+        results_store.save_labels(valdir, val_subset.targets)
+
+    for i in range(run_time):
         transforms_list = [
             transforms.Resize(256),
             transforms.CenterCrop(224),
@@ -324,11 +683,22 @@ def main_worker(gpu, ngpus_per_node, args):
                 transforms_list.append(MyEraseJPEGTransform(224, args.hidden_ratio, 0))
 
 
+        input_transform = None
+        if args.uint8_transport:
+            # Workers stop at uint8 (plus the mask of the random erase patterns),
+            # normalization and the other erase patterns run in validate()
+            worker_transforms, input_transform = MyUint8Normalize.split(
+                normalize.mean, normalize.std, transforms_list[4:], args.erase_in_main)
+            transforms_list = transforms_list[:2] + [transforms.PILToTensor()] + worker_transforms
+
         val_transforms = transforms.Compose(transforms_list)
 
+        val_dataset.transform = val_transforms
+
         val_loader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(valdir, val_transforms),
+            val_subset,
             batch_size=args.batch_size, shuffle=False,
+            sampler=ShardSampler(val_subset, args.rank, args.world_size) if args.distributed else None,
             num_workers=args.workers, pin_memory=True)
 
         # We generates the heatmaps from here
@@ -339,18 +709,35 @@ def main_worker(gpu, ngpus_per_node, args):
                 if isinstance(layer, nn.Conv2d):
                     conv_layer_list.append(layer)
             print(len(conv_layer_list))
+            global idx_remove
+            if trial_config() is not None:
+                # Autotune trial: time the model with one region of the first layer removed
+                idx_remove = 0
+                conv_layer_list[0].register_forward_pre_hook(skip_computation_pre)
+                report(benchmark(val_loader, model, args, args.autotune_batches, input_transform))
+                return
+            if args.evaluate and (args.channel_groups or args.bitsets):
+                # Accuracy without any removal, the reference for the joint heatmaps
+                # and the per-image correctness
+                idx_remove = None
+                base_acc = validate(val_loader, model, criterion, args)
+            if args.evaluate and args.share_heatmaps:
+                generate_shared_heatmaps(conv_layer_list, val_loader, model, criterion, args)
+                return
             for conv_layer in conv_layer_list:
                 global conv_layer_count
                 conv_layer_count += 1 
+                spatial_acc = []
                 for i in range(HEATMAP_COUNT):
-                    global idx_remove
                     idx_remove = i
                     if args.evaluate:
                         handler = conv_layer.register_forward_pre_hook(skip_computation_pre)
-                        validate(val_loader, model, criterion, args)
+                        spatial_acc.append(validate(val_loader, model, criterion, args))
                         handler.remove()
                         # return
                         # continue
+                if args.evaluate and args.channel_groups:
+                    generate_joint_heatmap(conv_layer, val_loader, model, criterion, args, base_acc, spatial_acc)
 
 def train(train_loader, model, criterion, optimizer, epoch, args):
     batch_time = AverageMeter('Time', ':6.3f')
@@ -412,13 +799,27 @@ def validate(val_loader, model, criterion, args):
     # switch to evaluate mode
     model.eval()
 
+    global layer_profiler
+    if args.layer_profile:
+        # Attached last, so its inner pre-hooks run after the masking hooks
+        if layer_profiler is None:
+            layer_profiler = LayerProfiler(every=args.layer_profile_every)
+        layer_profiler.attach(model)
+
     with torch.no_grad():
-        end = time.time()
+        start = end = time.time()
+        correct1, correct5 = [], []
+        # Top-1 hits, top-5 hits and images per class, kept on the device
+        class_counts = None
         for i, (images, target) in enumerate(val_loader):
+            if layer_profiler is not None:
+                layer_profiler.begin_batch(i)
             if args.gpu is not None:
                 images = images.cuda(args.gpu, non_blocking=True)
             if torch.cuda.is_available():
                 target = target.cuda(args.gpu, non_blocking=True)
+            if input_transform is not None:
+                images = input_transform(images)
 
             # compute output
             output = model(images)
@@ -429,6 +830,17 @@ def validate(val_loader, model, criterion, args):
             losses.update(loss.item(), images.size(0))
             top1.update(acc1[0], images.size(0))
             top5.update(acc5[0], images.size(0))
+            c1, c5 = correct_per_sample(output, target, topk=(1, 5))
+            correct1.append(c1.cpu())
+            correct5.append(c5.cpu())
+            if args.class_heatmaps:
+                counts = torch.stack([torch.bincount(target, weights=w, minlength=output.size(1))
+                                      for w in (c1.double(), c5.double(), torch.ones_like(c1, dtype=torch.double))])
+                class_counts = counts if class_counts is None else class_counts + counts
+
+            if layer_profiler is not None:
+                layer_profiler.end_batch()
+            telemetry.tick()
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -437,22 +849,50 @@ def validate(val_loader, model, criterion, args):
             if i % args.print_freq == 0:
                 progress.display(i)
 
+        empty = [torch.zeros(0, dtype=torch.bool)]
+        correct1 = torch.cat(correct1 or empty).numpy()
+        correct5 = torch.cat(correct5 or empty).numpy()
+        # Exact correct counts over all ranks, not an average of their percentages
+        hits1, hits5, samples = reduce_sum([int(correct1.sum()), int(correct5.sum()), len(correct1)], args)
+        acc1_avg = 100.0 * hits1 / max(samples, 1)
+        acc5_avg = 100.0 * hits5 / max(samples, 1)
+
+        bitsets = {}
+        if args.bitsets:
+            bitsets = dict(top1_bits=pack_bits(gather_in_rank_order(correct1, args)),
+                           top5_bits=pack_bits(gather_in_rank_order(correct5, args)))
+
+        class_acc = {}
+        if class_counts is not None:
+            counts = torch.tensor(reduce_sum(class_counts.long().flatten().tolist(), args)).view(3, -1).double()
+            accs = torch.where(counts[2] > 0, 100.0 * counts[:2] / counts[2].clamp(min=1),
+                               torch.full_like(counts[:2], float('nan')))
+            class_acc = dict(class_acc1=pack_floats(accs[0].numpy()), class_acc5=pack_floats(accs[1].numpy()))
+
         # TODO: this should also be done with the ProgressMeter
-        print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
-              .format(top1=top1, top5=top5))
+        print(' * Acc@1 {:.3f} Acc@5 {:.3f}'.format(acc1_avg, acc5_avg))
+
+        if layer_profiler is not None:
+            if is_main_process(args):
+                layer_profiler.write(args.layer_profile)
+                print(' * Layer profile ' + json.dumps(layer_profiler.summary()))
+            layer_profiler.detach()
             
-        with open('results@1_cnvlayer' + str(conv_layer_count) + '.txt', 'a') as f:
-            f.write("{:.5f}".format(top1.avg.item()) + ",")
-            if ((idx_remove + 1) % 8 == 0):
-                f.write("\n")
-        with open('results@5_cnvlayer' + str(conv_layer_count) + '.txt', 'a') as f:
-            f.write("{:.5f}".format(top5.avg.item()) + ",")
-            if ((idx_remove + 1) % 8 == 0):
-                f.write("\n")
+        telemetry.flush(event='validate', conv_layer=conv_layer_count, idx_remove=idx_remove,
+                        channel_group=channel_group_remove, acc1=acc1_avg, acc5=acc5_avg, samples=samples)
 
-            # f.write(str(args.delete_blocks) + ", " + str(top1.avg) + ", " + str(top5.avg) + "\n")
+        if idx_remove is None:
+            kind = 'baseline' if channel_group_remove is None else 'heatmap_channel'
+        else:
+            kind = 'heatmap' if channel_group_remove is None else 'heatmap_joint'
+        results_store.add(arch=args.arch, kind=kind,
+                          layer=None if kind == 'baseline' else conv_layer_count,
+                          region=idx_remove, channel_group=channel_group_remove,
+                          channel_groups=args.channel_groups if channel_group_remove is not None else None,
+                          pattern=args.pattern, acc1=acc1_avg, acc5=acc5_avg,
+                          samples=samples, wall_time=time.time() - start, **dict(bitsets, **class_acc))
 
-    return top1.avg
+    return acc1_avg, acc5_avg
 
 
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
@@ -526,5 +966,13 @@ def accuracy(output, target, topk=(1,)):
         return res
 
 
+def correct_per_sample(output, target, topk=(1,)):
+    """Computes for every sample whether it is in the top k predictions, for the specified values of k"""
+    with torch.no_grad():
+        _, pred = output.topk(max(topk), 1, True, True)
+        correct = pred.eq(target.view(-1, 1))
+        return [correct[:, :k].any(dim=1) for k in topk]
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -10,4 +10,6 @@
 
 
 #For multiple Heatmap
-python3 heatmap_generate_imagenet.py -a resnet50  -j 32 -b 2048 -e --pretrained ~/imagenet18/data/imagenet/
\ No newline at end of file
+python3 heatmap_generate_imagenet.py -a resnet50  -j 32 -b 2048 -e --pretrained ~/imagenet18/data/imagenet/
+# # Distributed CPU heatmap generation (gloo), one process per socket/host slice
+# torchrun --nproc_per_node 4 heatmap_generate_imagenet.py -a resnet50  -j 8 -b 256 -e --pretrained ~/imagenet18/data/imagenet/
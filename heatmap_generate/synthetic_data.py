@@ -0,0 +1,69 @@
+import glob
+import os
+
+import torch
+import torch.utils.data
+import torchvision.transforms.functional as TF
+
+# Offline stand-ins for ImageNet and the downloaded weights (--synthetic), so
+# the whole heatmap generation to zero-out flow runs on an isolated box. The
+# numbers only size and profile runs, they say nothing about accuracy.
+
+SYNTHETIC_IMAGE_SIZE = 256
+
+
+class SyntheticImageNet(torch.utils.data.Dataset):
+    """Deterministic generated images: noise with a class-colored square at a
+    class-dependent position. Image `i` is the same in every process and run,
+    and yields a PIL image, so the usual transforms apply."""
+
+    def __init__(self, size, num_classes=1000, seed=0, transform=None):
+        self.size = size
+        self.num_classes = num_classes
+        self.seed = seed
+        self.transform = transform
+        self.targets = [i % num_classes for i in range(size)]
+        self.classes = [str(c) for c in range(num_classes)]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        target = self.targets[index]
+        generator = torch.Generator().manual_seed(self.seed * 1000003 + index)
+        image = torch.randint(0, 256, (3, SYNTHETIC_IMAGE_SIZE, SYNTHETIC_IMAGE_SIZE),
+                              generator=generator, dtype=torch.uint8)
+        class_generator = torch.Generator().manual_seed(target)
+        color = torch.randint(0, 256, (3, 1, 1), generator=class_generator, dtype=torch.uint8)
+        side = SYNTHETIC_IMAGE_SIZE // 3
+        top, left = torch.randint(0, SYNTHETIC_IMAGE_SIZE - side, (2,), generator=class_generator).tolist()
+        image[:, top: top + side, left: left + side] = color
+        image = TF.to_pil_image(image)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, target
+
+    def key(self):
+        """Dataset name of the labels in the results store"""
+        return 'synthetic:%d:%d:%d' % (self.size, self.num_classes, self.seed)
+
+
+def cached_weights(arch):
+    """Path of the torchvision weights of `arch` in the torch hub cache, None when not downloaded"""
+    paths = sorted(glob.glob(os.path.join(torch.hub.get_dir(), 'checkpoints', '%s-*.pth' % arch)))
+    return paths[-1] if paths else None
+
+
+def load_offline_model(models, arch, pretrained, weights=''):
+    """Build `arch` without the network: --weights, else the hub cache when
+    --pretrained, else random initialization"""
+    # Same random weights in every process
+    torch.manual_seed(0)
+    model = models.__dict__[arch]()
+    path = weights or (cached_weights(arch) if pretrained else None)
+    if path:
+        print("=> loading local weights '{}'".format(path))
+        model.load_state_dict(torch.load(path, map_location='cpu'))
+    elif pretrained:
+        print("=> no cached weights for '{}', using random initialization".format(arch))
+    return model
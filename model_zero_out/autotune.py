@@ -0,0 +1,138 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import torch
+
+# Thread and batch size autotuner for CPU evaluation.
+#
+# --autotune re-runs the script once per candidate configuration, because the
+# inter-op thread count can only be set before any parallel work in a process.
+# Every trial times a few batches of the masked model and reports images/s.
+# The search is a coordinate descent over workers, batch size, intra-op threads
+# and inter-op threads, and the best configuration is saved to a per-host
+# profile that later runs load automatically.
+
+TRIAL_ENV = 'OBE_AUTOTUNE_TRIAL'
+RESULT_PREFIX = 'AUTOTUNE_RESULT '
+
+
+def profile_path(profile_dir):
+    return os.path.join(os.path.expanduser(profile_dir), 'autotune_%s.json' % socket.gethostname())
+
+
+def trial_config():
+    """Configuration of the running trial, None outside of --autotune trials"""
+    config = os.environ.get(TRIAL_ENV)
+    return json.loads(config) if config else None
+
+
+def set_threads(config):
+    if config.get('interop_threads'):
+        torch.set_num_interop_threads(config['interop_threads'])
+    if config.get('intra_threads'):
+        torch.set_num_threads(config['intra_threads'])
+
+
+def apply_profile(args, parser):
+    """Use the host profile for what the command line left at its default.
+
+    Trials run their configuration under test instead. Has to run before any
+    parallel work for the inter-op threads to apply.
+    """
+    config = trial_config()
+    if config is not None:
+        args.batch_size = config['batch_size']
+        args.workers = config['workers']
+        set_threads(config)
+        return
+
+    path = profile_path(args.profile_dir)
+    if not args.use_profile or not os.path.isfile(path):
+        return
+    with open(path) as f:
+        config = json.load(f)
+    print("=> using autotune profile '{}': {}".format(path, config))
+    set_threads(config)
+    if args.batch_size == parser.get_default('batch_size'):
+        args.batch_size = config['batch_size']
+    if args.workers == parser.get_default('workers'):
+        args.workers = config['workers']
+
+
+def benchmark(val_loader, model, args, batches, input_transform=None):
+    """images/s of the model over `batches` batches after one warm-up batch, data loading included"""
+    model.eval()
+    images_seen = 0
+    start = None
+    with torch.no_grad():
+        for i, (images, target) in enumerate(val_loader):
+            if args.gpu is not None:
+                images = images.cuda(args.gpu, non_blocking=True)
+            if input_transform is not None:
+                images = input_transform(images)
+            model(images)
+            if i == 0:
+                start = time.time()
+                continue
+            images_seen += images.size(0)
+            if i == batches:
+                break
+    if start is None:
+        return 0.0
+    elapsed = time.time() - start
+    return images_seen / elapsed if elapsed > 0 else 0.0
+
+
+def report(throughput):
+    print(RESULT_PREFIX + json.dumps({'images_per_sec': throughput}))
+    sys.stdout.flush()
+
+
+def run_trial(argv, config, timeout):
+    env = dict(os.environ)
+    env[TRIAL_ENV] = json.dumps(config)
+    try:
+        output = subprocess.run([sys.executable] + argv, env=env, stdout=subprocess.PIPE,
+                                timeout=timeout, universal_newlines=True).stdout
+    except subprocess.TimeoutExpired:
+        return 0.0
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])['images_per_sec']
+    return 0.0
+
+
+def autotune(args, argv, timeout=600):
+    """Search the best configuration of this host and save it as its profile"""
+    cores = os.cpu_count() or 1
+    argv = [a for a in argv if a != '--autotune']
+    space = [
+        ('workers', sorted(set([max(cores // 8, 1), max(cores // 4, 1), max(cores // 2, 1)]))),
+        ('batch_size', [64, 128, 256, 512]),
+        ('intra_threads', sorted(set([max(cores // 4, 1), max(cores // 2, 1), cores]))),
+        ('interop_threads', [1, 2, 4]),
+    ]
+    best = {'workers': max(cores // 4, 1), 'batch_size': 256,
+            'intra_threads': max(cores // 2, 1), 'interop_threads': 1}
+    results = {}
+    for name, values in space:
+        for value in values:
+            config = dict(best, **{name: value})
+            key = json.dumps(config, sort_keys=True)
+            if key not in results:
+                results[key] = run_trial(argv, config, timeout)
+                print("autotune: %s -> %.1f images/s" % (key, results[key]))
+        best = max((json.loads(key) for key in results), key=lambda c: results[json.dumps(c, sort_keys=True)])
+
+    best['images_per_sec'] = results[json.dumps(best, sort_keys=True)]
+    path = profile_path(args.profile_dir)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump(best, f, indent=2)
+    print("=> autotune profile written to '{}': {}".format(path, best))
+    return best
@@ -0,0 +1,112 @@
+import argparse
+import os
+
+import numpy as np
+
+from results_store import ResultsStore
+
+# Answer questions about mask configurations from the stored per-image
+# correctness instead of new validation passes:
+#
+#   python3 bitset_analysis.py --kind multi_layer --layer 40 --ratio 0.5 --val DIR/val
+#   python3 bitset_analysis.py --kind single_layer --layer 3 --ratio 0.25 --with-layer 10
+
+parser = argparse.ArgumentParser(description='Per-image correctness analysis')
+parser.add_argument('-a', '--arch', default='resnet50', type=str,
+                    help='model architecture (default: resnet50)')
+parser.add_argument('--results-db', default='../results.db', type=str, metavar='PATH',
+                    help='results store (default: ../results.db)')
+parser.add_argument('--kind', default='multi_layer', type=str,
+                    help='result kind of the configuration (default: multi_layer)')
+parser.add_argument('--layer', default=None, type=int, help='layer of the configuration')
+parser.add_argument('--region', default=None, type=int, help='region of the configuration')
+parser.add_argument('--ratio', default=None, type=float, help='hidden ratio of the configuration')
+parser.add_argument('--with-layer', default=None, type=int,
+                    help='estimate the accuracy of combining the configuration with the '
+                         'same kind and ratio on this layer')
+parser.add_argument('--hard-fraction', default=0.5, type=float,
+                    help='images wrong in at least this share of all stored configurations '
+                         'form the hard subset (default: 0.5)')
+parser.add_argument('--val', default=None, type=str,
+                    help='validation directory the labels were stored for, for per-class drops '
+                         '(synthetic:N:C:SEED for --synthetic runs)')
+parser.add_argument('--top-classes', default=10, type=int,
+                    help='number of classes with the largest drop to print (default: 10)')
+
+
+def accuracy(correct, subset=None):
+    if subset is not None:
+        correct = correct[subset]
+    return 100.0 * correct.mean() if len(correct) else float('nan')
+
+
+def per_class_accuracy(correct, labels, num_classes=None):
+    num_classes = num_classes or int(labels.max()) + 1
+    totals = np.bincount(labels, minlength=num_classes)
+    hits = np.bincount(labels, weights=correct, minlength=num_classes)
+    return 100.0 * hits / np.maximum(totals, 1)
+
+
+def hard_subset(configurations, fraction):
+    """Images misclassified by at least `fraction` of the configurations"""
+    wrong = np.mean([~c for c in configurations], axis=0)
+    return wrong >= fraction
+
+
+def overlap(correct_a, correct_b, baseline):
+    """Combined top-1 estimate: an image survives two masks only if it survives each one"""
+    lost_a = baseline & ~correct_a
+    lost_b = baseline & ~correct_b
+    both = np.count_nonzero(lost_a & lost_b)
+    union = np.count_nonzero(lost_a | lost_b)
+    return accuracy(baseline & ~(lost_a | lost_b)), both / float(max(union, 1))
+
+
+def find_one(store, args, layer):
+    config = dict(layer=layer)
+    if args.region is not None:
+        config['region'] = args.region
+    if args.ratio is not None:
+        config['ratio'] = args.ratio
+    rows = store.load_bitsets(args.arch, args.kind, **config)
+    if not rows:
+        raise SystemExit("no stored per-image results for %s %s" % (args.kind, config))
+    # Latest measurement of the configuration
+    return rows[-1]
+
+
+def main():
+    args = parser.parse_args()
+    store = ResultsStore(args.results_db)
+    baselines = store.load_bitsets(args.arch, 'baseline')
+    if not baselines:
+        raise SystemExit("no baseline with per-image results in " + args.results_db)
+    baseline = baselines[-1]
+    config = find_one(store, args, args.layer)
+    print("baseline: acc@1 %.3f acc@5 %.3f, configuration: acc@1 %.3f acc@5 %.3f"
+          % (accuracy(baseline['top1']), accuracy(baseline['top5']),
+             accuracy(config['top1']), accuracy(config['top5'])))
+
+    configurations = [row['top1'] for row in store.load_bitsets(args.arch, args.kind)]
+    hard = hard_subset(configurations, args.hard_fraction)
+    print("hard subset (%d images, wrong in >= %.0f%% of %d configurations): baseline %.3f, configuration %.3f"
+          % (np.count_nonzero(hard), 100 * args.hard_fraction, len(configurations),
+             accuracy(baseline['top1'], hard), accuracy(config['top1'], hard)))
+
+    if args.val:
+        dataset = args.val if args.val.startswith('synthetic:') else os.path.abspath(args.val)
+        labels = store.load_labels(dataset).astype(np.int64)
+        drop = per_class_accuracy(baseline['top1'], labels) - per_class_accuracy(config['top1'], labels)
+        print("classes with the largest acc@1 drop:")
+        for c in np.argsort(-drop)[:args.top_classes]:
+            print("  class %4d: %.2f" % (c, drop[c]))
+
+    if args.with_layer is not None:
+        other = find_one(store, args, args.with_layer)
+        combined, shared = overlap(config['top1'], other['top1'], baseline['top1'])
+        print("layer %d: acc@1 %.3f, estimated combined acc@1 %.3f, shared losses %.1f%%"
+              % (args.with_layer, accuracy(other['top1']), combined, 100 * shared))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+
+import numpy as np
+
+from results_store import ResultsStore
+
+# Representative validation coreset for exploratory sweeps.
+#
+#   python3 erase_experiment_imagenet.py -a resnet50 -e --pretrained --save-margins margins.npz DIR
+#   python3 coreset.py --margins margins.npz --size 5000 --output coreset.json
+#   python3 erase_experiment_imagenet.py ... --val-subset coreset.json DIR
+#
+# The coreset is balanced over the classes and, within a class, over
+# confidence strata (quantiles of the baseline margin over the whole set), so
+# easy and borderline images keep their share. The report checks on the
+# stored per-image results how well accuracy deltas measured on the coreset
+# track the full set deltas.
+
+parser = argparse.ArgumentParser(description='Stratified validation coreset')
+parser.add_argument('--margins', required=True, type=str, metavar='PATH',
+                    help='baseline margins saved with --save-margins')
+parser.add_argument('--size', default=5000, type=int, help='images in the coreset (default: 5000)')
+parser.add_argument('--strata', default=4, type=int,
+                    help='confidence strata per class (default: 4)')
+parser.add_argument('--seed', default=0, type=int, help='seed of the sampling within a stratum')
+parser.add_argument('--output', default='coreset.json', type=str, metavar='PATH',
+                    help='coreset file for --val-subset (default: coreset.json)')
+parser.add_argument('-a', '--arch', default='resnet50', type=str,
+                    help='model architecture of the stored results (default: resnet50)')
+parser.add_argument('--results-db', default='../results.db', type=str, metavar='PATH',
+                    help='results store (default: ../results.db)')
+parser.add_argument('--kinds', default='heatmap,single_layer,multi_layer', type=str,
+                    help='comma separated result kinds to check the coreset on')
+
+
+def allocate(counts, total):
+    """Split `total` over groups proportionally to `counts`, largest remainders first, never above a count"""
+    counts = np.asarray(counts, dtype=np.int64)
+    total = min(total, int(counts.sum()))
+    if total == 0:
+        return np.zeros_like(counts)
+    exact = counts * float(total) / counts.sum()
+    quota = np.minimum(np.floor(exact).astype(np.int64), counts)
+    for i in np.argsort(-(exact - quota), kind='stable'):
+        if quota.sum() >= total:
+            break
+        if quota[i] < counts[i]:
+            quota[i] += 1
+    return quota
+
+
+def stratified_coreset(targets, margin, size, strata, rng):
+    edges = np.quantile(margin, np.linspace(0, 1, strata + 1)[1:-1])
+    stratum = np.searchsorted(edges, margin, side='right')
+    classes = np.unique(targets)
+    class_members = [np.nonzero(targets == c)[0] for c in classes]
+    # Equal share per class, as far as the classes have the images
+    class_quota = allocate([min(len(m), size) for m in class_members], size)
+
+    selected = []
+    for members, quota in zip(class_members, class_quota):
+        groups = [members[stratum[members] == s] for s in range(strata)]
+        for group, count in zip(groups, allocate([len(g) for g in groups], quota)):
+            selected.append(rng.choice(group, size=count, replace=False))
+    return np.sort(np.concatenate(selected)) if selected else np.zeros(0, dtype=np.int64)
+
+
+def _ranks(values):
+    return np.argsort(np.argsort(values)).astype(np.float64)
+
+
+def _correlation(a, b):
+    if len(a) < 2 or np.std(a) == 0 or np.std(b) == 0:
+        return float('nan')
+    return float(np.corrcoef(a, b)[0, 1])
+
+
+def correlation_report(store, arch, kinds, indices, samples):
+    """Pearson and Spearman correlation of full set and coreset accuracy deltas per result kind"""
+    baselines = [row for row in store.load_bitsets(arch, 'baseline') if row['samples'] == samples]
+    if not baselines:
+        print("no stored full set baseline with per-image results, skipping the correlation report")
+        return {}
+    baseline = baselines[-1]
+    report = {}
+    for kind in kinds:
+        rows = [row for row in store.load_bitsets(arch, kind) if row['samples'] == samples]
+        if len(rows) < 2:
+            continue
+        report[kind] = {'configurations': len(rows)}
+        for metric in ('top1', 'top5'):
+            full = np.array([100.0 * (row[metric].mean() - baseline[metric].mean()) for row in rows])
+            core = np.array([100.0 * (row[metric][indices].mean() - baseline[metric][indices].mean())
+                             for row in rows])
+            # Do the configurations a sweep would pick, the smallest drops, stay the same?
+            top = max(len(rows) // 10, 1)
+            agreement = len(set(np.argsort(-full)[:top]) & set(np.argsort(-core)[:top])) / float(top)
+            report[kind][metric] = {'pearson': _correlation(full, core),
+                                    'spearman': _correlation(_ranks(full), _ranks(core)),
+                                    'mean_abs_error': float(np.abs(full - core).mean()),
+                                    'top10pct_agreement': agreement}
+            print("%-12s %s (%d configurations): pearson %.3f, spearman %.3f, mean abs delta error %.3f, "
+                  "top 10%% agreement %.2f" % (kind, metric, len(rows), report[kind][metric]['pearson'],
+                                               report[kind][metric]['spearman'],
+                                               report[kind][metric]['mean_abs_error'], agreement))
+    return report
+
+
+def main():
+    args = parser.parse_args()
+    data = np.load(args.margins)
+    targets, margin = data['targets'], data['margin']
+    rng = np.random.RandomState(args.seed)
+    indices = stratified_coreset(targets, margin, args.size, args.strata, rng)
+    print("coreset: %d of %d images, %d classes, %d confidence strata"
+          % (len(indices), len(targets), len(np.unique(targets[indices])), args.strata))
+
+    store = ResultsStore(args.results_db)
+    report = correlation_report(store, args.arch, args.kinds.split(','), indices, len(targets))
+    with open(args.output, 'w') as f:
+        json.dump({'dataset': str(data['dataset']), 'margins': args.margins, 'size': len(indices),
+                   'strata': args.strata, 'seed': args.seed, 'report': report,
+                   'indices': indices.tolist()}, f)
+    print("=> coreset written to '{}'".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
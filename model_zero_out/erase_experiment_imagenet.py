@@ -4,10 +4,17 @@ import random
 import shutil
 import time
 import warnings
+import sys
 import math 
+import json
+import socketserver
+import io
+
+import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
@@ -18,18 +25,34 @@ import torch.utils.data.distributed
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
+from torchvision.models.resnet import BasicBlock, Bottleneck
 
 from torchvision.utils import save_image
-
-from preprocess import MyEraseTransform, MyEraseCircleTransform, MyRandomErasePixelTransform, MyEraseEvenTransform, MyEraseJPEGTransform
+from PIL import Image
+
+from preprocess import MyEraseTransform, MyEraseCircleTransform, MyRandomErasePixelTransform, MyEraseEvenTransform, MyEraseJPEGTransform, MyUint8Normalize
+from results_store import ResultsStore, pack_bits
+from dataset_index import CachedImageFolder
+from synthetic_data import SyntheticImageNet, load_offline_model
+from weight_snapshot import fold_batchnorm, load_snapshot, save_snapshot
+from autotune import apply_profile, autotune, benchmark, report, trial_config
+from layer_profiler import LayerProfiler
+from telemetry import Telemetry
+from slo_controller import LatencyController, parse_ladder
+from microbatch import MicroBatcher, make_server
+from distributed_eval import ShardSampler, default_backend, gather_in_rank_order, is_main_process, reduce_sum
+from masks import (DEFAULT_TILE_SIZES, BlockSkipper, ClassGuesser, CroppedConv, SaliencyPredictor,
+                   class_region_budgets, compile_tile_mask, conv_input_shapes, conv_macs, first_stage_features,
+                   kept_box, parse_tile_sizes, tile_for, zero_class_regions, zero_dynamic_regions,
+                   zero_heatmap_regions, zero_joint_blocks)
 
 model_names = sorted(name for name in models.__dict__
     if name.islower() and not name.startswith("__")
     and callable(models.__dict__[name]))
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
-parser.add_argument('data', metavar='DIR',
-                    help='path to dataset')
+parser.add_argument('data', metavar='DIR', nargs='?', default='',
+                    help='path to dataset (not needed with --synthetic)')
 parser.add_argument('-a', '--arch', metavar='ARCH', default='resnet18',
                     choices=model_names,
                     help='model architecture: ' +
@@ -69,8 +92,8 @@ parser.add_argument('--rank', default=-1, type=int,
                     help='node rank for distributed training')
 parser.add_argument('--dist-url', default='tcp://224.66.41.62:23456', type=str,
                     help='url used to set up distributed training')
-parser.add_argument('--dist-backend', default='nccl', type=str,
-                    help='distributed backend')
+parser.add_argument('--dist-backend', default=None, type=str,
+                    help='distributed backend (default: nccl with GPUs, gloo on CPU)')
 parser.add_argument('--seed', default=None, type=int,
                     help='seed for initializing training. ')
 parser.add_argument('--gpu', default=None, type=int,
@@ -93,20 +116,182 @@ parser.add_argument('--heatmap', dest='heatmap', action='store_true',
                     help='use quantized model')    
 parser.add_argument('--hidden-ratio-for-model', default=0, type=float,
                     help='')
+parser.add_argument('--dynamic-mask', dest='dynamic_mask', action='store_true',
+                    help='zero out per-image regions ranked by a saliency predictor '
+                         'on the first stage features instead of the static heatmap')
+parser.add_argument('--saliency-weights', default='', type=str, metavar='PATH',
+                    help='trained weights for the saliency predictor (default: channel mean)')
+parser.add_argument('--results-db', default='../results.db', type=str, metavar='PATH',
+                    help='SQLite results store shared with the heatmap generator '
+                         '(default: ../results.db)')
+parser.add_argument('--ratio-schedule', default='', type=str, metavar='PATH',
+                    help='per-layer hidden ratios from ratio_optimizer.py, validated '
+                         'once with every layer hooked')
+parser.add_argument('--index-cache', default='~/.cache/obe', type=str, metavar='DIR',
+                    help='directory of the cached dataset file indexes (default: ~/.cache/obe)')
+parser.add_argument('--layer-profile', default='', type=str, metavar='DIR',
+                    help='time every layer, its masking hooks and the data wait during validation, '
+                         'and write a per-layer CSV and a Chrome trace per validation to DIR')
+parser.add_argument('--layer-profile-every', default=1, type=int, metavar='N',
+                    help='time only every N-th batch, cheap enough to keep on in sweeps (default: 1)')
+parser.add_argument('--telemetry', default='', type=str, metavar='PATH',
+                    help='append the hook metrics to this JSON lines file')
+parser.add_argument('--telemetry-interval', default=10.0, type=float, metavar='SEC',
+                    help='seconds between telemetry flushes (default: 10)')
+parser.add_argument('--verbosity', default=1, type=int,
+                    help='0: no telemetry, 1: --telemetry file, 2: also a line per flush (default: 1)')
+parser.add_argument('--uint8-transport', action='store_true',
+                    help='hand validation images from the loader workers as uint8 and normalize '
+                         'and erase them at the start of validate(), on the GPU when there is one')
+parser.add_argument('--erase-in-main', action='store_true',
+                    help='with --uint8-transport, also draw the random and block erase patterns in '
+                         'validate() instead of the loader workers')
+parser.add_argument('--synthetic', default=0, type=int, metavar='N',
+                    help='use N generated images instead of ImageNet and local or random weights, '
+                         'to profile and size the pipeline offline (default: 0, off)')
+parser.add_argument('--synthetic-classes', default=1000, type=int, metavar='C',
+                    help='classes of the --synthetic dataset (default: 1000)')
+parser.add_argument('--weights', default='', type=str, metavar='PATH',
+                    help='load the model weights from this state_dict instead of downloading them')
+parser.add_argument('--save-margins', default='', type=str, metavar='PATH',
+                    help='save the per-image margins and confidences of a clean baseline pass '
+                         'to this .npz, the input of coreset.py')
+parser.add_argument('--val-subset', default='', type=str, metavar='PATH',
+                    help='validate on the images listed in this coreset.py JSON file only')
+parser.add_argument('--snapshot', default='', type=str, metavar='PATH',
+                    help='memory-map the model weights from this snapshot, written by the first '
+                         'run that uses it')
+parser.add_argument('--fold-bn', action='store_true',
+                    help='fold the BatchNorms into the convs of a new --snapshot (evaluation only)')
+parser.add_argument('--tile-masks', nargs='?', const=DEFAULT_TILE_SIZES, default='', metavar='SPEC',
+                    help='zero whole tiles of each resolution, e.g. 56:7x7,7:1x7, instead of the '
+                         'static regions (default spec: %s, see mask_compiler.py)' % DEFAULT_TILE_SIZES)
+parser.add_argument('--autotune', action='store_true',
+                    help='benchmark batch size, intra-op/inter-op threads and workers on this '
+                         'host and save the best as its profile')
+parser.add_argument('--autotune-batches', default=10, type=int, metavar='N',
+                    help='timed batches per autotune trial (default: 10)')
+parser.add_argument('--profile-dir', default='~/.cache/obe', type=str, metavar='DIR',
+                    help='directory of the per-host autotune profiles (default: ~/.cache/obe)')
+parser.add_argument('--no-profile', dest='use_profile', action='store_false',
+                    help='ignore the autotune profile of this host')
+parser.add_argument('--no-bitsets', dest='bitsets', action='store_false',
+                    help='do not store per-image top-1/top-5 correctness with every result')
+parser.add_argument('--serve', default='', type=str, metavar='SOCKET',
+                    help='keep the model and the validation data loaded and evaluate '
+                         'configurations sent to this Unix socket (see eval_client.py)')
+parser.add_argument('--channel-groups', default=0, type=int, metavar='G',
+                    help='skip (channel group, region) blocks ranked by the G x 64 joint '
+                         'heatmaps instead of whole regions (default: 0, off)')
+parser.add_argument('--skip-blocks', action='store_true',
+                    help='replace a residual block whose input the masks zero entirely by its '
+                         'output on zeros, computed once, instead of running its convs')
+parser.add_argument('--latency-slo', default=0.0, type=float, metavar='MS',
+                    help='p95 batch latency target: raise the hidden ratio of every hooked layer '
+                         'along --slo-ladder when it is missed, lower it when there is slack '
+                         '(default: 0, fixed --hidden-ratio-for-model)')
+parser.add_argument('--slo-ladder', default='0,0.05,0.1,0.25,0.5,0.75', type=str, metavar='RATIOS',
+                    help='hidden ratios the latency controller steps between '
+                         '(default: 0,0.05,0.1,0.25,0.5,0.75)')
+parser.add_argument('--slo-window', default=20, type=int, metavar='N',
+                    help='batches per latency controller decision (default: 20)')
+parser.add_argument('--slo-band', default=0.1, type=float,
+                    help='dead band around the latency target, as a fraction of it (default: 0.1)')
+parser.add_argument('--slo-dwell', default=3, type=int, metavar='N',
+                    help='windows under the band before stepping the ratio down (default: 3)')
+parser.add_argument('--infer-server', default='', type=str, metavar='ADDR',
+                    help='serve single-image predictions of the masked model over HTTP on HOST:PORT '
+                         'or a Unix socket path, batched on the fly (see infer_client.py)')
+parser.add_argument('--infer-max-batch', default=32, type=int, metavar='N',
+                    help='largest micro-batch of the inference server (default: 32)')
+parser.add_argument('--infer-max-wait', default=5.0, type=float, metavar='MS',
+                    help='longest a request waits for its micro-batch to fill (default: 5)')
+parser.add_argument('--infer-workers', default=1, type=int, metavar='N',
+                    help='micro-batches run at the same time (default: 1)')
+parser.add_argument('--infer-topk', default=5, type=int, metavar='K',
+                    help='classes per prediction (default: 5)')
+parser.add_argument('--finetune', action='store_true',
+                    help='fine-tune the model with every layer hooked, so it learns to do without '
+                         'the zeroed regions (cosine learning rate over --epochs)')
+parser.add_argument('--train-subset', default=0, type=int, metavar='N',
+                    help='train on N images drawn once from the training set (default: 0, all)')
+parser.add_argument('--crop-convs', nargs='?', const=0.75, default=0.0, type=float, metavar='FRACTION',
+                    help='run a conv on the bounding box of the region its mask keeps when the box '
+                         'is at most FRACTION of the map (default when given: 0.75)')
+parser.add_argument('--class-masks', action='store_true',
+                    help='zero out per-image regions ranked by the per-class heatmap of a first stage '
+                         'class guess (heatmaps of heatmap_generate_imagenet.py --class-heatmaps)')
+parser.add_argument('--class-guess', default='', type=str, metavar='PATH',
+                    help='class centroids of the first stage guess, fitted on the training set and '
+                         'saved here when missing (default: class_guess_<arch>.pt)')
+parser.add_argument('--class-drop-tolerance', default=0.0, type=float, metavar='POINTS',
+                    help='also zero every region that costs the guessed class at most this many '
+                         'top-5 points (default: 0.0)')
 best_acc1 = 0
 
 args = parser.parse_args()
+# Tiled masks are told apart from the region masks in the results by their pattern
+if args.tile_masks and args.pattern is None:
+    args.pattern = 'tiles:' + args.tile_masks
+# Synthetic runs never mix with the real results
+if args.synthetic and args.results_db == parser.get_default('results_db'):
+    args.results_db = '../results_synthetic.db'
 
 conv_layer_count = 0
 
-heatmap_per_layer=[]
-for i in range(53):
-    file_path = "../heatmap_generate/heatmap_results/acc5/results@5_cnvlayer" + \
-        str(i) + ".txt"
-    with open(file_path) as f:
-        data = f.read().replace('\n', '').split(",")[:-1]
+# Results store opened by open_results_store(), heatmaps loaded from it by
+# load_heatmaps(), both in main_worker
+results_store = None
+heatmap_per_layer = []
+# Joint channel group x region heatmaps, one row of 64 regions per channel group
+joint_heatmap_per_layer = []
+# Per-class heatmaps of --class-masks, classes x 64 per layer, and the per-class baseline
+class_heatmap_per_layer = []
+class_baseline = None
+
+# Compiled --tile-masks: (layer, size, ratio, device) -> (keep mask, zeroed pixels)
+tile_sizes = parse_tile_sizes(args.tile_masks)
+tile_masks = {}
+
+# Per-layer hidden ratios of --ratio-schedule
+ratio_schedule = None
+if args.ratio_schedule:
+    with open(args.ratio_schedule) as f:
+        ratio_schedule = json.load(f)['ratios']
+
+# Accuracy, sample count and wall time of the last validate() call
+last_validation = {}
+
+# Normalization and erasing of --uint8-transport batches, set up in main_worker
+input_transform = None
+
+# Timing of --layer-profile, kept over validate() calls to number its outputs
+layer_profiler = None
+
+# Hook metrics, the hooks themselves never print
+telemetry = Telemetry(args.telemetry, args.verbosity, args.telemetry_interval)
+erase_fraction_metric = telemetry.histogram('erase_fraction')
 
-    heatmap_per_layer.append(data)
+# Per-image region importance for --dynamic-mask, set up in main_worker
+saliency_predictor = None
+# Convs that run before the predictor sees the current batch keep the static heatmap
+dynamic_first_layer = 0
+
+# First stage class guess of --class-masks, set up in main_worker
+class_guesser = None
+# (layer, ratio, device) -> (region scores, regions to zero) per class
+class_regions = {}
+
+# Residual blocks of --skip-blocks, set up in main_worker
+block_skippers = []
+block_skips_metric = telemetry.counter('block_skips')
+
+# Convs of --crop-convs, set up in main_worker
+cropped_convs = []
+conv_crops_metric = telemetry.counter('conv_crops')
+
+# Hidden ratio of --latency-slo, set up in main_worker
+slo_controller = None
 
 # This is the hook class for zeroing out the input value in a layer
 # with the help of heatmaps generated before.
@@ -114,65 +299,201 @@ class myHook():
     def __init__(self, name, conv_layer_count):
         self.name = name
         self.conv_layer_count = conv_layer_count
+        self.reset()
+        # Arguments of the last record(), replayed for the calls of a skipped block
+        self.last_record = None
+        # (input shape, ratio) -> whether the mask zeroes the input entirely
+        self.full_masks = {}
+        # (input shape, ratio, device, dtype) -> (keep mask, erased, total) of training
+        self.keep_masks = {}
+        # (input shape, ratio) -> box the mask keeps, None to run the conv in full
+        self.boxes = {}
+        self.calls_metric = telemetry.counter('layer%d.calls' % conv_layer_count)
+        self.erase_metric = telemetry.counter('layer%d.erase_pixel' % conv_layer_count)
+        self.total_metric = telemetry.counter('layer%d.total_pixel' % conv_layer_count)
+
+    # Erased and total input values are summed over the calls since the last
+    # reset(), results use the mean per call
+    def reset(self):
+        self.calls = 0
         self.erase_pixel = 0
         self.total_pixel = 0
+        self.macs_total = 0.0
+
+    def mean_pixels(self):
+        calls = max(self.calls, 1)
+        return self.erase_pixel / calls, self.total_pixel / calls
+
+    @property
+    def macs_saved(self):
+        return self.macs_total / max(self.calls, 1)
+
+    def record(self, mode, input_shape, erase_pixel, total_pixel):
+        self.last_record = (mode, input_shape, erase_pixel, total_pixel)
+        self.calls += 1
+        self.erase_pixel += erase_pixel
+        self.total_pixel += total_pixel
+        self.macs_total += conv_macs(mode, input_shape) * erase_pixel / total_pixel
+        telemetry.inc(self.calls_metric)
+        telemetry.inc(self.erase_metric, erase_pixel)
+        telemetry.inc(self.total_metric, total_pixel)
+        telemetry.observe(erase_fraction_metric, erase_pixel / total_pixel)
+
+    def hidden_ratio(self):
+        if ratio_schedule is not None:
+            return float(ratio_schedule[self.conv_layer_count])
+        if slo_controller is not None:
+            return slo_controller.ratio
+        return float(args.hidden_ratio_for_model)
 
     def skip_computation_pre(self, mode, input):
-        print("Using heatmap: ", self.conv_layer_count)
-        heatmap_size = 8
-        heatmap = heatmap_per_layer[self.conv_layer_count]
-        # print("Using heatmap: ", heatmap)
-
-        total_size = input[0].size(dim=-1)
-        filter_size = input[0].size(dim=1)
-        scale_factor = float(total_size / heatmap_size)
-        total_pixels = total_size * total_size
-        region_size = scale_factor * scale_factor
-
-        # print(len(input))
-        # print("scale factor: " + str(scale_factor))
-        # print("total size: " + str(total_size))
-
-        hidden_ratio = float(args.hidden_ratio_for_model)
-        # print(hidden_ratio)
-        total_pixels_to_skip = total_pixels * hidden_ratio
-        # print("total pixels to skip: " + str(total_pixels_to_skip))
-
-        # calculate which regions to skip
-        max_regions_to_skip = int((heatmap_size * heatmap_size) * hidden_ratio) + 1
-        regions_ranked = sorted(range(len(heatmap)), key=lambda k: heatmap[k])
-        lowest_regions_to_skip = regions_ranked[:max_regions_to_skip]
-
-        # skip regions
-        total_pixels_skipped = 0
-        for region_idx in lowest_regions_to_skip:
-            x = int((region_idx / heatmap_size) * scale_factor)
-            y = int((region_idx % heatmap_size) * scale_factor)
-
-            # skip a full region
-            if total_pixels_to_skip > region_size:
-                input[0].data[:, :, y: int(y + scale_factor),
-                            x: int(x + scale_factor)] = 0
-                total_pixels_skipped += int(scale_factor) * int(scale_factor)
-
-            # skip a partial region
-            elif total_pixels_to_skip > 0:
-                for i in range(int(scale_factor)):
-                    if total_pixels_to_skip > 0:
-                        input[0].data[:, :, y + i: y + i + 1, x: int(x + scale_factor)] = 0
-                        total_pixels_skipped += int(scale_factor)
-
-        # Testing check
-        print("Total erased: " + str(total_pixels_skipped))
-        print("Total pixels: " + str(total_pixels))
-        self.total_pixel = total_pixels * filter_size
-        self.erase_pixel = total_pixels_skipped * filter_size
-        print("The percentage of zero pixels: " +
-            str(total_pixels_skipped / total_pixels))
-            
+        if mode.training:
+            return self.mask_training(mode, input)
+        erase_pixel, total_pixel = self.mask_input(input[0].data)
+        self.record(mode, input[0].shape, erase_pixel, total_pixel)
+
+    # Training (--finetune): a masked copy replaces the input, so autograd sees
+    # the zeros and the in-place masking never hides a change from backward
+    def mask_training(self, mode, input):
+        x = input[0]
+        if self.is_dynamic():
+            keep = torch.ones_like(x)
+            erase_pixel, total_pixel = self.mask_input(keep)
+        else:
+            key = (tuple(x.shape[1:]), self.hidden_ratio(), x.device, x.dtype)
+            if key not in self.keep_masks:
+                keep = torch.ones((1,) + key[0], device=x.device, dtype=x.dtype)
+                self.keep_masks[key] = (keep,) + self.mask_input(keep)
+            keep, erase_pixel, total_pixel = self.keep_masks[key]
+        self.record(mode, input[0].shape, erase_pixel, total_pixel)
+        return (x * keep,) + tuple(input[1:])
+
+    # Zero out the input in place, returns the erased and total input values
+    def mask_input(self, x):
+        if args.channel_groups:
+            return self.mask_joint(x)
+        if args.tile_masks:
+            return self.mask_tiled(x)
+        if self.is_dynamic() and args.class_masks:
+            classes = class_guesser.last_classes
+            if classes is not None and classes.size(0) == x.size(0):
+                return self.mask_class(x, classes)
+        elif self.is_dynamic():
+            scores = saliency_predictor.last_scores
+            if scores is not None and scores.size(0) == x.size(0):
+                return self.mask_dynamic(x, scores)
+
+        total_size = x.size(dim=-1)
+        filter_size = x.size(dim=1)
+        total_pixels_skipped = zero_heatmap_regions(x, heatmap_per_layer[self.conv_layer_count], self.hidden_ratio())
+        return total_pixels_skipped * filter_size, total_size * total_size * filter_size
+
+    # Zero out (channel group, region) blocks of the joint heatmap. Blocks whose
+    # removal keeps the highest accuracy go first, with the regions laid out
+    # as in the heatmap generator.
+    def mask_joint(self, x):
+        total_size = x.size(dim=-1)
+        filter_size = x.size(dim=1)
+        erase_pixel = zero_joint_blocks(x, joint_heatmap_per_layer[self.conv_layer_count], self.hidden_ratio())
+        return erase_pixel, total_size * total_size * filter_size
+
+    # Zero out whole tiles the heatmap ranks least important, compiled once per
+    # layer, resolution and ratio
+    def mask_tiled(self, x):
+        total_size = x.size(dim=-1)
+        filter_size = x.size(dim=1)
+        key = (self.conv_layer_count, total_size, self.hidden_ratio(), x.device)
+        if key not in tile_masks:
+            mask = compile_tile_mask(heatmap_per_layer[self.conv_layer_count], key[2], total_size,
+                                     tile_for(total_size, tile_sizes))
+            tile_masks[key] = (mask.to(x.device, x.dtype), mask.numel() - mask.sum().item())
+        mask, pixels_skipped = tile_masks[key]
+        x.mul_(mask)
+        return pixels_skipped * filter_size, total_size * total_size * filter_size
+
+    # Zero out every image's own least important regions, with the same
+    # number of regions per image as the static heatmap budget
+    def mask_dynamic(self, x, scores):
+        total_size = x.size(dim=-1)
+        filter_size = x.size(dim=1)
+        pixels_skipped = zero_dynamic_regions(x, scores, self.hidden_ratio())
+        return pixels_skipped * filter_size, total_size * total_size * filter_size
+
+    # Zero out the regions the per-class heatmap of every image's guessed class
+    # ranks least important, more of them for classes that need fewer regions
+    def mask_class(self, x, classes):
+        total_size = x.size(dim=-1)
+        filter_size = x.size(dim=1)
+        key = (self.conv_layer_count, self.hidden_ratio(), x.device)
+        if key not in class_regions:
+            heatmap = class_heatmap_per_layer[self.conv_layer_count]
+            # The highest accuracy after removal is the least important region
+            scores = -torch.nan_to_num(torch.as_tensor(heatmap, dtype=torch.float32), nan=0.0)
+            budgets = class_region_budgets(heatmap, class_baseline, key[1], args.class_drop_tolerance)
+            class_regions[key] = (scores.to(x.device), budgets.to(x.device))
+        scores, budgets = class_regions[key]
+        pixels_skipped = zero_class_regions(x, scores[classes], budgets[classes])
+        return pixels_skipped * filter_size, total_size * total_size * filter_size
+
+    def is_dynamic(self):
+        return (args.dynamic_mask or args.class_masks) and self.conv_layer_count >= dynamic_first_layer
+
+    # Bounding box (r0, r1, c0, c1) of what the mask keeps of an input of this
+    # shape when it is at most `max_fraction` of the map, never for the
+    # per-image masks
+    def crop_box(self, shape, max_fraction):
+        if self.is_dynamic():
+            return None
+        key = (tuple(shape[1:]), self.hidden_ratio())
+        if key not in self.boxes:
+            ones = torch.ones((1,) + key[0])
+            self.mask_input(ones)
+            box = kept_box(ones)
+            if box is not None and (box[1] - box[0]) * (box[3] - box[2]) > max_fraction * shape[-2] * shape[-1]:
+                box = None
+            self.boxes[key] = box
+        return self.boxes[key]
+
+    # Whether the mask of this layer zeroes an input of this shape entirely,
+    # never for the per-image masks
+    def masks_everything(self, shape):
+        if self.is_dynamic():
+            return False
+        key = (tuple(shape[1:]), self.hidden_ratio())
+        if key not in self.full_masks:
+            ones = torch.ones((1,) + key[0])
+            self.mask_input(ones)
+            self.full_masks[key] = not ones.any().item()
+        return self.full_masks[key]
 
 
 def main():
+    if not args.data and not args.synthetic and not args.infer_server:
+        parser.error('the dataset DIR is required without --synthetic')
+    if args.snapshot and args.quantize:
+        parser.error('--snapshot stores float models, not --use-quantize ones')
+    if args.fold_bn and not args.evaluate:
+        parser.error('--fold-bn folds the evaluation statistics, it needs -e')
+    if args.quantize and not (args.evaluate or args.serve or args.infer_server):
+        parser.error('--use-quantize models have no float parameters to train, use it with -e, '
+                     '--serve or --infer-server')
+    if args.synthetic and args.quantize:
+        parser.error('--use-quantize needs the downloaded quantized weights, not --synthetic')
+    if args.latency_slo and (args.ratio_schedule or args.serve):
+        parser.error('--latency-slo sets one ratio for every layer, not per-layer --ratio-schedule '
+                     'or --serve ratios')
+    if args.class_masks and (args.dynamic_mask or args.channel_groups or args.tile_masks):
+        parser.error('--class-masks ranks its own per-image regions, not with --dynamic-mask, '
+                     '--channel-groups or --tile-masks')
+    if args.finetune and (args.evaluate or args.quantize or args.serve or args.infer_server):
+        parser.error('--finetune trains the float model, not with -e, --use-quantize, --serve or --infer-server')
+    if args.infer_server and args.multiprocessing_distributed:
+        parser.error('--infer-server runs in one process, use --gpu to pick its device')
+    if args.autotune:
+        autotune(args, sys.argv)
+        return
+    # Before any parallel work, so the inter-op threads of the profile apply
+    apply_profile(args, parser)
 
     # print("hidden_ratio_for_model: " + str(args.hidden_ratio_for_model))
         
@@ -195,6 +516,10 @@ def main():
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
+    # Launched by torchrun, which sets up the rendezvous in the environment
+    if "WORLD_SIZE" in os.environ and args.world_size == -1:
+        args.dist_url = "env://"
+
     if args.dist_url == "env://" and args.world_size == -1:
         args.world_size = int(os.environ["WORLD_SIZE"])
 
@@ -214,7 +539,7 @@ def main():
 
 
 def main_worker(gpu, ngpus_per_node, args):
-    global best_acc1
+    global best_acc1, input_transform
     args.gpu = gpu
 
     if args.gpu is not None:
@@ -227,23 +552,40 @@ def main_worker(gpu, ngpus_per_node, args):
             # For multiprocessing distributed training, rank needs to be the
             # global rank among all the processes
             args.rank = args.rank * ngpus_per_node + gpu
+        if args.dist_backend is None:
+            args.dist_backend = default_backend()
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
+    open_results_store(args)
+    load_heatmaps(args)
     # create model
-    if args.pretrained:
+    if args.snapshot and os.path.isfile(args.snapshot):
+        print("=> mapping weight snapshot '{}'".format(args.snapshot))
+        model = load_snapshot(models, args.snapshot, args.arch)
+    elif args.synthetic or args.weights:
+        print("=> creating model '{}' offline".format(args.arch))
+        model = load_offline_model(models, args.arch, args.pretrained, args.weights)
+    elif args.pretrained:
         print("=> using pre-trained model '{}'".format(args.arch))
         if (args.quantize):
-            fake_model = models.__dict__[args.arch](pretrained=True)
             model = models.quantization.__dict__[args.arch](pretrained=True, quantize=True)
         else:
             model = models.__dict__[args.arch](pretrained=True)
     else:
         print("=> creating model '{}'".format(args.arch))
         model = models.__dict__[args.arch]()
-        
+
+    if args.snapshot and not os.path.isfile(args.snapshot):
+        if args.fold_bn:
+            fold_batchnorm(model.eval())
+        if is_main_process(args):
+            save_snapshot(model, args.snapshot, args.arch, args.fold_bn)
+            print("=> weight snapshot written to '{}'".format(args.snapshot))
 
     if not torch.cuda.is_available():
         print('using CPU, this will be slow')
+        if args.distributed and not args.evaluate:
+            model = torch.nn.parallel.DistributedDataParallel(model)
     elif args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
@@ -273,15 +615,23 @@ def main_worker(gpu, ngpus_per_node, args):
         else:
             model = torch.nn.DataParallel(model).cuda()
 
+    if args.dynamic_mask:
+        setup_saliency_predictor(model, args)
+    if args.class_masks:
+        setup_class_guesser(model, args)
+    if args.skip_blocks:
+        setup_block_skipping(model, args)
+    if args.crop_convs:
+        setup_conv_cropping(model, args)
+    if args.latency_slo:
+        setup_latency_controller(model, args)
+
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda(args.gpu)
     
-    # we have to fake optimizer, we don't need to train
-    if args.quantize:
-        optimizer = torch.optim.SGD(fake_model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
-    else:
+    # Evaluation and quantized models (which have no float parameters) need no optimizer
+    optimizer = None
+    if not args.evaluate and not args.quantize:
         optimizer = torch.optim.SGD(model.parameters(), args.lr,
                                 momentum=args.momentum,
                                 weight_decay=args.weight_decay)
@@ -290,7 +640,9 @@ def main_worker(gpu, ngpus_per_node, args):
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            if args.gpu is None:
+            if not torch.cuda.is_available():
+                checkpoint = torch.load(args.resume, map_location='cpu')
+            elif args.gpu is None:
                 checkpoint = torch.load(args.resume)
             else:
                 # Map model to be loaded to specified single gpu.
@@ -298,11 +650,12 @@ def main_worker(gpu, ngpus_per_node, args):
                 checkpoint = torch.load(args.resume, map_location=loc)
             args.start_epoch = checkpoint['epoch']
             best_acc1 = checkpoint['best_acc1']
-            if args.gpu is not None:
+            if args.gpu is not None and torch.is_tensor(best_acc1):
                 # best_acc1 may be from a checkpoint from a different GPU
                 best_acc1 = best_acc1.to(args.gpu)
             model.load_state_dict(checkpoint['state_dict'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
+            if optimizer is not None:
+                optimizer.load_state_dict(checkpoint['optimizer'])
             print("=> loaded checkpoint '{}' (epoch {})"
                   .format(args.resume, checkpoint['epoch']))
         else:
@@ -310,6 +663,10 @@ def main_worker(gpu, ngpus_per_node, args):
 
     cudnn.benchmark = True
 
+    if args.infer_server:
+        serve_inference(args.infer_server, model, args)
+        return
+
     GRID_width = 8
     GRID_height = 8
 
@@ -321,35 +678,65 @@ def main_worker(gpu, ngpus_per_node, args):
         run_time = GRID_width * GRID_height
     else:
         run_time = 1
-    for i in range(run_time):
-        # Data loading code
-        traindir = os.path.join(args.data, 'train')
-        if args.val_path:
-            print("Validation dataset path specified: " + args.val_path)
-            valdir = args.val_path
+    # Data loading code
+    traindir = os.path.join(args.data, 'train')
+    if args.val_path:
+        print("Validation dataset path specified: " + args.val_path)
+        valdir = args.val_path
+    else:
+        valdir = os.path.join(args.data, 'val')
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                    std=[0.229, 0.224, 0.225])
+
+    # The training set is only listed when training actually runs
+    train_sampler = None
+    train_loader = None
+    if not args.evaluate:
+        train_transforms = transforms.Compose([
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            normalize,
+        ])
+        if args.synthetic:
+            train_dataset = SyntheticImageNet(args.synthetic, args.synthetic_classes, seed=1,
+                                              transform=train_transforms)
         else:
-            valdir = os.path.join(args.data, 'val')
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                        std=[0.229, 0.224, 0.225])
-
-        train_dataset = datasets.ImageFolder(
-            traindir,
-            transforms.Compose([
-                transforms.RandomResizedCrop(224),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ]))
+            train_dataset = CachedImageFolder(traindir, train_transforms, cache_dir=args.index_cache)
+        if args.train_subset:
+            # The same images in every process and after a --resume
+            indices = torch.randperm(len(train_dataset), generator=torch.Generator().manual_seed(0))
+            train_dataset = torch.utils.data.Subset(train_dataset, indices[:args.train_subset].tolist())
+            print("=> training on {} of the training images".format(len(train_dataset)))
 
         if args.distributed:
             train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
-        else:
-            train_sampler = None
 
         train_loader = torch.utils.data.DataLoader(
             train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
             num_workers=args.workers, pin_memory=True, sampler=train_sampler)
 
+    # The validation file index is read once, every run only swaps the transforms
+    if args.synthetic:
+        val_dataset = SyntheticImageNet(args.synthetic, args.synthetic_classes)
+        valdir = val_dataset.key()
+    else:
+        val_dataset = CachedImageFolder(valdir, cache_dir=args.index_cache)
+        valdir = os.path.abspath(valdir)
+    # A --val-subset coreset keeps its labels under its own dataset name
+    val_subset = val_dataset
+    if args.val_subset:
+        with open(args.val_subset) as f:
+            indices = json.load(f)['indices']
+        val_subset = torch.utils.data.Subset(val_dataset, indices)
+        val_subset.targets = [val_dataset.targets[i] for i in indices]
+        valdir = '%s#%s' % (valdir, os.path.basename(args.val_subset))
+        print("=> validating on the {} images of '{}'".format(len(indices), args.val_subset))
+    # Autotune trials are thrown away, they write nothing to the results store
+    if args.bitsets and trial_config() is None:
+        results_store.save_labels(valdir, val_subset.targets)
+
+    for i in range(run_time):
         transforms_list = [
             transforms.Resize(256),
             transforms.CenterCrop(224),
@@ -380,12 +767,25 @@ def main_worker(gpu, ngpus_per_node, args):
                 transforms_list.append(MyEraseJPEGTransform(224, args.hidden_ratio, 0))
 
 
+        input_transform = None
+        if args.uint8_transport:
+            # Workers stop at uint8 (plus the mask of the random erase patterns),
+            # normalization and the other erase patterns run in validate()
+            worker_transforms, input_transform = MyUint8Normalize.split(
+                normalize.mean, normalize.std, transforms_list[4:], args.erase_in_main)
+            transforms_list = transforms_list[:2] + [transforms.PILToTensor()] + worker_transforms
+
         val_transforms = transforms.Compose(transforms_list)
 
+        val_dataset.transform = val_transforms
+
+        # The daemon keeps its loader workers alive between requests
         val_loader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(valdir, val_transforms),
+            val_subset,
             batch_size=args.batch_size, shuffle=False,
-            num_workers=args.workers, pin_memory=True)
+            sampler=ShardSampler(val_subset, args.rank, args.world_size) if args.distributed else None,
+            num_workers=args.workers, pin_memory=True,
+            persistent_workers=bool(args.serve) and args.workers > 0)
 
         # Enable this to see the pattern
         # for i, (images, target) in enumerate(val_loader):
@@ -398,8 +798,38 @@ def main_worker(gpu, ngpus_per_node, args):
                 if isinstance(layer, nn.Conv2d):
                     conv_layer_list.append(layer)
             print(len(conv_layer_list))
+            if len(heatmap_per_layer) < len(conv_layer_list):
+                # An interrupted generation stopped before the last layers
+                parser.error("the heatmaps of %s in '%s' cover %d of its %d convs, finish them with "
+                             "heatmap_generate_imagenet.py -a %s" % (args.arch, args.results_db,
+                                                                     len(heatmap_per_layer), len(conv_layer_list),
+                                                                     args.arch))
             global conv_layer_count
             conv_layer_count = len(conv_layer_list)
+            if trial_config() is not None:
+                # Autotune trial: time the model with every layer hooked
+                for idx, conv_layer in enumerate(conv_layer_list):
+                    conv_layer.register_forward_pre_hook(myHook(str(idx), idx).skip_computation_pre)
+                report(benchmark(val_loader, model, args, args.autotune_batches, input_transform))
+                return
+            if args.serve:
+                serve(args.serve, conv_layer_list, val_loader, model, criterion, args)
+                return
+            if args.finetune:
+                finetune(conv_layer_list, train_loader, train_sampler, val_loader, model, criterion, optimizer, args)
+                return
+            if args.evaluate and (args.bitsets or args.save_margins):
+                # Clean baseline the per-image correctness of the hooked runs is compared to
+                margins = [] if args.save_margins else None
+                validate(val_loader, model, criterion, args, margins=margins)
+                results_store.add(arch=args.arch, kind='baseline', pattern=args.pattern, **last_validation)
+                if margins is not None and is_main_process(args):
+                    np.savez(args.save_margins, dataset=valdir, targets=np.array(val_subset.targets),
+                             margin=margins[0], confidence=margins[1])
+                    print("=> baseline margins saved to '{}'".format(args.save_margins))
+            if args.evaluate and ratio_schedule is not None:
+                validate_schedule(conv_layer_list, val_loader, model, criterion, args)
+                return
             conv_layer_list.reverse()
             hook_list = []
             for conv_layer in conv_layer_list:
@@ -414,18 +844,44 @@ def main_worker(gpu, ngpus_per_node, args):
                     hook_list.append(my_hook)
                     erase_pixel_until_current_hooked_layer = 0
                     total_pixel_until_current_hooked_layer = 0
+                    macs_saved = sum(hook.macs_saved for hook in hook_list)
                     for hook in hook_list:
-                        erase_pixel_until_current_hooked_layer += hook.erase_pixel
-                        total_pixel_until_current_hooked_layer += hook.total_pixel
-                        hook.erase_pixel = 0
-                        hook.total_pixel = 0
+                        erase_pixel, total_pixel = hook.mean_pixels()
+                        erase_pixel_until_current_hooked_layer += erase_pixel
+                        total_pixel_until_current_hooked_layer += total_pixel
+                        hook.reset()
+                    if slo_controller is not None:
+                        print(slo_controller.summary())
+                        slo_controller.reset_stats()
+                    if cropped_convs:
+                        print("convs cropped: %d of %d conv calls"
+                              % (sum(c.cropped for c in cropped_convs), sum(c.calls for c in cropped_convs)))
+                        for cropped in cropped_convs:
+                            cropped.reset()
+                    if block_skippers:
+                        print("blocks skipped: %d of %d block calls"
+                              % (sum(b.skipped for b in block_skippers), sum(b.calls for b in block_skippers)))
+                        for skipper in block_skippers:
+                            skipper.reset()
+                    if args.dynamic_mask:
+                        print("saliency predictor MACs per image: %d, MACs saved per image: %d"
+                              % (saliency_predictor.macs(), macs_saved))
+                    if args.class_masks:
+                        print("class guess MACs per image: %d, MACs saved per image: %d"
+                              % (class_guesser.macs(), macs_saved))
                     print("erase_pixel_until_current_hooked_layer: " + str(erase_pixel_until_current_hooked_layer))
                     print("total_pixel_until_current_hooked_layer: " + str(total_pixel_until_current_hooked_layer))
                     all_skip = "%.3f" % ((float(erase_pixel_until_current_hooked_layer) / 10662400.0)* 100)
-                    with open('results_' + str(args.hidden_ratio_for_model) + '.txt', 'a') as f:
-                        f.write(str(erase_pixel_until_current_hooked_layer) + ", " + str(total_pixel_until_current_hooked_layer) + ", ")
-                        f.write(str("%.3f" % ((float(erase_pixel_until_current_hooked_layer) / float(
-                            total_pixel_until_current_hooked_layer)) * 100)) + ", " + str(all_skip) + "\n")
+                    print("layer skip: %.3f%%, model skip: %s%%" % ((float(erase_pixel_until_current_hooked_layer) / float(
+                        total_pixel_until_current_hooked_layer)) * 100, all_skip))
+                    results_store.add(arch=args.arch, kind='multi_layer', layer=conv_layer_count,
+                                      channel_groups=args.channel_groups or None,
+                                      ratio=slo_controller.mean_ratio() if slo_controller is not None
+                                      else args.hidden_ratio_for_model, pattern=args.pattern,
+                                      macs_saved=macs_saved,
+                                      erase_pixel=int(erase_pixel_until_current_hooked_layer),
+                                      total_pixel=int(total_pixel_until_current_hooked_layer),
+                                      **last_validation)
                     # handler.remove()
                     # return
                     continue
@@ -456,6 +912,412 @@ def main_worker(gpu, ngpus_per_node, args):
                         }, is_best)
 
 
+# Mask-aware fine-tuning: train and validate with every layer hooked, one
+# result and checkpoint per epoch, resumable with --resume
+def finetune(conv_layer_list, train_loader, train_sampler, val_loader, model, criterion, optimizer, args):
+    global best_acc1
+    hook_list = []
+    for idx, conv_layer in enumerate(conv_layer_list):
+        my_hook = myHook(str(idx), idx)
+        conv_layer.register_forward_pre_hook(my_hook.skip_computation_pre)
+        hook_list.append(my_hook)
+    ratios = json.dumps(ratio_schedule) if ratio_schedule is not None else None
+    checkpoint_name = 'finetune_%s_%s.pth.tar' % (args.arch, os.path.basename(args.ratio_schedule)
+                                                 if ratio_schedule is not None else args.hidden_ratio_for_model)
+
+    def record(epoch):
+        erase_pixel = sum(hook.mean_pixels()[0] for hook in hook_list)
+        total_pixel = sum(hook.mean_pixels()[1] for hook in hook_list)
+        results_store.add(arch=args.arch, kind='finetune', epoch=epoch, ratio=args.hidden_ratio_for_model,
+                          ratios=ratios, pattern=args.pattern,
+                          macs_saved=sum(hook.macs_saved for hook in hook_list),
+                          erase_pixel=int(erase_pixel), total_pixel=int(total_pixel), **last_validation)
+        for hook in hook_list:
+            hook.reset()
+
+    if args.start_epoch == 0:
+        # Accuracy of the masked model before any fine-tuning
+        validate(val_loader, model, criterion, args)
+        record(0)
+    for epoch in range(args.start_epoch, args.epochs):
+        if args.distributed:
+            train_sampler.set_epoch(epoch)
+        adjust_learning_rate(optimizer, epoch, args)
+        train(train_loader, model, criterion, optimizer, epoch, args)
+        for hook in hook_list:
+            hook.reset()
+
+        acc1 = validate(val_loader, model, criterion, args)
+        record(epoch + 1)
+        is_best = acc1 > best_acc1
+        best_acc1 = max(acc1, best_acc1)
+        if is_main_process(args):
+            save_checkpoint({
+                'epoch': epoch + 1,
+                'arch': args.arch,
+                'state_dict': model.state_dict(),
+                'best_acc1': best_acc1,
+                'optimizer': optimizer.state_dict(),
+                'hidden_ratio': args.hidden_ratio_for_model,
+                'ratio_schedule': ratio_schedule,
+            }, is_best, checkpoint_name)
+
+
+# One validation run with every layer hooked at its own ratio
+def evaluate_ratios(conv_layer_list, ratios, val_loader, model, criterion, args):
+    global ratio_schedule
+    saved_schedule, ratio_schedule = ratio_schedule, ratios
+    hook_list = []
+    handlers = []
+    for idx, conv_layer in enumerate(conv_layer_list):
+        my_hook = myHook(str(idx), idx)
+        handlers.append(conv_layer.register_forward_pre_hook(my_hook.skip_computation_pre))
+        hook_list.append(my_hook)
+
+    try:
+        validate(val_loader, model, criterion, args)
+    finally:
+        for handler in handlers:
+            handler.remove()
+        ratio_schedule = saved_schedule
+
+    erase_pixel = sum(hook.mean_pixels()[0] for hook in hook_list)
+    total_pixel = sum(hook.mean_pixels()[1] for hook in hook_list)
+    macs_saved = sum(hook.macs_saved for hook in hook_list)
+    results_store.add(arch=args.arch, kind='schedule', pattern=args.pattern, macs_saved=macs_saved,
+                      ratios=json.dumps(list(ratios)),
+                      erase_pixel=int(erase_pixel), total_pixel=int(total_pixel), **last_validation)
+    return dict(acc1=last_validation['acc1'], acc5=last_validation['acc5'],
+                samples=last_validation['samples'], wall_time=last_validation['wall_time'],
+                macs_saved=macs_saved, erase_pixel=int(erase_pixel), total_pixel=int(total_pixel))
+
+
+# Check a --ratio-schedule with a single validation run
+def validate_schedule(conv_layer_list, val_loader, model, criterion, args):
+    with open(args.ratio_schedule) as f:
+        schedule = json.load(f)
+    result = evaluate_ratios(conv_layer_list, schedule['ratios'], val_loader, model, criterion, args)
+    print("schedule: predicted top-1 drop %.3f, measured top-1 drop %.3f, MACs saved per image: %d"
+          % (schedule['predicted_drop'], schedule['baseline_acc1'] - result['acc1'], result['macs_saved']))
+
+
+# Evaluation daemon: one JSON request per line on a Unix socket, answered with
+# one JSON line. A request is either {"ratios": [one ratio per conv layer]} or
+# {"hidden_ratio": r, "first_layer": n}, which hooks layer n and every layer
+# after it like the multi layer sweep. {"cmd": "shutdown"} stops the daemon.
+def serve(path, conv_layer_list, val_loader, model, criterion, args):
+    num_layers = len(conv_layer_list)
+
+    class EvalHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line.decode())
+                    if request.get('cmd') == 'shutdown':
+                        self.wfile.write(b'{"status": "shutdown"}\n')
+                        self.server.stop = True
+                        return
+                    if 'ratios' in request:
+                        ratios = [float(r) for r in request['ratios']]
+                        if len(ratios) != num_layers:
+                            raise ValueError("expected %d ratios, got %d" % (num_layers, len(ratios)))
+                    else:
+                        first_layer = int(request.get('first_layer', 0))
+                        ratios = [0.0] * first_layer + [float(request['hidden_ratio'])] * (num_layers - first_layer)
+                    print("=> evaluating request: " + json.dumps(request))
+                    response = evaluate_ratios(conv_layer_list, ratios, val_loader, model, criterion, args)
+                except Exception as e:
+                    response = {'error': '%s: %s' % (type(e).__name__, e)}
+                self.wfile.write((json.dumps(response) + '\n').encode())
+                self.wfile.flush()
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.UnixStreamServer(path, EvalHandler)
+    server.stop = False
+    print("=> serving evaluation requests on '{}'".format(path))
+    try:
+        while not server.stop:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+# Inference server: every conv is hooked at --hidden-ratio-for-model (or the
+# --latency-slo ratio), requests are batched by a MicroBatcher
+def serve_inference(address, model, args):
+    preprocess = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    for idx, conv_layer in enumerate(m for m in model.modules() if isinstance(m, nn.Conv2d)):
+        conv_layer.register_forward_pre_hook(myHook(str(idx), idx).skip_computation_pre)
+    model.eval()
+    workers = args.infer_workers
+    if (args.dynamic_mask or args.class_masks) and workers > 1:
+        warnings.warn('Concurrent batches would share the per-image scores, --dynamic-mask and --class-masks '
+                      'serve with one worker.')
+        workers = 1
+
+    def decode(body):
+        return preprocess(Image.open(io.BytesIO(body)).convert('RGB'))
+
+    def run_batch(images):
+        start = time.time()
+        batch = torch.stack(images)
+        if args.gpu is not None:
+            batch = batch.cuda(args.gpu, non_blocking=True)
+        elif torch.cuda.is_available():
+            batch = batch.cuda(non_blocking=True)
+        with torch.no_grad():
+            probabilities, classes = torch.softmax(model(batch), dim=1).topk(args.infer_topk, dim=1)
+        results = [{'classes': c, 'probabilities': p} for c, p in zip(classes.tolist(), probabilities.tolist())]
+        if slo_controller is not None:
+            slo_controller.observe(time.time() - start)
+        return results
+
+    batcher = MicroBatcher(run_batch, args.infer_max_batch, args.infer_max_wait / 1e3, workers)
+    server = make_server(address, batcher, decode)
+    print("=> serving predictions on '{}', micro-batches of up to {} within {} ms, {} workers".format(
+        address, args.infer_max_batch, args.infer_max_wait, workers))
+    try:
+        while not server.stop:
+            server.handle_request()
+    finally:
+        server.server_close()
+        batcher.close()
+        if not isinstance(server.server_address, tuple):
+            os.remove(address)
+    stats = batcher.stats()
+    telemetry.flush(event='inference', **stats)
+    print("=> inference stats: " + json.dumps(stats))
+
+
+def setup_saliency_predictor(model, args):
+    global saliency_predictor, dynamic_first_layer
+    base_model = model.module if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else model
+    if not hasattr(base_model, 'layer1'):
+        raise ValueError("--dynamic-mask needs a ResNet, '{}' has no layer1".format(args.arch))
+    if isinstance(model, nn.DataParallel):
+        warnings.warn('DataParallel replicas share one saliency predictor, '
+                      'use --gpu to run --dynamic-mask on a single device.')
+
+    # Every conv up to the end of layer1 runs before the scores of the batch exist
+    first_stage = [base_model.conv1] + list(base_model.layer1.modules())
+    dynamic_first_layer = len([m for m in first_stage if isinstance(m, nn.Conv2d)])
+
+    # Output channels of the last conv, BatchNorms are gone from a --fold-bn snapshot
+    feature_channels = [m for m in base_model.layer1.modules() if isinstance(m, nn.Conv2d)][-1].out_channels
+    saliency_predictor = SaliencyPredictor(feature_channels)
+    if args.saliency_weights:
+        print("=> loading saliency predictor '{}'".format(args.saliency_weights))
+        saliency_predictor.load_state_dict(torch.load(args.saliency_weights, map_location='cpu'))
+    if torch.cuda.is_available():
+        saliency_predictor.cuda(args.gpu)
+    saliency_predictor.eval()
+    base_model.layer1.register_forward_hook(saliency_predictor.hook)
+
+
+def setup_latency_controller(model, args):
+    global slo_controller
+    ladder = parse_ladder(args.slo_ladder)
+    if args.tile_masks:
+        # Compile the tile masks of every step ahead, no batch waits for them
+        base_model = model.module if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) \
+            else model
+        device = next(base_model.parameters()).device
+        for layer, (conv, shape) in enumerate(conv_input_shapes(base_model)):
+            size = shape[-1]
+            for ratio in ladder:
+                key = (layer, size, ratio, device)
+                mask = compile_tile_mask(heatmap_per_layer[layer], ratio, size, tile_for(size, tile_sizes))
+                tile_masks[key] = (mask.to(device), mask.numel() - mask.sum().item())
+    slo_controller = LatencyController(args.latency_slo / 1e3, ladder, args.hidden_ratio_for_model,
+                                       window=args.slo_window, band=args.slo_band, dwell=args.slo_dwell,
+                                       telemetry=telemetry)
+    print("=> latency SLO p95 {:.1f} ms over the ratios {}, starting at {}".format(
+        args.latency_slo, ladder, slo_controller.ratio))
+
+
+def setup_class_guesser(model, args):
+    global class_guesser, dynamic_first_layer
+    base_model = model.module if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else model
+    if not hasattr(base_model, 'layer1'):
+        raise ValueError("--class-masks needs a ResNet, '{}' has no layer1".format(args.arch))
+    if isinstance(model, nn.DataParallel):
+        warnings.warn('DataParallel replicas share one class guess, '
+                      'use --gpu to run --class-masks on a single device.')
+
+    # Every conv up to the end of layer1 runs before the guess of the batch exists
+    first_stage = [base_model.conv1] + list(base_model.layer1.modules())
+    dynamic_first_layer = len([m for m in first_stage if isinstance(m, nn.Conv2d)])
+
+    path = args.class_guess or 'class_guess_%s.pt' % args.arch
+    if os.path.isfile(path):
+        print("=> loading class guess '{}'".format(path))
+        state = torch.load(path, map_location='cpu')
+        if state['arch'] != args.arch:
+            raise ValueError("'{}' guesses classes of {}, not {}".format(path, state['arch'], args.arch))
+        centroids = state['centroids']
+    else:
+        centroids = fit_class_centroids(base_model, args)
+        if is_main_process(args):
+            torch.save({'arch': args.arch, 'centroids': centroids}, path)
+            print("=> class guess saved to '{}'".format(path))
+    class_guesser = ClassGuesser(centroids)
+    if torch.cuda.is_available():
+        class_guesser.cuda(args.gpu)
+    class_guesser.eval()
+    base_model.layer1.register_forward_hook(class_guesser.hook)
+
+
+# Mean pooled first stage feature per class, over the --train-subset images
+# of the training set
+def fit_class_centroids(base_model, args):
+    transform = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    if args.synthetic:
+        dataset = SyntheticImageNet(args.synthetic, args.synthetic_classes, seed=1, transform=transform)
+    else:
+        dataset = CachedImageFolder(os.path.join(args.data, 'train'), transform, cache_dir=args.index_cache)
+    if args.train_subset:
+        indices = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(0))
+        dataset = torch.utils.data.Subset(dataset, indices[:args.train_subset].tolist())
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                         num_workers=args.workers, pin_memory=True)
+    print("=> fitting the class guess on {} training images".format(len(dataset)))
+
+    sums, counts = None, None
+    base_model.eval()
+    with torch.no_grad():
+        for images, target in loader:
+            if args.gpu is not None:
+                images = images.cuda(args.gpu, non_blocking=True)
+            elif torch.cuda.is_available():
+                images = images.cuda(non_blocking=True)
+            pooled = F.normalize(first_stage_features(base_model, images).mean(dim=(2, 3)), dim=1).cpu()
+            if sums is None:
+                sums = torch.zeros(args.synthetic_classes if args.synthetic else 1000, pooled.size(1))
+                counts = torch.zeros(sums.size(0))
+            sums.index_add_(0, target, pooled)
+            counts += torch.bincount(target, minlength=sums.size(0)).float()
+    return sums / counts.clamp(min=1).view(-1, 1)
+
+
+# Only rank 0 writes: it creates or migrates the schema and, on the first
+# run, imports the text heatmaps generated before the store existed. The
+# other ranks wait for it, then open the store read-only.
+def open_results_store(args):
+    global results_store
+    if is_main_process(args):
+        results_store = ResultsStore(args.results_db)
+        try:
+            results_store.require_heatmaps(args.arch, None if args.synthetic else '../heatmap_generate/heatmap_results')
+        except KeyError as e:
+            parser.error(e.args[0])
+    if args.distributed:
+        dist.barrier()
+    if not is_main_process(args):
+        results_store = ResultsStore(args.results_db, read_only=True)
+
+
+def load_heatmaps(args):
+    global heatmap_per_layer, joint_heatmap_per_layer, class_heatmap_per_layer, class_baseline
+    layers = results_store.heatmap_layers(args.arch)
+
+    heatmap_per_layer = [results_store.load_heatmap(args.arch, i) for i in range(layers)]
+    if args.channel_groups:
+        joint_heatmap_per_layer = [results_store.load_joint_heatmap(args.arch, i, args.channel_groups)
+                                   for i in range(layers)]
+    if args.class_masks:
+        class_heatmap_per_layer = [results_store.load_class_heatmap(args.arch, i) for i in range(layers)]
+        class_baseline = results_store.load_class_baseline(args.arch)
+
+
+# The myHook zeroing the input of a conv, None when it has none
+def conv_hook(conv):
+    for hook in conv._forward_pre_hooks.values():
+        owner = getattr(hook, '__self__', None)
+        if isinstance(owner, myHook):
+            return owner
+    return None
+
+
+# Masking state of a block whose conv1 hook zeroes the input x entirely, None
+# when the block has to run. The output on zeros depends on the hooks of the
+# other convs too, and is only the same for every image without per-image masks.
+def block_masked(block):
+    convs = [m for m in block.modules() if isinstance(m, nn.Conv2d)]
+
+    def masked(x):
+        hooks = [conv_hook(conv) for conv in convs]
+        if hooks[0] is None or not hooks[0].masks_everything(x.shape):
+            return None
+        if any(hook is not None and hook.is_dynamic() for hook in hooks):
+            return None
+        return tuple(None if hook is None else (hook, hook.hidden_ratio()) for hook in hooks)
+    return masked
+
+
+# What the hooks of a block recorded while its skipped output was computed
+def block_records(block):
+    convs = [m for m in block.modules() if isinstance(m, nn.Conv2d)]
+
+    def records():
+        hooks = [conv_hook(conv) for conv in convs]
+        return [(hook, hook.last_record) for hook in hooks if hook is not None and hook.last_record is not None]
+    return records
+
+
+# The hooks of a skipped block do not run, count each of them as if it had
+# masked its input again, the mask is static so the counts are the same
+def skip_block(records):
+    telemetry.inc(block_skips_metric)
+    for hook, record in records or ():
+        hook.record(*record)
+
+
+# Box of x that conv has to read, None to run it in full
+def conv_box(conv):
+    def box(x):
+        hook = conv_hook(conv)
+        return None if hook is None else hook.crop_box(x.shape, args.crop_convs)
+    return box
+
+
+def setup_conv_cropping(model, args):
+    if isinstance(model, nn.DataParallel):
+        # The replicas would run the convs of the original model
+        warnings.warn('--crop-convs does not work with DataParallel replicas, '
+                      'use --gpu or DistributedDataParallel.')
+        return
+    for conv in model.modules():
+        if isinstance(conv, nn.Conv2d) and conv.padding_mode == 'zeros':
+            cropped_convs.append(CroppedConv(conv, conv_box(conv), lambda: telemetry.inc(conv_crops_metric)))
+    print("=> cropping masked inputs of {} convs to their kept box".format(len(cropped_convs)))
+
+
+def setup_block_skipping(model, args):
+    if isinstance(model, nn.DataParallel):
+        # The replicas would run the blocks of the original model
+        warnings.warn('--skip-blocks does not work with DataParallel replicas, '
+                      'use --gpu or DistributedDataParallel.')
+        return
+    for block in model.modules():
+        if isinstance(block, (Bottleneck, BasicBlock)):
+            block_skippers.append(BlockSkipper(block, block_masked(block), skip_block, block_records(block)))
+    print("=> skipping fully masked blocks among {} residual blocks".format(len(block_skippers)))
+
+
 def train(train_loader, model, criterion, optimizer, epoch, args):
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
@@ -503,7 +1365,7 @@ def train(train_loader, model, criterion, optimizer, epoch, args):
             progress.display(i)
 
 
-def validate(val_loader, model, criterion, args):
+def validate(val_loader, model, criterion, args, margins=None):
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
@@ -516,13 +1378,26 @@ def validate(val_loader, model, criterion, args):
     # switch to evaluate mode
     model.eval()
 
+    global layer_profiler
+    if args.layer_profile:
+        # Attached last, so its inner pre-hooks run after the masking hooks
+        if layer_profiler is None:
+            layer_profiler = LayerProfiler(every=args.layer_profile_every)
+        layer_profiler.attach(model)
+
     with torch.no_grad():
-        end = time.time()
+        start = end = time.time()
+        correct1, correct5 = [], []
         for i, (images, target) in enumerate(val_loader):
+            batch_start = time.time()
+            if layer_profiler is not None:
+                layer_profiler.begin_batch(i)
             if args.gpu is not None:
                 images = images.cuda(args.gpu, non_blocking=True)
             if torch.cuda.is_available():
                 target = target.cuda(args.gpu, non_blocking=True)
+            if input_transform is not None:
+                images = input_transform(images)
 
             # compute output
             output = model(images)
@@ -533,6 +1408,18 @@ def validate(val_loader, model, criterion, args):
             losses.update(loss.item(), images.size(0))
             top1.update(acc1[0], images.size(0))
             top5.update(acc5[0], images.size(0))
+            c1, c5 = correct_per_sample(output, target, topk=(1, 5))
+            correct1.append(c1.cpu())
+            correct5.append(c5.cpu())
+            if margins is not None:
+                margins.append([t.cpu() for t in margin_per_sample(output, target)])
+            if slo_controller is not None:
+                # Until the results are on the host, without the data loading the ratio cannot speed up
+                slo_controller.observe(time.time() - batch_start)
+
+            if layer_profiler is not None:
+                layer_profiler.end_batch()
+            telemetry.tick()
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -541,16 +1428,41 @@ def validate(val_loader, model, criterion, args):
             if i % args.print_freq == 0:
                 progress.display(i)
 
+        empty = [torch.zeros(0, dtype=torch.bool)]
+        correct1 = torch.cat(correct1 or empty).numpy()
+        correct5 = torch.cat(correct5 or empty).numpy()
+        # Exact correct counts over all ranks, not an average of their percentages
+        hits1, hits5, samples = reduce_sum([int(correct1.sum()), int(correct5.sum()), len(correct1)], args)
+        acc1_avg = 100.0 * hits1 / max(samples, 1)
+        acc5_avg = 100.0 * hits5 / max(samples, 1)
+
+        bitsets = {}
+        if args.bitsets:
+            bitsets = dict(top1_bits=pack_bits(gather_in_rank_order(correct1, args)),
+                           top5_bits=pack_bits(gather_in_rank_order(correct5, args)))
+
+        if margins is not None:
+            # Replaced by the (margin, confidence) arrays of the whole set
+            batches = list(margins)
+            margins[:] = [gather_in_rank_order(torch.cat([b[k] for b in batches] or [torch.zeros(0)]).numpy(), args)
+                          for k in range(2)]
+
         # TODO: this should also be done with the ProgressMeter
-        print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
-              .format(top1=top1, top5=top5))
-        
-        
-        with open('results_' + str(args.hidden_ratio_for_model) + '.txt', 'a') as f:
-            f.write(str(conv_layer_count) + ", " + "{:.5f}".format(top1.avg.item()) + ", " + "{:.5f}".format(top5.avg.item()) +", ")
+        print(' * Acc@1 {:.3f} Acc@5 {:.3f}'.format(acc1_avg, acc5_avg))
+
+        if layer_profiler is not None:
+            if is_main_process(args):
+                layer_profiler.write(args.layer_profile)
+                print(' * Layer profile ' + json.dumps(layer_profiler.summary()))
+            layer_profiler.detach()
 
+        telemetry.flush(event='validate', acc1=acc1_avg, acc5=acc5_avg, samples=samples)
 
-    return top1.avg
+        last_validation.clear()
+        last_validation.update(acc1=acc1_avg, acc5=acc5_avg,
+                               samples=samples, wall_time=time.time() - start, **bitsets)
+
+    return torch.tensor(acc1_avg)
 
 
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
@@ -601,8 +1513,12 @@ class ProgressMeter(object):
 
 
 def adjust_learning_rate(optimizer, epoch, args):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    lr = args.lr * (0.1 ** (epoch // 30))
+    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs,
+    fine-tuning runs a cosine decay over its few epochs instead"""
+    if args.finetune:
+        lr = 0.5 * args.lr * (1 + math.cos(math.pi * epoch / args.epochs))
+    else:
+        lr = args.lr * (0.1 ** (epoch // 30))
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
 
@@ -624,5 +1540,22 @@ def accuracy(output, target, topk=(1,)):
         return res
 
 
+def correct_per_sample(output, target, topk=(1,)):
+    """Computes for every sample whether it is in the top k predictions, for the specified values of k"""
+    with torch.no_grad():
+        _, pred = output.topk(max(topk), 1, True, True)
+        correct = pred.eq(target.view(-1, 1))
+        return [correct[:, :k].any(dim=1) for k in topk]
+
+
+def margin_per_sample(output, target):
+    """Logit of the true class minus the best other logit, and the top softmax probability"""
+    with torch.no_grad():
+        true_logit = output.gather(1, target.view(-1, 1)).squeeze(1)
+        others = output.scatter(1, target.view(-1, 1), float('-inf'))
+        confidence = torch.softmax(output.float(), dim=1).max(dim=1)[0]
+        return true_logit - others.max(dim=1)[0], confidence
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,71 @@
+import argparse
+import json
+import socket
+
+# Client of the evaluation daemon started with
+#   python3 erase_experiment_imagenet.py -a resnet50 -e --pretrained --serve /tmp/obe.sock DIR
+#
+# From a sweep driver or a notebook:
+#   with EvalClient('/tmp/obe.sock') as client:
+#       for ratio in (0.125, 0.25):
+#           print(client.evaluate(hidden_ratio=ratio, first_layer=40))
+
+parser = argparse.ArgumentParser(description='Evaluation daemon client')
+parser.add_argument('socket', metavar='SOCKET', help='Unix socket of the daemon')
+parser.add_argument('--hidden-ratio', default=None, type=float,
+                    help='hidden ratio of the hooked layers')
+parser.add_argument('--first-layer', default=0, type=int,
+                    help='first hooked layer, every later layer is hooked too (default: 0)')
+parser.add_argument('--ratio-schedule', default='', type=str, metavar='PATH',
+                    help='per-layer ratios from ratio_optimizer.py or surrogate.py')
+parser.add_argument('--shutdown', action='store_true', help='stop the daemon')
+
+
+class EvalClient(object):
+    """Keeps one connection open, so a sweep pays no per-job startup"""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile('rb')
+
+    def request(self, request):
+        self.sock.sendall((json.dumps(request) + '\n').encode())
+        response = json.loads(self.reader.readline().decode())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def evaluate(self, ratios=None, hidden_ratio=None, first_layer=0):
+        if ratios is not None:
+            return self.request({'ratios': list(ratios)})
+        return self.request({'hidden_ratio': hidden_ratio, 'first_layer': first_layer})
+
+    def shutdown(self):
+        return self.request({'cmd': 'shutdown'})
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    args = parser.parse_args()
+    with EvalClient(args.socket) as client:
+        if args.shutdown:
+            print(client.shutdown())
+        elif args.ratio_schedule:
+            with open(args.ratio_schedule) as f:
+                print(client.evaluate(ratios=json.load(f)['ratios']))
+        else:
+            print(client.evaluate(hidden_ratio=args.hidden_ratio, first_layer=args.first_layer))
+
+
+if __name__ == '__main__':
+    main()
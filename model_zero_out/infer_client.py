@@ -0,0 +1,121 @@
+import argparse
+import glob
+import http.client
+import io
+import json
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from slo_controller import percentile
+
+# Load generator of the inference server started with
+#   python3 erase_experiment_imagenet.py -a resnet50 --pretrained --hidden-ratio-for-model 0.25 \
+#       --infer-server /tmp/obe-infer.sock
+#
+#   python3 infer_client.py /tmp/obe-infer.sock --images DIR --requests 2000 --concurrency 32
+#
+# Compare the throughput and latencies at --hidden-ratio-for-model 0 with the
+# masked model to see what the spatial skipping buys when serving.
+
+parser = argparse.ArgumentParser(description='Inference server load generator')
+parser.add_argument('address', metavar='ADDR', help='HOST:PORT or Unix socket path of the server')
+parser.add_argument('--images', default='', type=str, metavar='DIR',
+                    help='send the JPEG files under this directory (default: synthetic images)')
+parser.add_argument('--requests', default=1000, type=int, help='requests to send (default: 1000)')
+parser.add_argument('--concurrency', default=16, type=int, help='requests in flight (default: 16)')
+parser.add_argument('--shutdown', action='store_true', help='stop the server at the end')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class InferClient(object):
+    """One keep-alive connection, use one client per thread"""
+
+    def __init__(self, address):
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            self.conn = http.client.HTTPConnection(host, int(port))
+        else:
+            self.conn = UnixHTTPConnection(address)
+
+    def request(self, method, path, body=None):
+        self.conn.request(method, path, body=body, headers={'Content-Type': 'application/octet-stream'})
+        response = json.loads(self.conn.getresponse().read().decode())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def predict(self, image_bytes):
+        return self.request('POST', '/predict', image_bytes)
+
+    def stats(self):
+        return self.request('GET', '/stats')
+
+    def shutdown(self):
+        return self.request('POST', '/shutdown', b'')
+
+    def close(self):
+        self.conn.close()
+
+
+def load_images(directory, count):
+    if directory:
+        paths = sorted(glob.glob(os.path.join(directory, '**', '*.JPEG'), recursive=True))[:count]
+        if not paths:
+            raise ValueError("no .JPEG files under '{}'".format(directory))
+        images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+        return images
+    from synthetic_data import SyntheticImageNet
+    dataset = SyntheticImageNet(min(count, 64))
+    images = []
+    for i in range(len(dataset)):
+        buffer = io.BytesIO()
+        dataset[i][0].save(buffer, format='JPEG')
+        images.append(buffer.getvalue())
+    return images
+
+
+def main():
+    args = parser.parse_args()
+    images = load_images(args.images, args.requests)
+    clients = [InferClient(args.address) for _ in range(args.concurrency)]
+
+    def worker(index):
+        client = clients[index]
+        latencies = []
+        for i in range(index, args.requests, args.concurrency):
+            start = time.time()
+            client.predict(images[i % len(images)])
+            latencies.append(time.time() - start)
+        return latencies
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = [t for result in pool.map(worker, range(args.concurrency)) for t in result]
+    elapsed = time.time() - start
+    print("%d requests in %.2f s: %.1f images/s, client latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms"
+          % (len(latencies), elapsed, len(latencies) / elapsed, 1e3 * percentile(latencies, 50),
+             1e3 * percentile(latencies, 95), 1e3 * percentile(latencies, 99)))
+    print("server: " + json.dumps(clients[0].stats()))
+    if args.shutdown:
+        clients[0].shutdown()
+    for client in clients:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import csv
+import json
+import os
+import time
+
+import torch
+
+# Per-layer timing of validate().
+#
+# Every leaf module gets three hooks: a forward pre-hook placed in front of
+# the others, one placed behind them (so behind the masking hooks) and a
+# forward hook. The first two bound the time spent in mask application, the
+# last two the time of the module itself. The gap between the end of a batch
+# and the arrival of the next one is the data wait.
+#
+# Only every `every`-th batch is timed; on the other batches the hooks return
+# at once, so a sampled profile can stay on during production sweeps. On GPU
+# the timed batches synchronize around every module.
+
+MAX_TRACE_EVENTS = 200000
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+class LayerProfiler(object):
+
+    def __init__(self, every=1, synchronize=None):
+        self.every = max(every, 1)
+        self.synchronize = torch.cuda.is_available() if synchronize is None else synchronize
+        self.handles = []
+        self.names = []
+        self.types = []
+        self.runs = 0
+        self.reset()
+
+    def reset(self):
+        self.active = False
+        self.compute = [[] for _ in self.names]
+        self.mask = [[] for _ in self.names]
+        self.data_wait = []
+        self.batch_time = []
+        self.events = []
+        self.batch_end = None
+        self.start = time.perf_counter()
+
+    def attach(self, model):
+        """Hook every leaf module of `model`, after the hooks it already has"""
+        self.detach()
+        for name, module in model.named_modules():
+            if any(True for _ in module.children()):
+                continue
+            idx = len(self.names)
+            self.names.append(name)
+            self.types.append(type(module).__name__)
+            self.handles.append(module.register_forward_pre_hook(self._enter_hook(idx), prepend=True))
+            self.handles.append(module.register_forward_pre_hook(self._masked_hook(idx)))
+            self.handles.append(module.register_forward_hook(self._exit_hook(idx)))
+        self.enter_time = [0.0] * len(self.names)
+        self.masked_time = [0.0] * len(self.names)
+        self.reset()
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.names = []
+        self.types = []
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _enter_hook(self, idx):
+        def hook(module, input):
+            if self.active:
+                self.enter_time[idx] = self._now()
+        return hook
+
+    def _masked_hook(self, idx):
+        def hook(module, input):
+            if self.active:
+                self.masked_time[idx] = self._now()
+        return hook
+
+    def _exit_hook(self, idx):
+        def hook(module, input, output):
+            if not self.active:
+                return
+            now = self._now()
+            enter, masked = self.enter_time[idx], self.masked_time[idx]
+            self.mask[idx].append(masked - enter)
+            self.compute[idx].append(now - masked)
+            self._event(self.names[idx] + ' mask', 'mask', enter, masked)
+            self._event(self.names[idx], self.types[idx], masked, now)
+        return hook
+
+    def _event(self, name, category, begin, end):
+        if len(self.events) < MAX_TRACE_EVENTS:
+            self.events.append((name, category, begin, end))
+
+    def begin_batch(self, i):
+        """Call when batch `i` has been loaded, before the forward pass"""
+        now = time.perf_counter()
+        self.active = i % self.every == 0
+        if self.active and self.batch_end is not None:
+            self.data_wait.append(now - self.batch_end)
+            self._event('data', 'data', self.batch_end, now)
+        self.batch_begin = now
+
+    def end_batch(self):
+        """Call when the outputs of the batch have been consumed"""
+        if self.active:
+            now = self._now()
+            self.batch_time.append(now - self.batch_begin)
+            self._event('batch', 'batch', self.batch_begin, now)
+        self.active = False
+        self.batch_end = time.perf_counter()
+
+    def rows(self):
+        total = sum(self.batch_time) + sum(self.data_wait)
+        rows = []
+        for idx, name in enumerate(self.names):
+            compute, mask = self.compute[idx], self.mask[idx]
+            if not compute:
+                continue
+            rows.append({
+                'layer': name,
+                'type': self.types[idx],
+                'calls': len(compute),
+                'mean_ms': 1e3 * sum(compute) / len(compute),
+                'p95_ms': 1e3 * _percentile(compute, 0.95),
+                'mask_mean_ms': 1e3 * sum(mask) / len(mask),
+                'mask_p95_ms': 1e3 * _percentile(mask, 0.95),
+                'share': (sum(compute) + sum(mask)) / total if total else 0.0,
+            })
+        return rows
+
+    def summary(self):
+        mask = sum(sum(m) for m in self.mask)
+        compute = sum(sum(c) for c in self.compute)
+        data_wait = sum(self.data_wait)
+        batches = sum(self.batch_time)
+        total = batches + data_wait
+        if not total:
+            return {'batches': 0}
+        return {
+            'batches': len(self.batch_time),
+            'batch_mean_ms': 1e3 * batches / max(len(self.batch_time), 1),
+            'mask_share': mask / total,
+            'module_share': compute / total,
+            'data_wait_share': data_wait / total,
+            # Python between the modules, loss, accuracy and the masking not in a pre-hook
+            'other_share': max(batches - mask - compute, 0.0) / total,
+        }
+
+    def write(self, directory, tag=None):
+        """Write layers_<tag>.csv and the Chrome trace trace_<tag>.json (chrome://tracing, Perfetto)"""
+        if tag is None:
+            tag = '%03d' % self.runs
+        self.runs += 1
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'layers_%s.csv' % tag), 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['layer', 'type', 'calls', 'mean_ms', 'p95_ms',
+                                                   'mask_mean_ms', 'mask_p95_ms', 'share'])
+            writer.writeheader()
+            writer.writerows(self.rows())
+
+        pid = os.getpid()
+        events = [{'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': 0,
+                   'ts': 1e6 * (begin - self.start), 'dur': 1e6 * (end - begin)}
+                  for name, category, begin, end in self.events]
+        with open(os.path.join(directory, 'trace_%s.json' % tag), 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
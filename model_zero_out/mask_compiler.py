@@ -0,0 +1,85 @@
+import argparse
+import json
+
+import torchvision.models as models
+
+from masks import (DEFAULT_TILE_SIZES, compile_tile_mask, conv_input_shapes, conv_macs, estimated_drop,
+                   full_tile_fraction, parse_tile_sizes, static_keep_mask, tile_for)
+from results_store import ResultsStore
+
+# Tile-aligned mask compiler report.
+#
+# The static hook zeroes 8x8 heatmap regions, partly row by row, at offsets
+# that follow no kernel blocking, so a tiled or sparse conv can only skip the
+# tiles that happen to be zeroed entirely. This compares, per ratio, the MACs
+# the region masks nominally save, the MACs a tiled kernel could actually skip
+# with them, and the MACs of masks snapped to whole tiles (--tile-masks),
+# with the accuracy drop the heatmaps predict for both. Measure the shipped
+# masks with erase_experiment_imagenet.py --tile-masks.
+
+parser = argparse.ArgumentParser(description='Tile-aligned mask compiler report')
+parser.add_argument('-a', '--arch', default='resnet50', type=str,
+                    help='model architecture (default: resnet50)')
+parser.add_argument('--results-db', default='../results.db', type=str, metavar='PATH',
+                    help='results store with the heatmaps (default: ../results.db)')
+parser.add_argument('--tile-sizes', default=DEFAULT_TILE_SIZES, type=str, metavar='SPEC',
+                    help='tile per resolution (default: %s)' % DEFAULT_TILE_SIZES)
+parser.add_argument('--ratios', default='0.1,0.25,0.5', type=str,
+                    help='comma separated hidden ratios (default: 0.1,0.25,0.5)')
+parser.add_argument('--baseline-acc5', default=None, type=float,
+                    help='top-5 without any hook (default: the stored baseline of the arch)')
+parser.add_argument('--output', default='', type=str, metavar='PATH',
+                    help='also write the per-layer report as JSON')
+
+
+def main():
+    args = parser.parse_args()
+    store = ResultsStore(args.results_db)
+    try:
+        store.require_heatmaps(args.arch, '../heatmap_generate/heatmap_results')
+    except KeyError as e:
+        parser.error(e.args[0])
+    baseline = args.baseline_acc5 if args.baseline_acc5 is not None else store.load_baseline(args.arch, 'acc5')
+    if baseline is None:
+        parser.error('no stored baseline for %s in %s, pass --baseline-acc5' % (args.arch, args.results_db))
+    tile_sizes = parse_tile_sizes(args.tile_sizes)
+    shapes = conv_input_shapes(models.__dict__[args.arch]())
+    heatmaps = [store.load_heatmap(args.arch, layer) for layer in range(len(shapes))]
+    total_macs = float(sum(conv_macs(conv, shape) for conv, shape in shapes))
+
+    report = []
+    for ratio in [float(r) for r in args.ratios.split(',')]:
+        totals = dict(region_macs=0.0, region_tiled_macs=0.0, tile_macs=0.0, region_drop=0.0, tile_drop=0.0)
+        for layer, ((conv, shape), heatmap) in enumerate(zip(shapes, heatmaps)):
+            size = shape[-1]
+            tile = tile_for(size, tile_sizes)
+            macs = conv_macs(conv, shape)
+            region = static_keep_mask(heatmap, ratio, size)
+            tiled = compile_tile_mask(heatmap, ratio, size, tile)
+            entry = {
+                'layer': layer, 'ratio': ratio, 'size': size, 'tile': list(tile),
+                'region_zeroed': 1.0 - region.mean().item(),
+                'region_skippable': full_tile_fraction(region, tile),
+                'tile_zeroed': 1.0 - tiled.mean().item(),
+                'region_drop': estimated_drop(region, heatmap, baseline),
+                'tile_drop': estimated_drop(tiled, heatmap, baseline),
+            }
+            report.append(entry)
+            totals['region_macs'] += macs * entry['region_zeroed']
+            totals['region_tiled_macs'] += macs * entry['region_skippable']
+            totals['tile_macs'] += macs * entry['tile_zeroed']
+            totals['region_drop'] += entry['region_drop']
+            totals['tile_drop'] += entry['tile_drop']
+
+        print("ratio %.3f: region masks save %.2f%% of the MACs nominally, %.2f%% as whole tiles "
+              "(estimated acc@5 drop %.2f); tile masks save %.2f%% (estimated acc@5 drop %.2f)"
+              % (ratio, 100 * totals['region_macs'] / total_macs, 100 * totals['region_tiled_macs'] / total_macs,
+                 totals['region_drop'], 100 * totals['tile_macs'] / total_macs, totals['tile_drop']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'arch': args.arch, 'tile_sizes': args.tile_sizes, 'layers': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Helpers shared by the zero-out hooks in erase_experiment_imagenet.py. The
+# zero_* functions apply a mask in place to an NCHW input, they import without
+# the script's arguments so microbench.py can time them.
+
+# Heatmaps are 8x8 regions per layer
+HEATMAP_SIZE = 8
+
+
+def conv_macs(conv, input_shape):
+    """Multiply-accumulates of one image through `conv` for an NCHW input shape"""
+    in_h, in_w = input_shape[-2], input_shape[-1]
+    kh, kw = conv.kernel_size
+    sh, sw = conv.stride
+    ph, pw = conv.padding
+    dh, dw = conv.dilation
+    out_h = (in_h + 2 * ph - dh * (kh - 1) - 1) // sh + 1
+    out_w = (in_w + 2 * pw - dw * (kw - 1) - 1) // sw + 1
+    return conv.out_channels * (conv.in_channels // conv.groups) * kh * kw * out_h * out_w
+
+
+def conv_input_shapes(model, image_size=224):
+    """Run one dummy image through `model` and return its convs with their input shapes"""
+    convs = [m for m in model.modules() if isinstance(m, nn.Conv2d)]
+    shapes = {}
+    handlers = [conv.register_forward_pre_hook(
+        lambda module, input: shapes.setdefault(module, input[0].shape)) for conv in convs]
+    was_training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        model(torch.zeros(1, 3, image_size, image_size, device=device))
+    model.train(was_training)
+    for handler in handlers:
+        handler.remove()
+    return [(conv, shapes[conv]) for conv in convs]
+
+
+def static_region_count(hidden_ratio):
+    """Heatmap regions the static heatmap hook zeroes at `hidden_ratio`"""
+    if hidden_ratio <= 0:
+        return 0
+    regions = HEATMAP_SIZE * HEATMAP_SIZE
+    return min(int(regions * hidden_ratio) + 1, regions)
+
+
+def skipped_fraction(hidden_ratio):
+    """Share of a layer's input the static heatmap hook zeroes at `hidden_ratio`"""
+    return static_region_count(hidden_ratio) / float(HEATMAP_SIZE * HEATMAP_SIZE)
+
+
+def channel_group_bounds(channels, groups, group_idx):
+    """Channel range of a group, laid out as in the heatmap generator"""
+    return channels * group_idx // groups, channels * (group_idx + 1) // groups
+
+
+def region_mask(regions, size):
+    """Upsample a (N, 64) boolean region selection to a (N, 1, size, size) pixel mask"""
+    mask = regions.view(-1, 1, HEATMAP_SIZE, HEATMAP_SIZE).float()
+    return F.interpolate(mask, size=(size, size), mode='nearest')
+
+
+def lowest_regions(scores, num_regions):
+    """Select the `num_regions` least important regions of every image"""
+    regions = torch.zeros_like(scores, dtype=torch.bool)
+    if num_regions > 0:
+        idx = scores.topk(num_regions, dim=1, largest=False).indices
+        regions.scatter_(1, idx, True)
+    return regions
+
+
+def zero_heatmap_regions(x, heatmap, hidden_ratio):
+    """Static heatmap mask of the original hook, regions ranked by ascending heatmap value.
+    Returns the zeroed pixels of one channel plane."""
+    heatmap_size = HEATMAP_SIZE
+
+    total_size = x.size(dim=-1)
+    scale_factor = float(total_size / heatmap_size)
+    total_pixels = total_size * total_size
+    region_size = scale_factor * scale_factor
+
+    total_pixels_to_skip = total_pixels * hidden_ratio
+
+    # calculate which regions to skip
+    max_regions_to_skip = int((heatmap_size * heatmap_size) * hidden_ratio) + 1
+    regions_ranked = sorted(range(len(heatmap)), key=lambda k: heatmap[k])
+    lowest_regions_to_skip = regions_ranked[:max_regions_to_skip]
+
+    # skip regions
+    total_pixels_skipped = 0
+    for region_idx in lowest_regions_to_skip:
+        x_start = int((region_idx / heatmap_size) * scale_factor)
+        y_start = int((region_idx % heatmap_size) * scale_factor)
+
+        # skip a full region
+        if total_pixels_to_skip > region_size:
+            x[:, :, y_start: int(y_start + scale_factor), x_start: int(x_start + scale_factor)] = 0
+            total_pixels_skipped += int(scale_factor) * int(scale_factor)
+
+        # skip a partial region
+        elif total_pixels_to_skip > 0:
+            for i in range(int(scale_factor)):
+                if total_pixels_to_skip > 0:
+                    x[:, :, y_start + i: y_start + i + 1, x_start: int(x_start + scale_factor)] = 0
+                    total_pixels_skipped += int(scale_factor)
+    return total_pixels_skipped
+
+
+def zero_joint_blocks(x, heatmap, hidden_ratio):
+    """Zero out (channel group, region) blocks of a joint heatmap. Blocks whose
+    removal keeps the highest accuracy go first, with the regions laid out as
+    in the heatmap generator. Returns the zeroed values over all channels."""
+    groups = len(heatmap)
+    total_size = x.size(dim=-1)
+    channels = x.size(dim=1)
+    block = int(total_size / HEATMAP_SIZE)
+
+    blocks = [(g, r) for g in range(groups) for r in range(len(heatmap[g]))]
+    blocks.sort(key=lambda b: heatmap[b[0]][b[1]], reverse=True)
+    blocks_to_skip = blocks[:int(len(blocks) * hidden_ratio)]
+
+    erase_pixel = 0
+    for g, r in blocks_to_skip:
+        channel_start, channel_end = channel_group_bounds(channels, groups, g)
+        row = int(r / HEATMAP_SIZE) * block
+        col = int(r % HEATMAP_SIZE) * block
+        x[:, channel_start: channel_end, row: row + block, col: col + block] = 0
+        erase_pixel += (channel_end - channel_start) * block * block
+    return erase_pixel
+
+
+def zero_dynamic_regions(x, scores, hidden_ratio):
+    """Zero out every image's own least important regions, with the same
+    number of regions per image as the static heatmap budget. Returns the
+    mean over the images of the batch."""
+    regions = lowest_regions(scores, static_region_count(hidden_ratio))
+    mask = region_mask(regions, x.size(dim=-1)).to(x.dtype)
+    x.mul_(1 - mask)
+    return mask.sum().item() / mask.size(0)
+
+
+def zero_class_regions(x, scores, counts):
+    """Zero out the `counts[i]` least important regions of image i. Returns the
+    mean over the images of the batch."""
+    order = scores.argsort(dim=1)
+    ranks = torch.empty_like(order)
+    ranks.scatter_(1, order, torch.arange(scores.size(1), device=scores.device).expand_as(order))
+    mask = region_mask(ranks < counts.view(-1, 1), x.size(dim=-1)).to(x.dtype)
+    x.mul_(1 - mask)
+    return mask.sum().item() / mask.size(0)
+
+
+def class_region_budgets(class_heatmap, class_baseline, hidden_ratio, tolerance):
+    """Regions to zero per class: the global budget of the ratio, or more for a
+    class when more of its regions cost it at most `tolerance` accuracy points"""
+    heatmap = torch.as_tensor(class_heatmap, dtype=torch.float64)
+    drops = torch.as_tensor(class_baseline, dtype=torch.float64).view(-1, 1) - heatmap
+    # Classes without images lose nothing and gain nothing
+    cheap = (torch.nan_to_num(drops, nan=float('inf')) <= tolerance).sum(dim=1)
+    return cheap.clamp(min=static_region_count(hidden_ratio))
+
+
+# Tile granularity per input resolution of the mask compiler, e.g. 7x7 tiles
+# at 56x56 and whole rows at 7x7
+DEFAULT_TILE_SIZES = '112:8x8,56:7x7,28:7x7,14:7x7,7:1x7'
+
+
+def parse_tile_sizes(spec):
+    """'56:7x7,7:1x7' -> {56: (7, 7), 7: (1, 7)}"""
+    tile_sizes = {}
+    for item in filter(None, spec.split(',')):
+        size, tile = item.split(':')
+        th, tw = tile.lower().split('x')
+        tile_sizes[int(size)] = (int(th), int(tw))
+    return tile_sizes
+
+
+def tile_for(size, tile_sizes):
+    """Tile of a resolution, one heatmap region when none is configured"""
+    block = max(size // HEATMAP_SIZE, 1)
+    return tile_sizes.get(size, (block, block))
+
+
+def pixel_regions(size):
+    """Heatmap region of every pixel of a size x size map, laid out as in the heatmap generator"""
+    idx = torch.arange(size) * HEATMAP_SIZE // size
+    return idx.view(-1, 1) * HEATMAP_SIZE + idx.view(1, -1)
+
+
+def compile_tile_mask(heatmap, hidden_ratio, size, tile):
+    """Keep mask (size, size) that zeroes whole tiles, round(hidden_ratio * tiles) of
+    them, the tiles whose regions keep the highest accuracy when removed first"""
+    th, tw = tile
+    scores = torch.tensor(heatmap, dtype=torch.float64)[pixel_regions(size)]
+    tiles = [(scores[r: r + th, c: c + tw].mean().item(), r, c)
+             for r in range(0, size, th) for c in range(0, size, tw)]
+    tiles.sort(key=lambda t: -t[0])
+    mask = torch.ones(size, size)
+    for _, r, c in tiles[:int(round(hidden_ratio * len(tiles)))]:
+        mask[r: r + th, c: c + tw] = 0
+    return mask
+
+
+def static_keep_mask(heatmap, hidden_ratio, size):
+    """Keep mask (size, size) of the static heatmap hook"""
+    mask = torch.ones(1, 1, size, size)
+    zero_heatmap_regions(mask, heatmap, hidden_ratio)
+    return mask[0, 0]
+
+
+def full_tile_fraction(mask, tile):
+    """Share of the map in tiles that are zeroed entirely, what a tiled kernel can skip"""
+    th, tw = tile
+    size_h, size_w = mask.shape
+    skippable = 0
+    for r in range(0, size_h, th):
+        for c in range(0, size_w, tw):
+            block = mask[r: r + th, c: c + tw]
+            if not block.any():
+                skippable += block.numel()
+    return skippable / float(mask.numel())
+
+
+def estimated_drop(mask, heatmap, baseline):
+    """Sum of the heatmap drops of the regions, weighted by the zeroed share of each region"""
+    regions = pixel_regions(mask.size(0)).flatten()
+    zeroed = torch.bincount(regions, weights=(mask == 0).flatten().double(), minlength=HEATMAP_SIZE * HEATMAP_SIZE)
+    pixels = torch.bincount(regions, minlength=HEATMAP_SIZE * HEATMAP_SIZE).clamp(min=1)
+    drops = (baseline - torch.tensor(heatmap, dtype=torch.float64)).clamp(min=0)
+    return (drops * zeroed / pixels).sum().item()
+
+
+class BlockSkipper(object):
+    """Short-circuit a residual block whose input the masks zero entirely.
+
+    `masked(x)` returns None when the block has to run, else a key of the
+    masking state of the block (hooks and ratios). The hook of conv1 zeroes x
+    in place, the identity or downsample path included, so the block output
+    is then its output on zeros: computed once per key and input shape, and
+    repeated over the batch.
+
+    The hooks inside a skipped block do not run. `on_cache()` is called right
+    after the output of a key was computed, its return value is passed to
+    `on_skip` on every later skip of the key (None on the computing one), so
+    the caller can replay what the hooks recorded.
+    """
+
+    def __init__(self, block, masked, on_skip=None, on_cache=None):
+        self.block = block
+        self.masked = masked
+        self.on_skip = on_skip
+        self.on_cache = on_cache
+        self.forward = block.forward
+        # (shape, device, dtype) -> (masking key, output of one image, on_cache() state)
+        self.outputs = {}
+        self.calls = 0
+        self.skipped = 0
+        block.forward = self
+
+    def __call__(self, x):
+        self.calls += 1
+        key = None if self.block.training else self.masked(x)
+        if key is None:
+            return self.forward(x)
+        shape = (tuple(x.shape[1:]), x.device, x.dtype)
+        cached = self.outputs.get(shape)
+        state = None
+        if cached is None or cached[0] != key:
+            with torch.no_grad():
+                output = self.forward(torch.zeros((1,) + shape[0], device=x.device, dtype=x.dtype))
+            cached = (key, output, None if self.on_cache is None else self.on_cache())
+            self.outputs[shape] = cached
+        else:
+            state = cached[2]
+        self.skipped += 1
+        if self.on_skip is not None:
+            self.on_skip(state)
+        # A copy, the hooks of the next block zero their input in place
+        return cached[1].repeat(x.size(0), 1, 1, 1)
+
+    def reset(self):
+        self.calls = 0
+        self.skipped = 0
+
+    def remove(self):
+        del self.block.forward
+
+
+def kept_box(keep):
+    """Bounding box (r0, r1, c0, c1) of the nonzero positions of an (N, C, H, W)
+    keep mask over every image and channel, None when nothing is kept"""
+    kept = keep.detach().abs().sum(dim=(0, 1)) > 0
+    rows = torch.nonzero(kept.any(dim=1)).flatten()
+    cols = torch.nonzero(kept.any(dim=0)).flatten()
+    if rows.numel() == 0:
+        return None
+    return rows[0].item(), rows[-1].item() + 1, cols[0].item(), cols[-1].item() + 1
+
+
+def conv_span(start, end, size, kernel, stride, padding, dilation):
+    """Outputs [o0, o1) of a conv along one axis whose window touches the input
+    rows [start, end), and the input rows [i0, i1) these outputs read"""
+    halo = dilation * (kernel - 1)
+    out_size = (size + 2 * padding - halo - 1) // stride + 1
+    o0 = max(0, -(-(start + padding - halo) // stride))
+    o1 = min(out_size, (end - 1 + padding) // stride + 1)
+    return o0, o1, o0 * stride - padding, (o1 - 1) * stride - padding + halo + 1
+
+
+class CroppedConv(object):
+    """Run a Conv2d on the bounding box of its nonzero input only.
+
+    `box(x)` returns the (r0, r1, c0, c1) box the masks keep of x, None to run
+    the conv in full. Outside the box the input is zero, so the conv only
+    computes the outputs whose window touches the box, from the box plus its
+    halo (the zeros of the box border and of the conv padding are padded in),
+    and every other output is the bias. The output keeps its full size: the
+    BatchNorm and the residual add after the conv need the whole map.
+    """
+
+    def __init__(self, conv, box, on_crop=None):
+        self.conv = conv
+        self.box = box
+        self.on_crop = on_crop
+        self.forward = conv.forward
+        self.calls = 0
+        self.cropped = 0
+        conv.forward = self
+
+    def __call__(self, x):
+        self.calls += 1
+        box = self.box(x)
+        if box is None:
+            return self.forward(x)
+        conv = self.conv
+        r0, r1, c0, c1 = box
+        spans = [conv_span(start, end, size, k, s, p, d) for start, end, size, k, s, p, d in
+                 zip((r0, c0), (r1, c1), x.shape[-2:], conv.kernel_size, conv.stride, conv.padding,
+                     conv.dilation)]
+        (o0, o1, i0, i1), (q0, q1, j0, j1) = spans
+        if o0 >= o1 or q0 >= q1:
+            return self.forward(x)
+        # The box rows and columns the outputs read, zeros around them
+        top, bottom, left, right = max(r0, i0), min(r1, i1), max(c0, j0), min(c1, j1)
+        if top >= bottom or left >= right:
+            return self.forward(x)
+        crop = F.pad(x[:, :, top:bottom, left:right], (left - j0, j1 - right, top - i0, i1 - bottom))
+        out = F.conv2d(crop, conv.weight, conv.bias, conv.stride, 0, conv.dilation, conv.groups)
+
+        h = (x.size(2) + 2 * conv.padding[0] - conv.dilation[0] * (conv.kernel_size[0] - 1) - 1) // conv.stride[0] + 1
+        w = (x.size(3) + 2 * conv.padding[1] - conv.dilation[1] * (conv.kernel_size[1] - 1) - 1) // conv.stride[1] + 1
+        if conv.bias is None:
+            full = out.new_zeros(x.size(0), out.size(1), h, w)
+        else:
+            full = conv.bias.view(1, -1, 1, 1).expand(x.size(0), -1, h, w).clone()
+        full[:, :, o0:o1, q0:q1] = out
+        self.cropped += 1
+        if self.on_crop is not None:
+            self.on_crop()
+        return full
+
+    def reset(self):
+        self.calls = 0
+        self.cropped = 0
+
+    def remove(self):
+        del self.conv.forward
+
+
+class ClassGuesser(nn.Module):
+    """Guess the class of every image from its pooled first stage features,
+    the class whose mean feature (fitted on training images) is nearest in
+    cosine similarity."""
+
+    def __init__(self, centroids):
+        super(ClassGuesser, self).__init__()
+        self.register_buffer('centroids', F.normalize(centroids.float(), dim=1))
+        self.last_classes = None
+        self.feature_shape = None
+
+    def forward(self, features):
+        pooled = F.normalize(features.mean(dim=(2, 3)), dim=1)
+        return (pooled @ self.centroids.t()).argmax(dim=1)
+
+    def macs(self):
+        """Per-image cost of the guess on the last seen features"""
+        if self.feature_shape is None:
+            return 0
+        _, c, h, w = self.feature_shape
+        # Pooling adds plus one dot product per class
+        return c * h * w + c * self.centroids.size(0)
+
+    def hook(self, module, input, output):
+        self.feature_shape = output.shape
+        self.last_classes = self(output)
+
+
+def first_stage_features(model, images):
+    """Features of a torchvision ResNet after layer1"""
+    x = model.maxpool(model.relu(model.bn1(model.conv1(images))))
+    return model.layer1(x)
+
+
+class SaliencyPredictor(nn.Module):
+    """Predict a per-image 8x8 region importance map from first stage features.
+
+    Without trained weights the 1x1 conv averages the channels, so the
+    importance of a region is its mean activation in the first ResNet stage.
+    """
+
+    def __init__(self, in_channels):
+        super(SaliencyPredictor, self).__init__()
+        self.score = nn.Conv2d(in_channels, 1, kernel_size=1, bias=False)
+        nn.init.constant_(self.score.weight, 1.0 / in_channels)
+        self.last_scores = None
+        self.feature_shape = None
+
+    def forward(self, features):
+        scores = self.score(features.abs())
+        scores = F.adaptive_avg_pool2d(scores, HEATMAP_SIZE)
+        return scores.flatten(1)
+
+    def macs(self):
+        """Per-image cost of the predictor on the last seen features"""
+        if self.feature_shape is None:
+            return 0
+        _, _, h, w = self.feature_shape
+        # 1x1 conv plus the pooling adds
+        return conv_macs(self.score, self.feature_shape) + h * w
+
+    def hook(self, module, input, output):
+        self.feature_shape = output.shape
+        self.last_scores = self(output)
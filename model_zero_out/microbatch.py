@@ -0,0 +1,166 @@
+import collections
+import http.server
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from slo_controller import percentile
+
+# Dynamic micro-batching for the inference server (--infer-server).
+#
+# Requests are single images. A collector thread takes the oldest waiting
+# request and keeps adding requests to its batch until the batch is full or
+# the oldest request has waited --infer-max-wait, then hands the batch to a
+# pool of workers running the model. Each request gets its own Future, so
+# the HTTP handler threads simply block on their result.
+
+
+class MicroBatcher(object):
+
+    def __init__(self, run_batch, max_batch=32, max_wait=0.005, workers=1, history=10000):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # Bounded, so a long running server keeps recent percentiles in constant memory
+        self.queue_times = collections.deque(maxlen=history)
+        self.latencies = collections.deque(maxlen=history)
+        self.batch_sizes = collections.Counter()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.completed = 0
+        self.stopped = False
+        self.collector = threading.Thread(target=self._collect, name='microbatch-collector')
+        self.collector.daemon = True
+        self.collector.start()
+
+    def submit(self, item):
+        future = Future()
+        self.requests.put((time.time(), item, future))
+        return future
+
+    def _collect(self):
+        while not self.stopped:
+            try:
+                first = self.requests.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = first[0] + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                try:
+                    batch.append(self.requests.get(timeout=remaining) if remaining > 0
+                                 else self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            self.pool.submit(self._run, batch)
+
+    def _run(self, batch):
+        start = time.time()
+        try:
+            results = self.run_batch([item for _, item, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        end = time.time()
+        with self.lock:
+            self.batch_sizes[len(batch)] += 1
+            self.completed += len(batch)
+            for (arrival, _, _), result in zip(batch, results):
+                self.queue_times.append(start - arrival)
+                self.latencies.append(end - arrival)
+        for (arrival, _, future), result in zip(batch, results):
+            future.set_result(dict(result, batch_size=len(batch), queue_ms=1e3 * (start - arrival),
+                                   latency_ms=1e3 * (end - arrival)))
+
+    def stats(self):
+        with self.lock:
+            queue_times = list(self.queue_times)
+            latencies = list(self.latencies)
+            batch_sizes = dict(self.batch_sizes)
+            completed = self.completed
+        stats = {'requests': completed, 'waiting': self.requests.qsize(),
+                 'throughput': completed / max(time.time() - self.started, 1e-9),
+                 'batch_sizes': dict((str(size), count) for size, count in sorted(batch_sizes.items()))}
+        for name, values in (('queue_ms', queue_times), ('latency_ms', latencies)):
+            if values:
+                stats[name] = dict(('p%d' % q, 1e3 * percentile(values, q)) for q in (50, 95, 99))
+                stats[name]['mean'] = 1e3 * sum(values) / len(values)
+        return stats
+
+    def close(self):
+        self.stopped = True
+        self.collector.join()
+        self.pool.shutdown(wait=True)
+
+
+# HTTP front end: POST /predict with the encoded image as the body answers
+# the top-k classes, GET /stats the batching statistics and POST /shutdown
+# stops the server. An address with a port is served over TCP, anything else
+# is a Unix socket path.
+class InferenceHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/shutdown':
+            self.server.stop = True
+            return self.reply(200, {'status': 'shutdown'})
+        if self.path != '/predict':
+            return self.reply(404, {'error': 'unknown path ' + self.path})
+        try:
+            image = self.server.decode(body)
+        except Exception as e:
+            return self.reply(400, {'error': '%s: %s' % (type(e).__name__, e)})
+        try:
+            result = self.server.batcher.submit(image).result()
+        except Exception as e:
+            return self.reply(500, {'error': '%s: %s' % (type(e).__name__, e)})
+        self.reply(200, result)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': 'unknown path ' + self.path})
+        self.reply(200, self.server.batcher.stats())
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # One line per request would cost more than a small batch
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, batcher, decode):
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)), InferenceHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = ThreadingUnixHTTPServer(address, InferenceHandler)
+    server.batcher = batcher
+    server.decode = decode
+    server.stop = False
+    # Handlers run in their own threads, the serving loop polls for /shutdown
+    server.timeout = 0.5
+    return server
@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import timeit
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from masks import HEATMAP_SIZE, CroppedConv, zero_dynamic_regions, zero_heatmap_regions, zero_joint_blocks
+from preprocess import (MyEraseTransform, MyEraseCircleTransform, MyRandomErasePixelTransform,
+                        MyEraseEvenTransform, MyEraseJPEGTransform, MyUint8Normalize)
+
+# Microbenchmarks of the erase transforms and of the zero-out masks, on
+# synthetic tensors so they run without ImageNet or a model.
+#
+#   python3 microbench.py --save         # record the baseline of this host
+#   python3 microbench.py                # compare, exit 1 on a regression
+#
+# Every case is timed as the best of --repeat runs of an auto-ranged loop.
+# A case is a regression when it is more than --tolerance slower than its
+# baseline. Before timing, CroppedConv is checked against the plain conv on
+# masked inputs, a mismatch exits 1 too.
+
+parser = argparse.ArgumentParser(description='Erase transform and zero-out mask microbenchmarks')
+parser.add_argument('--baseline', default='microbench_baseline.json', type=str, metavar='PATH',
+                    help='baseline timings (default: microbench_baseline.json)')
+parser.add_argument('--save', action='store_true', help='write the timings as the new baseline')
+parser.add_argument('--tolerance', default=0.25, type=float,
+                    help='allowed slowdown over the baseline (default: 0.25, i.e. 25%%)')
+parser.add_argument('--filter', default='', type=str, help='only run cases whose name contains this')
+parser.add_argument('--repeat', default=5, type=int, help='timed runs per case (default: 5)')
+parser.add_argument('-b', '--batch-size', default=32, type=int,
+                    help='images per batch case and per hook call (default: 32)')
+parser.add_argument('--threads', default=1, type=int, help='intra-op threads (default: 1)')
+parser.add_argument('--no-check', action='store_true', help='skip the CroppedConv correctness check')
+
+RATIOS = (0.1, 0.25, 0.5)
+# Spatial size and channels of the conv inputs of each ResNet50 resolution
+HOOK_INPUTS = ((112, 64), (56, 64), (28, 128), (14, 256), (7, 512))
+IMAGE_SIZE = 224
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def transform_cases(batch_size):
+    factories = [
+        ('circle', lambda r: MyEraseCircleTransform(IMAGE_SIZE, 1 - r, 0)),
+        ('random', lambda r: MyRandomErasePixelTransform(IMAGE_SIZE, r, 0)),
+        ('even', lambda r: MyEraseEvenTransform(IMAGE_SIZE, r, 0)),
+        ('jpeg', lambda r: MyEraseJPEGTransform(IMAGE_SIZE, r, 0)),
+    ]
+    # The heatmap generator's single region erase has no ratio
+    erase_transforms = [('region', None, lambda r: MyEraseTransform(0, 0, 28, 28, 0))]
+    erase_transforms += [(name, r, factory) for name, factory in factories for r in RATIOS]
+
+    image = torch.rand(3, IMAGE_SIZE, IMAGE_SIZE)
+    batch = torch.rand(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+    cases = []
+    for name, ratio, factory in erase_transforms:
+        t = factory(ratio)
+        label = 'transform/%s' % name if ratio is None else 'transform/%s/r%g' % (name, ratio)
+        cases.append((label + '/image', lambda t=t: t(image)))
+        cases.append((label + '/batch%d' % batch_size, lambda t=t: [t(x) for x in batch]))
+
+    uint8_batch = torch.randint(0, 256, (batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.uint8)
+    for label, erase in (('none', []), ('circle/r0.25', [MyEraseCircleTransform(IMAGE_SIZE, 0.75, 0)]),
+                         ('jpeg/r0.25', [MyEraseJPEGTransform(IMAGE_SIZE, 0.25, 0)])):
+        normalize = MyUint8Normalize(MEAN, STD, erase)
+        cases.append(('uint8_normalize/%s/batch%d' % (label, batch_size), lambda n=normalize: n(uint8_batch)))
+    return cases
+
+
+def hook_cases(batch_size):
+    rng = random.Random(0)
+    heatmap = [rng.uniform(80.0, 93.0) for _ in range(HEATMAP_SIZE * HEATMAP_SIZE)]
+    joint_heatmap = [[rng.uniform(80.0, 93.0) for _ in range(HEATMAP_SIZE * HEATMAP_SIZE)] for _ in range(4)]
+    scores = torch.rand(batch_size, HEATMAP_SIZE * HEATMAP_SIZE)
+    cases = []
+    for size, channels in HOOK_INPUTS:
+        x = torch.rand(batch_size, channels, size, size)
+        for ratio in RATIOS:
+            label = '%d/r%g' % (size, ratio)
+            cases.append(('hook/static/' + label, lambda x=x, r=ratio: zero_heatmap_regions(x, heatmap, r)))
+            cases.append(('hook/joint/' + label, lambda x=x, r=ratio: zero_joint_blocks(x, joint_heatmap, r)))
+            cases.append(('hook/dynamic/' + label, lambda x=x, r=ratio: zero_dynamic_regions(x, scores, r)))
+    return cases
+
+
+def check_cropped_convs():
+    """Names of the (conv, input, box) cases where CroppedConv differs from the
+    plain conv on an input that is zero outside the box"""
+    failures = []
+    cases = 0
+    for size in (14, 15):
+        # Boxes touching each border, a corner, the interior and the whole input
+        boxes = {'top': (0, 4, 3, 9), 'bottom': (size - 4, size, 3, 9), 'left': (3, 9, 0, 4),
+                 'right': (3, 9, size - 4, size), 'corner': (size - 1, size, size - 1, size),
+                 'interior': (5, 8, 6, 10), 'full': (0, size, 0, size)}
+        for kernel in (1, 3, 7):
+            for stride in (1, 2):
+                for dilation in ((1, 2) if kernel == 3 else (1,)):
+                    for bias in (True, False):
+                        conv = nn.Conv2d(8, 16, kernel, stride, dilation * (kernel // 2), dilation, bias=bias)
+                        for name, box in sorted(boxes.items()):
+                            r0, r1, c0, c1 = box
+                            x = torch.zeros(2, 8, size, size)
+                            x[:, :, r0:r1, c0:c1] = torch.randn(2, 8, r1 - r0, c1 - c0)
+                            cropped = CroppedConv(conv, lambda x, box=box: box)
+                            with torch.no_grad():
+                                expected = F.conv2d(x, conv.weight, conv.bias, conv.stride, conv.padding,
+                                                    conv.dilation)
+                                out = cropped(x)
+                            cropped.remove()
+                            cases += 1
+                            if out.shape != expected.shape or not torch.allclose(out, expected, rtol=1e-4, atol=1e-5):
+                                failures.append('%dx%d/s%d/d%d/%s/%d/%s' % (kernel, kernel, stride, dilation,
+                                                                          'bias' if bias else 'nobias', size, name))
+    print("cropped conv check: %d cases, %d mismatches" % (cases, len(failures)))
+    return failures
+
+
+def time_case(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    if not args.no_check:
+        failures = check_cropped_convs()
+        for name in failures:
+            print("MISMATCH cropped conv %s" % name)
+        if failures:
+            sys.exit(1)
+
+    timings = {}
+    for name, fn in transform_cases(args.batch_size) + hook_cases(args.batch_size):
+        if args.filter in name:
+            timings[name] = time_case(fn, args.repeat)
+            print("%-45s %10.3f ms" % (name, 1e3 * timings[name]))
+
+    if args.save:
+        baseline = {'host': socket.gethostname(), 'threads': args.threads,
+                    'batch_size': args.batch_size, 'timings': timings}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                # Keep the cases filtered out of this run
+                baseline['timings'] = dict(json.load(f)['timings'], **timings)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("=> baseline written to '{}'".format(args.baseline))
+        return
+
+    if not os.path.isfile(args.baseline):
+        print("=> no baseline at '{}', run with --save first".format(args.baseline))
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['host'] != socket.gethostname() or baseline['threads'] != args.threads \
+            or baseline['batch_size'] != args.batch_size:
+        print("=> warning: baseline recorded on %s with %d threads and batch size %d"
+              % (baseline['host'], baseline['threads'], baseline['batch_size']))
+
+    regressions = []
+    for name, seconds in sorted(timings.items()):
+        if name not in baseline['timings']:
+            print("new case without baseline: %s" % name)
+            continue
+        slowdown = seconds / baseline['timings'][name] - 1.0
+        if slowdown > args.tolerance:
+            regressions.append(name)
+            print("REGRESSION %-45s %10.3f ms -> %10.3f ms (%+.0f%%)"
+                  % (name, 1e3 * baseline['timings'][name], 1e3 * seconds, 100 * slowdown))
+    print("%d cases, %d regressions over %.0f%%" % (len(timings), len(regressions), 100 * args.tolerance))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import torch
 import torchvision.transforms.functional as TF
 import random
 import math
@@ -122,11 +123,11 @@ class MyRandomErasePixelTransform:
         num_erase_pixel = int(total_pixel_size * erase_ratio)
         
         idx = np.random.choice(total_pixel_size, size=num_erase_pixel, replace=0)
-        out = np.column_stack((np.unravel_index(idx,(total_size,total_size))))
-        
-        for i, j in out:
-            x[:, i, j] = 0
-        
+        rows, cols = np.unravel_index(idx, (total_size, total_size))
+
+        # One indexed write instead of a loop over the pixels
+        x[:, torch.from_numpy(rows), torch.from_numpy(cols)] = 0
+
         return x
 
 class MyEraseJPEGTransform:
@@ -182,6 +183,85 @@ class MyEraseJPEGTransform:
         return x
 
 
+class MyEraseMaskChannel:
+    """Append the mask of the erase transforms to a uint8 image as one more channel.
+
+    Runs in the loader workers with --uint8-transport, so the random patterns
+    are still drawn there in parallel. The erase transforms zero normalized
+    pixels, so they cannot be applied to the uint8 image itself, the mask
+    is applied by MyUint8Normalize after normalization.
+    """
+
+    def __init__(self, erase_transforms):
+        self.erase_transforms = list(erase_transforms)
+
+    def __call__(self, x):
+        mask = torch.ones((1,) + tuple(x.shape[1:]), dtype=x.dtype)
+        for t in self.erase_transforms:
+            mask = t(mask)
+        return torch.cat([x, mask])
+
+
+class MyUint8Normalize:
+    """Normalize a uint8 batch, then apply the erase transforms.
+
+    With --uint8-transport the loader workers stop after PILToTensor, so
+    images cross the worker queue as uint8 (4x smaller than float32). This
+    runs at the start of validate(), on the GPU when there is one. The erase
+    transforms are turned into a mask by applying them to a tensor of ones,
+    once for the fixed patterns and per image for the random ones. With
+    `mask_channel` the last channel of the batch is the mask drawn by
+    MyEraseMaskChannel in the workers.
+    """
+
+    random_transforms = (MyRandomErasePixelTransform, MyEraseJPEGTransform)
+
+    def __init__(self, mean, std, erase_transforms=(), mask_channel=False):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.erase_transforms = list(erase_transforms)
+        self.mask_channel = mask_channel
+        self.fixed_masks = {}
+
+    @classmethod
+    def split(cls, mean, std, erase_transforms, erase_in_main=False):
+        """Worker transforms after PILToTensor and the batch transform of
+        --uint8-transport. The random patterns stay in the workers unless
+        `erase_in_main`, the fixed ones are a cached mask either way."""
+        worker = [] if erase_in_main else [t for t in erase_transforms if isinstance(t, cls.random_transforms)]
+        main = [t for t in erase_transforms if t not in worker]
+        worker_transforms = [MyEraseMaskChannel(worker)] if worker else []
+        return worker_transforms, cls(mean, std, main, mask_channel=bool(worker))
+
+    def erase_mask(self, shape):
+        mask = torch.ones(shape)
+        for t in self.erase_transforms:
+            mask = t(mask)
+        return mask
+
+    def batch_mask(self, images):
+        if any(isinstance(t, self.random_transforms) for t in self.erase_transforms):
+            return torch.stack([self.erase_mask(images.shape[1:]) for _ in range(images.size(0))]).to(images.device)
+        key = (tuple(images.shape[1:]), images.device)
+        if key not in self.fixed_masks:
+            self.fixed_masks[key] = self.erase_mask(images.shape[1:]).unsqueeze(0).to(images.device)
+        return self.fixed_masks[key]
+
+    def __call__(self, images):
+        mask = None
+        if self.mask_channel:
+            images, mask = images[:, :-1], images[:, -1:]
+        # (x / 255 - mean) / std as one multiply-add on the converted batch
+        scale = (1.0 / (255.0 * self.std)).to(images.device)
+        bias = (-self.mean / self.std).to(images.device)
+        images = images.float().mul_(scale).add_(bias)
+        if mask is not None:
+            images.mul_(mask)
+        if self.erase_transforms:
+            images.mul_(self.batch_mask(images))
+        return images
+
+
 class MyRotationTransform:
     """Rotate by one of the given angles."""
 
@@ -0,0 +1,184 @@
+import argparse
+import glob
+import json
+import os
+import re
+
+import torchvision.models as models
+
+from masks import conv_input_shapes, conv_macs, estimated_drop, static_keep_mask
+from results_store import ResultsStore
+
+# Pick a hidden ratio per layer instead of one global --hidden-ratio-for-model.
+#
+# Every layer can keep its full input (ratio 0), use one of the ratios of the
+# single layer sweep, or one of the --heatmap-ratios the sweep never ran. The
+# drop of an unmeasured ratio is estimated from the layer's top-1 heatmap (the
+# drops of the regions the static mask zeroes), scaled by how the heatmap
+# estimates compare with the sweep at the measured ratios of the layer.
+# Assuming the top-1 drops of the layers add up, choosing
+# the ratios is a multiple-choice knapsack: the drops are the weights, the MACs
+# a layer saves are the values and the target drop is the capacity. The
+# schedule is then checked with one validation run:
+#
+#   python3 ratio_optimizer.py --target-drop 1.0 -o schedule.json
+#   python3 erase_experiment_imagenet.py -a resnet50 -e --pretrained --ratio-schedule schedule.json DIR
+
+parser = argparse.ArgumentParser(description='Per-layer hidden ratio optimizer')
+parser.add_argument('-a', '--arch', default='resnet50', type=str,
+                    help='model architecture (default: resnet50)')
+parser.add_argument('--target-drop', default=1.0, type=float,
+                    help='allowed top-1 drop in percentage points (default: 1.0)')
+parser.add_argument('--baseline-acc1', default=None, type=float,
+                    help='top-1 without any hook (default: the stored baseline of the arch)')
+parser.add_argument('--heatmap-ratios', default='0.05,0.15,0.35,0.75', type=str, metavar='RATIOS',
+                    help='ratios scored from the heatmaps where the sweep has no result '
+                         '(default: 0.05,0.15,0.35,0.75, empty for the sweep only)')
+parser.add_argument('--resolution', default=0.01, type=float,
+                    help='top-1 drop resolution of the knapsack (default: 0.01)')
+parser.add_argument('--results-db', default='../results.db', type=str, metavar='PATH',
+                    help='results store with the single layer sweep (default: ../results.db)')
+parser.add_argument('--single-layer-dir', default='results/single_layer', type=str,
+                    help='text results imported when the store has no single layer sweep')
+parser.add_argument('-o', '--output', default='ratio_schedule.json', type=str,
+                    help='schedule file for --ratio-schedule (default: ratio_schedule.json)')
+
+
+def load_single_layer(store, arch, directory):
+    """top-1 of every (layer, ratio) of the single layer sweep"""
+    query = "SELECT layer, ratio, acc1 FROM results WHERE arch = ? AND kind = 'single_layer' ORDER BY id"
+    rows = store.query(query, (arch,))
+    if not rows:
+        for path in glob.glob(os.path.join(directory, 'results_*.txt')):
+            ratio = float(re.search(r'results_([\d.]+)\.txt$', path).group(1))
+            store.import_zero_out_text(arch, path, ratio, 'single_layer')
+        rows = store.query(query, (arch,))
+    acc1 = {}
+    for row in rows:
+        acc1[(row['layer'], row['ratio'])] = row['acc1']
+    return acc1
+
+
+def layer_shapes(arch):
+    """MACs and input resolution of every conv"""
+    model = models.__dict__[arch]()
+    return [(conv_macs(conv, shape), shape[-1]) for conv, shape in conv_input_shapes(model)]
+
+
+def static_masks(heatmap5, size, ratios):
+    """Keep mask per ratio of the static hook, ranked by the top-5 heatmap as in the hook"""
+    return dict((ratio, static_keep_mask(heatmap5, ratio, size)) for ratio in ratios)
+
+
+def heatmap_drops(masks, heatmap1, baseline):
+    """Estimated top-1 drop per ratio of the static masks, from the top-1
+    drops of the zeroed regions"""
+    return dict((ratio, estimated_drop(mask, heatmap1, baseline)) for ratio, mask in masks.items())
+
+
+def calibration(measured, estimated):
+    """Scale of the heatmap estimates of a layer that matches its measured drops"""
+    common = [r for r in measured if r in estimated]
+    total = sum(estimated[r] for r in common)
+    if not common or total <= 0:
+        return 1.0
+    return sum(measured[r] for r in common) / total
+
+
+def optimize(choices, capacity):
+    """Multiple-choice knapsack over integer weights.
+
+    `choices[l]` lists the (weight, value, option) of layer l, exactly one is
+    taken per layer. Returns the chosen options maximizing the total value
+    with the total weight at most `capacity`.
+    """
+    best = [0.0] + [None] * capacity
+    picks = []
+    for layer_choices in choices:
+        new_best = [None] * (capacity + 1)
+        pick = [None] * (capacity + 1)
+        for used, value in enumerate(best):
+            if value is None:
+                continue
+            for weight, gain, option in layer_choices:
+                total = used + weight
+                if total <= capacity and (new_best[total] is None or value + gain > new_best[total]):
+                    new_best[total] = value + gain
+                    pick[total] = (used, option)
+        best = new_best
+        picks.append(pick)
+
+    used = max((u for u in range(capacity + 1) if best[u] is not None), key=lambda u: best[u])
+    options = []
+    for pick in reversed(picks):
+        used, option = pick[used]
+        options.append(option)
+    options.reverse()
+    return options
+
+
+def main():
+    args = parser.parse_args()
+    store = ResultsStore(args.results_db)
+    baseline = args.baseline_acc1 if args.baseline_acc1 is not None else store.load_baseline(args.arch)
+    if baseline is None:
+        parser.error('no stored baseline for %s in %s, pass --baseline-acc1' % (args.arch, args.results_db))
+    acc1 = load_single_layer(store, args.arch, args.single_layer_dir)
+    layers = layer_shapes(args.arch)
+    macs = [layer_total for layer_total, _ in layers]
+    ratios = sorted(set(ratio for _, ratio in acc1))
+    extra_ratios = sorted(set(float(r) for r in args.heatmap_ratios.split(',') if r.strip()) - set(ratios))
+    print("%d layers, baseline top-1 %.3f, single layer ratios: %s, heatmap ratios: %s"
+          % (len(macs), baseline, ratios, extra_ratios))
+    # The MACs a ratio saves come from the static mask, which zeroes less than
+    # the ratio at low resolutions (nothing at 7x7)
+    try:
+        store.require_heatmaps(args.arch, '../heatmap_generate/heatmap_results')
+    except KeyError as e:
+        parser.error(e.args[0])
+
+    choices = []
+    for layer, (layer_total, size) in enumerate(layers):
+        measured = dict((ratio, max(baseline - acc1[(layer, ratio)], 0.0))
+                        for ratio in ratios if (layer, ratio) in acc1)
+        drops = dict(measured)
+        masks = static_masks(store.load_heatmap(args.arch, layer), size, ratios + extra_ratios)
+        if extra_ratios:
+            heatmap1 = store.load_heatmap(args.arch, layer, metric='acc1')
+            estimated = heatmap_drops(masks, heatmap1, baseline)
+            scale = calibration(measured, estimated)
+            for ratio in extra_ratios:
+                drops[ratio] = scale * estimated[ratio]
+
+        layer_choices = [(0, 0.0, (0.0, 0.0, 0.0))]
+        for ratio, drop in sorted(drops.items()):
+            weight = int(round(drop / args.resolution))
+            saved = layer_total * (1.0 - masks[ratio].mean().item())
+            layer_choices.append((weight, saved, (ratio, drop, saved)))
+        choices.append(layer_choices)
+
+    capacity = int(round(args.target_drop / args.resolution))
+    options = optimize(choices, capacity)
+
+    schedule = [ratio for ratio, _, _ in options]
+    predicted_drop = sum(drop for _, drop, _ in options)
+    macs_saved = sum(saved for _, _, saved in options)
+    for layer, (ratio, drop, saved) in enumerate(options):
+        print("layer %2d: ratio %.3f, drop %.3f, MACs saved %d" % (layer, ratio, drop, saved))
+    print("predicted top-1 drop: %.3f, MACs saved: %d / %d (%.3f%%)"
+          % (predicted_drop, macs_saved, sum(macs), 100.0 * macs_saved / sum(macs)))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'arch': args.arch,
+            'target_drop': args.target_drop,
+            'baseline_acc1': baseline,
+            'predicted_drop': predicted_drop,
+            'macs_saved': macs_saved,
+            'ratios': schedule,
+        }, f, indent=2)
+    print("=> schedule written to '{}'".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
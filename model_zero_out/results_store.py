@@ -0,0 +1,324 @@
+import atexit
+import os
+import re
+import sqlite3
+import time
+import urllib.request
+
+import numpy as np
+
+# One SQLite results store for the heatmap generation and zero-out experiments.
+#
+# kind is one of:
+#   baseline                 no region removed
+#   heatmap                  OBE pass, `region` removed from `layer`'s input
+#   heatmap_channel          OBE pass, `channel_group` removed over the whole map
+#   heatmap_joint            OBE pass, (`channel_group`, `region`) removed
+#   heatmap_joint_estimate   estimated heatmap_joint block that was not measured
+#   heatmap_shared           heatmap region interpolated from the representative
+#                            layers of the stage (--share-heatmaps)
+#   single_layer             zero-out hook on `layer` only
+#   multi_layer              zero-out hooks on `layer` and every layer after it
+#   schedule                 zero-out hooks on every layer, `ratios` holds the JSON
+#                            list of per-layer ratios of the --ratio-schedule
+#   finetune                 zero-out hooks on every layer after `epoch` epochs of
+#                            mask-aware fine-tuning (--finetune), 0 before training
+#
+# top1_bits/top5_bits pack, in validation set order, whether every image was
+# classified correctly. The image labels are kept per dataset in `labels`.
+# class_acc1/class_acc5 hold the accuracy of every class as float32 (NaN for
+# classes without images), per-class heatmaps come from the heatmap rows that
+# have them (--class-heatmaps).
+
+COLUMNS = [
+    ('arch', 'TEXT'),
+    ('kind', 'TEXT'),
+    ('layer', 'INTEGER'),
+    ('region', 'INTEGER'),
+    ('channel_group', 'INTEGER'),
+    ('channel_groups', 'INTEGER'),
+    ('ratio', 'REAL'),
+    ('pattern', 'TEXT'),
+    ('acc1', 'REAL'),
+    ('acc5', 'REAL'),
+    ('samples', 'INTEGER'),
+    ('macs_saved', 'REAL'),
+    ('erase_pixel', 'INTEGER'),
+    ('total_pixel', 'INTEGER'),
+    ('wall_time', 'REAL'),
+    ('created', 'REAL'),
+    ('ratios', 'TEXT'),
+    ('epoch', 'INTEGER'),
+    ('class_acc1', 'BLOB'),
+    ('class_acc5', 'BLOB'),
+    ('top1_bits', 'BLOB'),
+    ('top5_bits', 'BLOB'),
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+HEATMAP_REGIONS = 64
+
+# The text heatmaps of heatmap_generate/heatmap_results predate the store,
+# they were generated for resnet50 only, on the full validation set
+LEGACY_HEATMAP_ARCH = 'resnet50'
+LEGACY_HEATMAP_SAMPLES = 50000
+
+
+class ResultsStore(object):
+    """Buffered writer and small query API over the results table.
+
+    A `read_only` store (distributed ranks other than 0) neither creates nor
+    migrates the schema and drops every write, the database must exist.
+    """
+
+    def __init__(self, path, batch_size=64, read_only=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = []
+        self.read_only = read_only
+        if read_only:
+            self.conn = sqlite3.connect('file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(path)),
+                                        uri=True)
+            atexit.register(self.close)
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, ' +
+                          ', '.join('%s %s' % column for column in COLUMNS) + ')')
+        existing = [row[1] for row in self.conn.execute('PRAGMA table_info(results)')]
+        for name, column_type in COLUMNS:
+            if name not in existing:
+                self.conn.execute('ALTER TABLE results ADD COLUMN %s %s' % (name, column_type))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_lookup ON results (arch, kind, layer)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS labels (dataset TEXT PRIMARY KEY, samples INTEGER, targets BLOB)')
+        self.conn.commit()
+        atexit.register(self.close)
+
+    def add(self, **row):
+        if self.read_only:
+            return
+        unknown = set(row) - set(COLUMN_NAMES)
+        if unknown:
+            raise ValueError("unknown result columns: " + ", ".join(sorted(unknown)))
+        row.setdefault('created', time.time())
+        self.pending.append(tuple(row.get(name) for name in COLUMN_NAMES))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.conn.executemany('INSERT INTO results (' + ', '.join(COLUMN_NAMES) + ') VALUES (' +
+                              ', '.join('?' * len(COLUMN_NAMES)) + ')', self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.flush()
+        self.conn.close()
+        self.conn = None
+
+    def query(self, sql, params=()):
+        self.flush()
+        cursor = self.conn.execute(sql, params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def save_labels(self, dataset, targets):
+        if self.read_only:
+            return
+        targets = np.asarray(targets, dtype=np.int16)
+        self.conn.execute('INSERT OR REPLACE INTO labels VALUES (?, ?, ?)',
+                          (dataset, len(targets), targets.tobytes()))
+        self.conn.commit()
+
+    def load_labels(self, dataset):
+        rows = self.query('SELECT targets FROM labels WHERE dataset = ?', (dataset,))
+        if not rows:
+            raise KeyError("no labels stored for " + dataset)
+        return np.frombuffer(rows[0]['targets'], dtype=np.int16)
+
+    def load_bitsets(self, arch, kind, **config):
+        """Rows of `kind` matching `config`, with top1/top5 unpacked to boolean arrays"""
+        sql = "SELECT * FROM results WHERE arch = ? AND kind = ? AND top1_bits IS NOT NULL"
+        params = [arch, kind]
+        for name, value in sorted(config.items()):
+            if name not in COLUMN_NAMES:
+                raise ValueError("unknown result column: " + name)
+            sql += " AND %s IS ?" % name
+            params.append(value)
+        rows = self.query(sql + " ORDER BY id", params)
+        for row in rows:
+            row['top1'] = unpack_bits(row.pop('top1_bits'), row['samples'])
+            row['top5'] = unpack_bits(row.pop('top5_bits'), row['samples'])
+        return rows
+
+    def has_heatmaps(self, arch):
+        return bool(self.query("SELECT 1 FROM results WHERE arch = ? AND kind = 'heatmap' LIMIT 1", (arch,)))
+
+    def heatmap_layers(self, arch):
+        """Number of layers with a heatmap, the layers of the arch once it was
+        generated. KeyError when a layer before the last one has no complete
+        heatmap, e.g. after an interrupted generation."""
+        rows = self.query("SELECT layer, COUNT(DISTINCT region) AS regions FROM results WHERE arch = ? "
+                          "AND kind IN ('heatmap_shared', 'heatmap') AND pattern IS NULL "
+                          "GROUP BY layer", (arch,))
+        if not rows:
+            return 0
+        layers = max(row['layer'] for row in rows) + 1
+        complete = set(row['layer'] for row in rows if row['regions'] == HEATMAP_REGIONS)
+        missing = [layer for layer in range(layers) if layer not in complete]
+        if missing:
+            raise KeyError("incomplete heatmaps for %s in '%s', layers %s lack regions, regenerate them with "
+                           "heatmap_generate_imagenet.py -a %s"
+                           % (arch, self.path, ', '.join(str(layer) for layer in missing), arch))
+        return layers
+
+    def load_baseline(self, arch, metric='acc1'):
+        """Accuracy of the latest clean baseline of `arch` on the largest validation
+        set, None without one. Input erase patterns change the baseline, tile
+        masks (hooks only) do not."""
+        rows = self.query("SELECT %s AS acc FROM results WHERE arch = ? AND kind = 'baseline' "
+                          "AND (pattern IS NULL OR pattern LIKE 'tiles:%%') "
+                          "ORDER BY samples DESC, id DESC LIMIT 1" % _metric(metric), (arch,))
+        return rows[0]['acc'] if rows else None
+
+    def require_heatmaps(self, arch, legacy_directory=None):
+        """Number of heatmap layers of `arch`. The first use imports the legacy
+        text heatmaps when they are the ones of `arch`, KeyError without any."""
+        if legacy_directory and arch == LEGACY_HEATMAP_ARCH and not self.has_heatmaps(arch):
+            self.import_heatmap_text(arch, legacy_directory)
+        layers = self.heatmap_layers(arch)
+        if not layers:
+            raise KeyError("no heatmaps for %s in '%s', generate them with "
+                           "heatmap_generate_imagenet.py -a %s" % (arch, self.path, arch))
+        return layers
+
+    def load_heatmap(self, arch, layer, metric='acc5'):
+        """64 region accuracies of a layer without input erase pattern, per region
+        the latest measurement on the largest validation set. Measured regions
+        override the ones shared from other layers of the stage."""
+        rows = self.query("SELECT region, %s AS acc FROM results WHERE arch = ? "
+                          "AND kind IN ('heatmap_shared', 'heatmap') AND layer = ? AND pattern IS NULL "
+                          "ORDER BY COALESCE(samples, ?), kind = 'heatmap', id" % _metric(metric),
+                          (arch, layer, LEGACY_HEATMAP_SAMPLES))
+        heatmap = [None] * HEATMAP_REGIONS
+        for row in rows:
+            heatmap[row['region']] = row['acc']
+        if None in heatmap:
+            raise KeyError("incomplete %s heatmap for %s layer %d" % (metric, arch, layer))
+        return heatmap
+
+    def load_class_heatmap(self, arch, layer, metric='acc5'):
+        """classes x 64 per-class region accuracies of a layer without input erase
+        pattern, per region the latest measurement on the largest validation set"""
+        column = 'class_' + _metric(metric)
+        rows = self.query("SELECT region, %s AS acc FROM results WHERE arch = ? AND kind = 'heatmap' "
+                          "AND layer = ? AND %s IS NOT NULL AND pattern IS NULL "
+                          "ORDER BY samples, id" % (column, column), (arch, layer))
+        heatmap = [None] * HEATMAP_REGIONS
+        for row in rows:
+            heatmap[row['region']] = unpack_floats(row['acc'])
+        if None in heatmap:
+            raise KeyError("incomplete per-class %s heatmap for %s layer %d" % (metric, arch, layer))
+        return np.stack(heatmap, axis=1)
+
+    def load_class_baseline(self, arch, metric='acc5'):
+        """Per-class accuracy of the latest baseline with per-class results"""
+        column = 'class_' + _metric(metric)
+        rows = self.query("SELECT %s AS acc FROM results WHERE arch = ? AND kind = 'baseline' "
+                          "AND %s IS NOT NULL ORDER BY id DESC LIMIT 1" % (column, column), (arch,))
+        if not rows:
+            raise KeyError("no per-class %s baseline for %s" % (metric, arch))
+        return unpack_floats(rows[0]['acc'])
+
+    def load_joint_heatmap(self, arch, layer, channel_groups, metric='acc5'):
+        """channel_groups x 64 block accuracies, measured blocks override estimates"""
+        rows = self.query("SELECT channel_group, region, %s AS acc FROM results WHERE arch = ? "
+                          "AND kind IN ('heatmap_joint_estimate', 'heatmap_joint') AND layer = ? "
+                          "AND channel_groups = ? ORDER BY kind = 'heatmap_joint', id"
+                          % _metric(metric), (arch, layer, channel_groups))
+        heatmap = [[None] * HEATMAP_REGIONS for _ in range(channel_groups)]
+        for row in rows:
+            heatmap[row['channel_group']][row['region']] = row['acc']
+        if any(None in row for row in heatmap):
+            raise KeyError("incomplete %s joint heatmap for %s layer %d" % (metric, arch, layer))
+        return heatmap
+
+    def pareto(self, arch, kind='multi_layer', pattern=None, metric='acc1'):
+        """Configurations not beaten on both MACs saved and accuracy, by MACs saved"""
+        sql = ("SELECT * FROM results WHERE arch = ? AND kind = ? AND macs_saved IS NOT NULL")
+        params = [arch, kind]
+        if pattern is not None:
+            sql += " AND pattern = ?"
+            params.append(pattern)
+        rows = self.query(sql + " ORDER BY macs_saved DESC, %s DESC" % _metric(metric), params)
+        frontier = []
+        for row in rows:
+            if not frontier or row[metric] > frontier[-1][metric]:
+                frontier.append(row)
+        frontier.reverse()
+        return frontier
+
+    def import_heatmap_text(self, arch, directory):
+        """Import the legacy results@{1,5}_cnvlayer<N>.txt heatmap files"""
+        layer = 0
+        while True:
+            paths = [os.path.join(directory, 'acc%d' % k, 'results@%d_cnvlayer%d.txt' % (k, layer))
+                     for k in (1, 5)]
+            if not all(os.path.isfile(path) for path in paths):
+                break
+            acc1, acc5 = [_read_numbers(path) for path in paths]
+            for region, (a1, a5) in enumerate(zip(acc1, acc5)):
+                self.add(arch=arch, kind='heatmap', layer=layer, region=region, acc1=a1, acc5=a5)
+            layer += 1
+        self.flush()
+        return layer
+
+    def import_zero_out_text(self, arch, path, ratio, kind):
+        """Import a legacy results_<ratio>.txt file of the single or multi layer sweep"""
+        with open(path) as f:
+            lines = [line for line in f.read().split('\n') if line.strip()]
+        for line_idx, line in enumerate(lines):
+            numbers = [float(n) for n in re.findall(r'-?\d+(?:\.\d+)?', line.replace('cuda:0', ''))]
+            row = dict(arch=arch, kind=kind, ratio=ratio, acc1=numbers[1], acc5=numbers[2])
+            if kind == 'single_layer':
+                # The layer column was not updated, lines follow the conv order
+                row['layer'] = line_idx
+            else:
+                row['layer'] = int(numbers[0])
+            if len(numbers) >= 5:
+                row['erase_pixel'] = int(numbers[3])
+                row['total_pixel'] = int(numbers[4])
+            self.add(**row)
+        self.flush()
+        return len(lines)
+
+
+def pack_bits(correct):
+    """Pack a boolean array of per-image correctness, 8 images per byte"""
+    return np.packbits(np.asarray(correct, dtype=bool)).tobytes()
+
+
+def unpack_bits(blob, samples):
+    return np.unpackbits(np.frombuffer(blob, dtype=np.uint8), count=samples).astype(bool)
+
+
+def pack_floats(values):
+    return np.asarray(values, dtype=np.float32).tobytes()
+
+
+def unpack_floats(blob):
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+def _metric(metric):
+    if metric not in ('acc1', 'acc5'):
+        raise ValueError("metric must be acc1 or acc5, got " + str(metric))
+    return metric
+
+
+def _read_numbers(path):
+    with open(path) as f:
+        return [float(n) for n in f.read().replace('\n', '').split(',')[:-1]]
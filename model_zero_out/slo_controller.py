@@ -0,0 +1,105 @@
+import collections
+
+# Latency SLO controller (--latency-slo).
+#
+# The hidden ratio of every hooked layer moves along a ladder of ratios whose
+# masks are compiled ahead. After every window of batches, the p95 batch
+# latency of the window is compared with the target:
+#
+#   p95 > target * (1 + band)  one step up, more skipping, right away
+#   p95 < target * (1 - band)  one step down after `dwell` such windows in a row
+#
+# The dead band and the slower way down keep the ratio from flapping between
+# two steps. The window restarts after every step, so a decision only looks
+# at latencies of the current ratio.
+
+
+class LatencyController(object):
+
+    def __init__(self, target, ladder, start_ratio=0.0, window=20, band=0.1, dwell=3, telemetry=None):
+        self.target = target
+        self.ladder = sorted(ladder)
+        self.window = window
+        self.band = band
+        self.dwell = dwell
+        # Closest step to the starting ratio
+        self.level = min(range(len(self.ladder)), key=lambda i: abs(self.ladder[i] - start_ratio))
+        self.latencies = collections.deque(maxlen=window)
+        self.calm = 0
+        self.last_p95 = 0.0
+        self.reset_stats()
+        self.telemetry = telemetry
+        if telemetry is not None:
+            self.ratio_metric = telemetry.gauge('slo.ratio')
+            self.p95_metric = telemetry.gauge('slo.p95_ms')
+            self.up_metric = telemetry.counter('slo.steps_up')
+            self.down_metric = telemetry.counter('slo.steps_down')
+            telemetry.set(self.ratio_metric, self.ratio)
+
+    @property
+    def ratio(self):
+        return self.ladder[self.level]
+
+    def reset_stats(self):
+        self.batches_per_step = [0] * len(self.ladder)
+        self.steps_up = 0
+        self.steps_down = 0
+
+    def observe(self, seconds):
+        """Record the latency of one batch, and step between the windows"""
+        self.batches_per_step[self.level] += 1
+        self.latencies.append(seconds)
+        if len(self.latencies) < self.window:
+            return
+        self.last_p95 = percentile(self.latencies, 95)
+        self.latencies.clear()
+        if self.last_p95 > self.target * (1 + self.band):
+            self.calm = 0
+            if self.level < len(self.ladder) - 1:
+                self.step(1)
+        elif self.last_p95 < self.target * (1 - self.band):
+            self.calm += 1
+            if self.calm >= self.dwell and self.level > 0:
+                self.calm = 0
+                self.step(-1)
+        else:
+            self.calm = 0
+        if self.telemetry is not None:
+            self.telemetry.set(self.p95_metric, 1e3 * self.last_p95)
+
+    def step(self, direction):
+        self.level += direction
+        if direction > 0:
+            self.steps_up += 1
+        else:
+            self.steps_down += 1
+        if self.telemetry is not None:
+            self.telemetry.inc(self.up_metric if direction > 0 else self.down_metric)
+            self.telemetry.set(self.ratio_metric, self.ratio)
+
+    def mean_ratio(self):
+        """Hidden ratio averaged over the batches since reset_stats()"""
+        batches = sum(self.batches_per_step)
+        if not batches:
+            return self.ratio
+        return sum(r * n for r, n in zip(self.ladder, self.batches_per_step)) / float(batches)
+
+    def summary(self):
+        steps = ', '.join('%g: %d' % (r, n) for r, n in zip(self.ladder, self.batches_per_step) if n)
+        return ("latency SLO p95 %.1f ms: mean ratio %.3f, %d steps up, %d down, batches per ratio {%s}"
+                % (1e3 * self.target, self.mean_ratio(), self.steps_up, self.steps_down, steps))
+
+
+def percentile(values, q):
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(int(-(-q * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+def parse_ladder(spec):
+    """'0,0.1,0.25' -> [0.0, 0.1, 0.25]"""
+    ladder = sorted(set(float(r) for r in spec.split(',') if r.strip()))
+    if not ladder or ladder[0] < 0 or ladder[-1] > 1:
+        raise ValueError("a ratio ladder needs ratios in [0, 1], got '%s'" % spec)
+    return ladder
@@ -0,0 +1,225 @@
+import argparse
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+from masks import skipped_fraction, static_region_count
+from ratio_optimizer import layer_macs, load_single_layer
+from results_store import ResultsStore
+
+# Surrogate for the accuracy of any per-layer ratio configuration.
+#
+# A configuration is the hidden ratio of each of the 53 layers. Its features are
+# the sums over layers of the single layer sweep drops and of the OBE heatmap
+# drops of the regions the hook skips. A bootstrap ensemble of ridge regressions
+# on the logit of the accuracy, fitted to every measured multi layer and
+# schedule point, gives a prediction and its spread.
+#
+# --propose N then writes the N most promising configurations the surrogate is
+# least sure about as --ratio-schedule files; validating them and running this
+# again closes the active learning loop.
+
+parser = argparse.ArgumentParser(description='Multi-layer mask accuracy surrogate')
+parser.add_argument('-a', '--arch', default='resnet50', type=str,
+                    help='model architecture (default: resnet50)')
+parser.add_argument('--results-db', default='../results.db', type=str, metavar='PATH',
+                    help='results store (default: ../results.db)')
+parser.add_argument('--single-layer-dir', default='results/single_layer', type=str,
+                    help='text results imported when the store has no single layer sweep')
+parser.add_argument('--multi-layer-dir', default='results/multi_layer', type=str,
+                    help='text results imported when the store has no multi layer sweep')
+parser.add_argument('--baseline-acc1', default=76.146, type=float,
+                    help='top-1 without any hook (default: 76.146, pretrained resnet50)')
+parser.add_argument('--baseline-acc5', default=92.878, type=float,
+                    help='top-5 without any hook (default: 92.878, pretrained resnet50)')
+parser.add_argument('--ensemble', default=32, type=int,
+                    help='bootstrap ensemble size (default: 32)')
+parser.add_argument('--ridge', default=1e-2, type=float,
+                    help='ridge regularization (default: 0.01)')
+parser.add_argument('--schedule', default='', type=str, metavar='PATH',
+                    help='predict the accuracy of this --ratio-schedule file')
+parser.add_argument('--propose', default=0, type=int, metavar='N',
+                    help='write N configurations worth validating next')
+parser.add_argument('--candidates', default=20000, type=int,
+                    help='random configurations scored for --propose (default: 20000)')
+parser.add_argument('--target-drop', default=1.0, type=float,
+                    help='top-1 drop a proposed configuration should stay within (default: 1.0)')
+parser.add_argument('--proposal-dir', default='proposals', type=str,
+                    help='directory of the proposed schedules (default: proposals)')
+parser.add_argument('--seed', default=0, type=int, help='seed of the candidate sampling')
+
+
+def load_multi_layer(store, arch, directory, num_layers):
+    """(ratios per layer, acc1, acc5) of the measured multi layer and schedule points"""
+    query = "SELECT * FROM results WHERE arch = ? AND kind = 'multi_layer' ORDER BY id"
+    rows = store.query(query, (arch,))
+    if not rows:
+        for path in glob.glob(os.path.join(directory, 'results_*.txt')):
+            ratio = float(re.search(r'results_([\d.]+)\.txt$', path).group(1))
+            store.import_zero_out_text(arch, path, ratio, 'multi_layer')
+        rows = store.query(query, (arch,))
+
+    points = []
+    for row in rows:
+        # Every layer from `layer` on is hooked
+        ratios = np.zeros(num_layers)
+        ratios[row['layer']:] = row['ratio']
+        points.append((ratios, row['acc1'], row['acc5']))
+    for row in store.query("SELECT ratios, acc1, acc5 FROM results WHERE arch = ? "
+                           "AND kind = 'schedule' AND ratios IS NOT NULL", (arch,)):
+        points.append((np.array(json.loads(row['ratios'])), row['acc1'], row['acc5']))
+    return points
+
+
+class Surrogate(object):
+
+    def __init__(self, single_layer, heatmaps, baseline, num_layers):
+        self.baseline = baseline
+        ratios = sorted(set(ratio for _, ratio in single_layer))
+        self.grid = np.array([0.0] + ratios)
+        # Drop of every layer at every grid ratio, for top-1 and top-5
+        self.single_drop = np.zeros((2, num_layers, len(self.grid)))
+        for (layer, ratio), acc in single_layer.items():
+            g = ratios.index(ratio) + 1
+            for k in range(2):
+                self.single_drop[k, layer, g] = max(baseline[k] - acc[k], 0.0)
+
+        # Drop of the heatmap regions the static hook skips at every grid ratio
+        self.heatmap_drop = np.zeros((num_layers, len(self.grid)))
+        for layer, heatmap in enumerate(heatmaps):
+            ranked = np.sort(np.maximum(baseline[1] - np.array(heatmap), 0.0))[::-1]
+            for g, ratio in enumerate(self.grid):
+                count = static_region_count(ratio)
+                self.heatmap_drop[layer, g] = ranked[:count].sum()
+        self.weights = None
+
+    def features(self, configs):
+        """Feature matrix of an (n, layers) array of per-layer ratios"""
+        configs = np.atleast_2d(configs)
+        single = np.zeros((2, len(configs)))
+        heat = np.zeros(len(configs))
+        for layer in range(configs.shape[1]):
+            ratios = configs[:, layer]
+            for k in range(2):
+                single[k] += np.interp(ratios, self.grid, self.single_drop[k, layer])
+            heat += np.interp(ratios, self.grid, self.heatmap_drop[layer])
+        hooked = np.count_nonzero(configs > 0, axis=1)
+        return np.stack([np.ones(len(configs)), single[0], single[1], np.sqrt(single[0]),
+                         heat, np.sqrt(heat), hooked, configs.mean(axis=1)], axis=1)
+
+    def fit(self, configs, acc, ensemble, ridge, seed=0):
+        x = self.features(configs)
+        # Standardize so one ridge strength suits every feature
+        self.mean = x.mean(axis=0)
+        self.mean[0] = 0.0
+        self.scale = x.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        x = (x - self.mean) / self.scale
+        y = _logit(np.asarray(acc) / 100.0)
+        rng = np.random.RandomState(seed)
+        eye = ridge * np.eye(x.shape[1])
+        eye[0, 0] = 0.0
+        weights = []
+        for _ in range(ensemble):
+            idx = rng.randint(len(x), size=len(x))
+            weights.append(np.linalg.solve(x[idx].T.dot(x[idx]) + eye, x[idx].T.dot(y[idx, :])))
+        self.weights = np.stack(weights)
+
+    def predict(self, configs):
+        """Mean and standard deviation of the predicted (top-1, top-5), each (n, 2)"""
+        x = (self.features(configs) - self.mean) / self.scale
+        pred = 100.0 * _sigmoid(np.einsum('nf,efk->enk', x, self.weights))
+        return pred.mean(axis=0), pred.std(axis=0)
+
+
+def _logit(p):
+    p = np.clip(p, 1e-4, 1 - 1e-4)
+    return np.log(p / (1 - p))
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+def sample_candidates(grid, num_layers, count, rng):
+    """Contiguous multi layer configurations plus random per-layer schedules"""
+    candidates = []
+    for _ in range(count):
+        if rng.rand() < 0.25:
+            config = np.zeros(num_layers)
+            config[rng.randint(num_layers):] = rng.choice(grid[1:])
+        else:
+            config = rng.choice(grid, size=num_layers)
+            config[rng.rand(num_layers) < rng.rand()] = 0.0
+        candidates.append(config)
+    return np.stack(candidates)
+
+
+def main():
+    args = parser.parse_args()
+    store = ResultsStore(args.results_db)
+    baseline = (args.baseline_acc1, args.baseline_acc5)
+
+    acc1 = load_single_layer(store, args.arch, args.single_layer_dir)
+    acc5 = dict(((row['layer'], row['ratio']), row['acc5']) for row in store.query(
+        "SELECT layer, ratio, acc5 FROM results WHERE arch = ? AND kind = 'single_layer'", (args.arch,)))
+    single_layer = dict((key, (acc1[key], acc5[key])) for key in acc1)
+    num_layers = max(layer for layer, _ in single_layer) + 1
+    try:
+        store.require_heatmaps(args.arch, '../heatmap_generate/heatmap_results')
+    except KeyError as e:
+        parser.error(e.args[0])
+    heatmaps = [store.load_heatmap(args.arch, layer) for layer in range(num_layers)]
+
+    points = load_multi_layer(store, args.arch, args.multi_layer_dir, num_layers)
+    configs = np.stack([ratios for ratios, _, _ in points])
+    acc = np.array([[a1, a5] for _, a1, a5 in points])
+
+    surrogate = Surrogate(single_layer, heatmaps, baseline, num_layers)
+    surrogate.fit(configs, acc, args.ensemble, args.ridge, args.seed)
+    fitted, _ = surrogate.predict(configs)
+    print("fitted on %d measured configurations, mean abs error acc@1 %.3f acc@5 %.3f"
+          % (len(points), np.abs(fitted[:, 0] - acc[:, 0]).mean(), np.abs(fitted[:, 1] - acc[:, 1]).mean()))
+
+    if args.schedule:
+        with open(args.schedule) as f:
+            ratios = np.array(json.load(f)['ratios'])
+        mean, std = surrogate.predict(ratios)
+        print("predicted acc@1 %.3f +- %.3f, acc@5 %.3f +- %.3f"
+              % (mean[0, 0], std[0, 0], mean[0, 1], std[0, 1]))
+
+    if args.propose:
+        rng = np.random.RandomState(args.seed)
+        macs = np.array(layer_macs(args.arch), dtype=np.float64)
+        candidates = sample_candidates(surrogate.grid, num_layers, args.candidates, rng)
+        mean, std = surrogate.predict(candidates)
+        fractions = np.vectorize(skipped_fraction)(candidates)
+        macs_saved = fractions.dot(macs)
+
+        # Promising: could be within the target drop given the uncertainty.
+        # Among those, the ones that save many MACs and that the surrogate is
+        # least sure about are worth a real validation pass first.
+        promising = np.nonzero(args.baseline_acc1 - (mean[:, 0] + 2 * std[:, 0]) <= args.target_drop)[0]
+        order = promising[np.argsort(-(macs_saved[promising] / macs.sum()) * std[promising, 0])]
+        if not os.path.isdir(args.proposal_dir):
+            os.makedirs(args.proposal_dir)
+        for i, c in enumerate(order[:args.propose]):
+            path = os.path.join(args.proposal_dir, 'schedule_%d.json' % i)
+            with open(path, 'w') as f:
+                json.dump({
+                    'arch': args.arch,
+                    'baseline_acc1': args.baseline_acc1,
+                    'predicted_drop': args.baseline_acc1 - mean[c, 0],
+                    'predicted_std': std[c, 0],
+                    'macs_saved': macs_saved[c],
+                    'ratios': candidates[c].tolist(),
+                }, f, indent=2)
+            print("%s: predicted acc@1 %.3f +- %.3f, MACs saved %.3f%%"
+                  % (path, mean[c, 0], std[c, 0], 100.0 * macs_saved[c] / macs.sum()))
+
+
+if __name__ == '__main__':
+    main()
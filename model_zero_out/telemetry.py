@@ -0,0 +1,114 @@
+import array
+import atexit
+import bisect
+import json
+import os
+import sys
+import time
+
+# Metrics registry for the forward hooks.
+#
+# Counters, gauges and histogram buckets live in one preallocated array of
+# doubles. Metrics are registered by name once, outside of the hot path, and
+# updated through their slot index, so a hook call costs a few additions and
+# never formats a string or writes to stdout. The registry is flushed as one
+# JSON line per interval (and at the end of every validation) to --telemetry.
+#
+# Verbosity: 0 writes nothing, 1 writes the JSON lines file, 2 also prints a
+# short summary line per flush.
+
+FRACTION_BOUNDS = (0.0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0)
+
+
+class Telemetry(object):
+
+    def __init__(self, path='', verbosity=1, interval=10.0, capacity=1024):
+        self.path = path
+        self.verbosity = verbosity
+        self.interval = interval
+        self.values = array.array('d', bytes(8 * capacity))
+        self.slots = {}
+        self.kinds = []
+        self.bounds = {}
+        self.size = 0
+        self.file = None
+        self.last_flush = time.time()
+        atexit.register(self.close)
+
+    def _register(self, name, kind, slots):
+        if name in self.slots:
+            return self.slots[name]
+        slot = self.size
+        self.size += slots
+        if self.size > len(self.values):
+            self.values.extend(bytes(8 * max(self.size - len(self.values), len(self.values))))
+        self.slots[name] = slot
+        self.kinds.append((name, kind, slot))
+        return slot
+
+    def counter(self, name):
+        return self._register(name, 'counter', 1)
+
+    def gauge(self, name):
+        return self._register(name, 'gauge', 1)
+
+    def histogram(self, name, bounds=FRACTION_BOUNDS):
+        """Buckets (-inf, b0], (b0, b1], ..., (bn, inf) plus the count and sum of the observations"""
+        slot = self._register(name, 'histogram', len(bounds) + 3)
+        self.bounds[slot] = bounds
+        return slot
+
+    def inc(self, slot, value=1.0):
+        self.values[slot] += value
+
+    def set(self, slot, value):
+        self.values[slot] = value
+
+    def observe(self, slot, value):
+        bounds = self.bounds[slot]
+        self.values[slot + bisect.bisect_left(bounds, value)] += 1
+        self.values[slot + len(bounds) + 1] += 1
+        self.values[slot + len(bounds) + 2] += value
+
+    def tick(self):
+        """Flush when the interval has passed, cheap enough to call once per batch"""
+        if self.verbosity and time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def snapshot(self):
+        metrics = {}
+        for name, kind, slot in self.kinds:
+            if kind == 'histogram':
+                bounds = self.bounds[slot]
+                count = self.values[slot + len(bounds) + 1]
+                metrics[name] = {'bounds': list(bounds),
+                                 'buckets': self.values[slot: slot + len(bounds) + 1].tolist(),
+                                 'count': count,
+                                 'mean': self.values[slot + len(bounds) + 2] / count if count else 0.0}
+            else:
+                metrics[name] = self.values[slot]
+        return metrics
+
+    def flush(self, **fields):
+        self.last_flush = time.time()
+        if not self.verbosity:
+            return
+        record = dict(time=self.last_flush, pid=os.getpid(), **fields)
+        record['metrics'] = self.snapshot()
+        if self.path:
+            if self.file is None:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+        if self.verbosity >= 2:
+            counters = sum(1 for _, kind, _ in self.kinds if kind == 'counter')
+            sys.stdout.write('telemetry: %d metrics (%d counters) %s\n'
+                             % (len(self.kinds), counters, json.dumps(fields)))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,26 @@
+#!/bin/bash
+# Offline end-to-end run on generated data: heatmap generation into the
+# results store, then the masked multi layer evaluation that reads it back.
+# Needs neither ImageNet nor network access; --pretrained uses the torch hub
+# cache when the weights were downloaded before, random weights otherwise.
+# Results go to results_synthetic.db.
+#
+#   ./synthetic_pipeline.sh                 # resnet18, 32 images
+#   ARCH=resnet50 IMAGES=256 ./synthetic_pipeline.sh
+set -e
+
+ARCH=${ARCH:-resnet18}
+IMAGES=${IMAGES:-32}
+BATCH=${BATCH:-32}
+RATIO=${RATIO:-0.25}
+WORKERS=${WORKERS:-2}
+COMMON="-a $ARCH -e --pretrained --synthetic $IMAGES -b $BATCH -j $WORKERS --no-profile"
+
+cd "$(dirname "$0")"
+rm -f results_synthetic.db
+
+cd heatmap_generate
+time python3 heatmap_generate_imagenet.py $COMMON --share-heatmaps --share-report ../heatmap_sharing_synthetic.json
+
+cd ../model_zero_out
+time python3 erase_experiment_imagenet.py $COMMON --hidden-ratio-for-model $RATIO